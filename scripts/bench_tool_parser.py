@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+工具调用解析基准测试
+
+构造约 100 KB 的模型输出（包含代码示例、字符串中的括号以及工具调用），
+测量 parse_tool_calls_from_response 的吞吐量。
+
+用法: python scripts/bench_tool_parser.py [--size-kb 100] [--repeat 50]
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+CODE_SAMPLE = """
+Here is an example:
+
+```python
+def merge(a, b):
+    result = {**a, **b}
+    return {k: v for k, v in result.items() if v is not None}
+```
+
+And in JavaScript: `const cfg = { retries: 3, hooks: [ () => {} ] };`
+The template string "{name} {{escaped}} [list]" contains braces too.
+"""
+
+TOOL_CALL = {
+    "type": "tool_use",
+    "id": "call_123",
+    "name": "Edit",
+    "input": {
+        "file_path": "/tmp/app.py",
+        "old_string": "if (a) { b(); }",
+        "new_string": "if (a) {\n    b();\n}",
+    },
+}
+
+
+def build_response(size_kb: int, fenced: bool) -> str:
+    """构造指定大小的模型输出"""
+    parts = []
+    while sum(len(p) for p in parts) < size_kb * 1024:
+        parts.append(CODE_SAMPLE)
+    tool_json = json.dumps(TOOL_CALL, indent=2)
+    if fenced:
+        parts.append(f"```json\n{tool_json}\n```")
+    else:
+        parts.append(tool_json)
+    return "".join(parts)
+
+
+def bench(text: str, repeat: int) -> float:
+    """返回吞吐量（MB/s）"""
+    from src.claude_code_adapter.utils import parse_tool_calls_from_response
+
+    tools, _ = parse_tool_calls_from_response(text)
+    assert len(tools) == 1, f"期望解析到 1 个工具调用，实际 {len(tools)}"
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parse_tool_calls_from_response(text)
+    elapsed = time.perf_counter() - start
+    return len(text.encode("utf-8")) * repeat / elapsed / (1024 * 1024)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="工具调用解析基准测试")
+    parser.add_argument("--size-kb", type=int, default=100, help="响应大小（KB）")
+    parser.add_argument("--repeat", type=int, default=50, help="重复次数")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    for fenced in (True, False):
+        text = build_response(args.size_kb, fenced)
+        throughput = bench(text, args.repeat)
+        label = "```json 代码块" if fenced else "裸 JSON"
+        print(
+            f"{label:<14} 大小: {len(text) / 1024:.1f} KB  "
+            f"吞吐量: {throughput:.1f} MB/s  "
+            f"单次耗时: {len(text) / 1024 / 1024 / throughput * 1000:.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,25 +2,70 @@
 FastAPI应用主文件
 """
 
+import asyncio
+import contextlib
+import hashlib
 import json
 import logging
-from typing import Any, Dict, List
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
 
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 
-from .config import config_manager, settings
-from .models import HealthResponse
+from . import metrics
+from .config import Settings, config_manager, freeze, settings, thaw
+from .models import CountTokensResponse, HealthResponse
 from .services import (
+    BackendLimiters,
+    LocalToolSelector,
     MessageConverter,
     OpenAIClient,
+    OverloadedError,
+    ResponseCache,
     ResponseProcessor,
+    SingleFlight,
+    StreamProcessor,
+    StreamTimer,
+    ToolSelectionCache,
+    client_registry,
+    current_caller,
+)
+from .tokenizer import get_token_counter
+from .tracing import RequestIdMiddleware, tracer
+from .utils import (
+    convert_tool_choice_to_openai,
+    convert_tools_to_openai,
+    format_sse,
+    supports_native_tools,
+    tool_prompt_cache_stats,
 )
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """应用生命周期：启动配置文件监听，关闭时释放上游连接池"""
+    watcher = None
+    if config_manager.settings.config_watch_interval > 0:
+        watcher = asyncio.create_task(config_manager.watch())
+    try:
+        yield
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await watcher
+        await client_registry.aclose()
+        response_cache.close()
+        tracer.close()
+
+
 # 创建FastAPI应用
 app = FastAPI(
     title="Claude Code Adapter",
@@ -29,20 +74,201 @@ app = FastAPI(
       根据配置自动优化性能和功能完整性；支持可选的自动工具选择、SSE 流式转发，
       以及将目标模型响应回转为 Anthropic 格式。仅提供服务端代理，不侵入客户端 SDK。""",
     version="1.1.2",
+    lifespan=lifespan,
+)
+# 统计消息接口的进行中请求数、状态码与端到端耗时（含流式传输）
+app.add_middleware(
+    metrics.MetricsMiddleware, paths=("/v1/messages", "/v1/messages/count_tokens")
+)
+# 请求 ID 从请求头读取（缺失时生成）并回写到响应头
+app.add_middleware(
+    RequestIdMiddleware,
+    paths=("/v1/messages", "/v1/messages/count_tokens"),
+    header=lambda: config_manager.settings.request_id_header or "x-request-id",
 )
 
 
 # 初始化服务
 message_converter = MessageConverter()
-openai_client = OpenAIClient()
-tool_selection_client = OpenAIClient()
+# 目标模型与工具选择模型共用同一个客户端注册表，响应缓存只用于目标模型
+response_cache = ResponseCache()
+# 并发的相同请求合并为一次上游调用（目标模型与工具选择模型共用）
+request_coalescer = SingleFlight()
+# 节点级并发限制器按地址共享：两类请求发往同一节点时在同一个公平队列中排队
+backend_limiters = BackendLimiters()
+openai_client = OpenAIClient(
+    client_registry,
+    response_cache,
+    request_coalescer,
+    "target_backends",
+    "target_max_concurrency",
+    fallback_setting="target_fallback",
+    backend_limiters=backend_limiters,
+)
+tool_selection_client = OpenAIClient(
+    client_registry,
+    coalescer=request_coalescer,
+    backends_setting="tool_selection_backends",
+    concurrency_setting="tool_selection_max_concurrency",
+    route="tool_selection",
+    fallback_setting="tool_selection_fallback",
+    backend_limiters=backend_limiters,
+)
+local_tool_selector = LocalToolSelector()
+tool_selection_cache = ToolSelectionCache()
 response_processor = ResponseProcessor()
+stream_processor = StreamProcessor()
 
 
 @app.get("/health", response_model=HealthResponse)
 async def health() -> HealthResponse:
     """健康检查端点"""
-    return HealthResponse(ok=True, target_base=settings.target_base_url)
+    breakers = {
+        client.route: {url: b.snapshot() for url, b in client.breakers.items()}
+        for client in (openai_client, tool_selection_client)
+        if client.breakers
+    }
+    return HealthResponse(
+        ok=True,
+        target_base=config_manager.settings.target_base_url,
+        circuit_breakers=breakers,
+    )
+
+
+@metrics.registry.collector
+def collect_service_stats() -> Iterator[metrics.Family]:
+    """抓取时读取各服务已有的统计信息"""
+    caches = {
+        "response": response_cache.stats(),
+        "tool_selection": tool_selection_cache.stats(),
+        "tool_prompt": tool_prompt_cache_stats(),
+        "conversion": message_converter.conversion_cache.stats(),
+        "token_count": get_token_counter(config_manager.settings).stats(),
+    }
+    yield (
+        "adapter_cache_hits_total",
+        "counter",
+        "Cache hits by cache",
+        [({"cache": name}, s.get("hits", 0)) for name, s in caches.items()],
+    )
+    yield (
+        "adapter_cache_misses_total",
+        "counter",
+        "Cache misses by cache",
+        [({"cache": name}, s.get("misses", 0)) for name, s in caches.items()],
+    )
+    yield (
+        "adapter_cache_entries",
+        "gauge",
+        "Cached entries by cache",
+        [({"cache": name}, s.get("size", 0)) for name, s in caches.items()],
+    )
+    yield (
+        "adapter_coalesced_requests_total",
+        "counter",
+        "Requests served by an in-flight identical upstream call",
+        [({}, request_coalescer.stats["coalesced"])],
+    )
+    yield (
+        "adapter_speculation_total",
+        "counter",
+        "Speculative executions by outcome",
+        [({"outcome": k}, v) for k, v in speculation_stats.items()],
+    )
+
+    clients = (openai_client, tool_selection_client)
+    yield (
+        "adapter_upstream_attempts_total",
+        "counter",
+        "Upstream attempt outcomes, retries and hedges by route",
+        [
+            ({"route": c.route, "outcome": k}, v)
+            for c in clients
+            for k, v in c.attempt_stats.items()
+        ],
+    )
+    limiters = [(c.route, c.limiter.stats()) for c in clients]
+    for field, kind in (
+        ("in_flight", "gauge"),
+        ("queue_depth", "gauge"),
+        ("admitted", "counter"),
+        ("rejected", "counter"),
+        ("timed_out", "counter"),
+    ):
+        yield (
+            f"adapter_admission_{field}" + ("_total" if kind == "counter" else ""),
+            kind,
+            f"Admission control {field.replace('_', ' ')} by route",
+            [({"route": route}, s[field]) for route, s in limiters],
+        )
+    yield (
+        "adapter_priority_requests_total",
+        "counter",
+        "Admitted upstream requests by route and priority class",
+        [
+            ({"route": c.route, "class": name}, s["requests"])
+            for c in clients
+            for name, s in c.class_stats.items()
+        ],
+    )
+    yield (
+        "adapter_circuit_open",
+        "gauge",
+        "Whether a backend circuit breaker is open (1) or half open (0.5)",
+        [
+            (
+                {"route": c.route, "backend": url},
+                {"open": 1.0, "half_open": 0.5}.get(b.snapshot()["state"], 0.0),
+            )
+            for c in clients
+            for url, b in c.breakers.items()
+        ],
+    )
+    pools = [(c.route, c.pool) for c in clients if c.pool is not None]
+    yield (
+        "adapter_backend_in_flight",
+        "gauge",
+        "Outstanding requests by backend",
+        [
+            ({"route": route, "backend": b.url}, b.in_flight)
+            for route, pool in pools
+            for b in pool.backends
+        ],
+    )
+    yield (
+        "adapter_prefix_affinity_total",
+        "counter",
+        "Prefix affinity routing decisions by outcome",
+        [
+            ({"route": route, "outcome": k}, v)
+            for route, pool in pools
+            for k, v in pool.affinity_stats.items()
+            if k != "requests"
+        ],
+    )
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint() -> PlainTextResponse:
+    """以 Prometheus 文本格式导出指标"""
+    return PlainTextResponse(
+        metrics.registry.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
+@app.get("/traces")
+async def list_traces(limit: int = 20, min_duration_ms: float = 0.0) -> Any:
+    """返回内存缓冲区中最近的请求追踪（按时间倒序），可按最短耗时过滤"""
+    return {"traces": tracer.memory.recent(limit, min_duration_ms)}
+
+
+@app.get("/traces/{request_id}")
+async def get_trace(request_id: str) -> Any:
+    """按请求 ID 返回一条请求追踪"""
+    trace = tracer.memory.get(request_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="trace not found")
+    return trace
 
 
 @app.exception_handler(Exception)
@@ -54,11 +280,44 @@ async def global_exception_handler(request: Request, exc: Exception) -> JSONResp
     )
 
 
+def overloaded_response(error: OverloadedError) -> JSONResponse:
+    """准入控制拒绝时返回 Anthropic 格式的 529 overloaded_error"""
+    return JSONResponse(
+        status_code=529,
+        content={
+            "type": "error",
+            "error": {"type": "overloaded_error", "message": str(error)},
+        },
+    )
+
+
+async def close_stream(stream: Any) -> None:
+    """关闭上游流（重复关闭无副作用），释放连接与并发名额"""
+    close = getattr(stream, "close", None)
+    if close is not None:
+        with contextlib.suppress(Exception):
+            await close()
+
+
+def caller_identity(request: Request, body: Dict[str, Any], settings: Settings) -> str:
+    """调用方标识：metadata.user_id，否则为配置的请求头（密钥类请求头取哈希）"""
+    metadata = body.get("metadata")
+    if isinstance(metadata, dict) and metadata.get("user_id"):
+        return str(metadata["user_id"])
+    header = settings.caller_id_header
+    value = request.headers.get(header) if header else None
+    if not value:
+        return "anonymous"
+    if header.lower() in ("x-api-key", "authorization"):
+        return "key:" + hashlib.sha1(value.encode("utf-8")).hexdigest()[:12]
+    return value
+
+
 @app.post("/v1/messages")
 async def proxy_messages(request: Request) -> Any:
     """代理消息请求到目标服务"""
-    # 重新初始化以应用新的配置
-    config_manager.reload()
+    started = time.perf_counter()
+    # 本次请求全程使用同一个不可变配置快照，配置文件变更由后台监听任务负责重新加载
     settings = config_manager.settings
     logger.setLevel(getattr(logging, settings.log_level.upper()))
 
@@ -74,10 +333,23 @@ async def proxy_messages(request: Request) -> Any:
         raise HTTPException(status_code=400, detail="messages 不能为空")
     if not isinstance(messages, list):
         raise HTTPException(status_code=400, detail="messages 必须是一个列表")
+    # 调用方标识用于排队时的公平调度，工具选择与推测执行的子任务自动继承
+    current_caller.set(caller_identity(request, body, settings))
+    tracer.configure(settings)
+    root = tracer.start_trace(
+        "proxy_messages",
+        message_count=len(messages),
+        tool_count=len(body.get("tools") or []),
+        stream=bool(body.get("stream")),
+    )
+    # 流式响应的追踪在流结束时才完成
+    streaming = False
     try:
 
         tools = body.get("tools") or []
         tool_choice = body.get("tool_choice")
+        # 推测执行时已提前发出的主请求
+        completion_task: Optional["asyncio.Task[Any]"] = None
 
         # 工具选择逻辑
         if settings.enable_tool_selection and tools:
@@ -85,47 +357,77 @@ async def proxy_messages(request: Request) -> Any:
                 # 已经指定了工具，直接过滤
                 selected_tools = [t for t in tools if tool_choice]
                 logger.info(f"已指定工具调用: {tool_choice}")
+                body["tools"] = selected_tools
             else:
                 # 未指定时，再根据上下文做工具选择
                 recent_count = settings.recent_messages_count
                 recent_msgs = (body.get("messages") or [])[-recent_count:]
-                selected_tools = await select_tools(
-                    body.get("model"), recent_msgs, tools
+                start = time.perf_counter()
+                if should_speculate(body.get("model"), recent_msgs, tools, settings):
+                    payload, completion_task = await speculative_select_and_start(
+                        body, recent_msgs, tools, settings
+                    )
+                else:
+                    body["tools"] = await select_tools(
+                        body.get("model"), recent_msgs, tools, settings
+                    )
+                metrics.stage_duration.observe(
+                    time.perf_counter() - start, "tool_selection"
                 )
-                logger.info(f"动态选择工具: {[t['name'] for t in selected_tools]}")
-
-            body["tools"] = selected_tools
+                logger.info(f"动态选择工具: {[t['name'] for t in body['tools']]}")
         else:
             if tools:
                 logger.info("工具选择未启用，使用所有工具")
             else:
                 logger.info("无工具可用")
 
-        payload = settings.target_model_config
-        payload["model"] = payload["model"] if payload["model"] else body.get("model")
-        stream_mode = bool(body.get("stream"))
-        payload["stream"] = stream_mode
-        body["model"] = payload["model"]
-
-        # 转换消息格式
-        openai_messages = message_converter.convert_anthropic_to_openai_messages(body)
-        payload["messages"] = openai_messages
+        if completion_task is None:
+            payload = build_target_payload(body, settings)
+        model = payload["model"]
+        stream_mode = payload["stream"]
+        native_tools = "tools" in payload
+        root.set("model", model)
         url = settings.target_base_url
         key = settings.target_api_key
         # 记录实际调用目标
-        logger.info(
-            f"请求地址：{url}，"
-            f"模型：{settings.target_model_config['model']}，流式：{stream_mode}"
-        )
+        logger.info(f"请求地址：{url}，模型：{model}，流式：{stream_mode}")
+
+        async def get_completion() -> Any:
+            if completion_task is not None:
+                return await completion_task
+            return await openai_client.create_completion(url, key, payload)
 
         if stream_mode:
+            # 先发起上游请求，过载时直接返回 529 而不是开始 SSE 响应
+            stream: Any = None
+            stream_error: Optional[Exception] = None
+            start = time.perf_counter()
+            try:
+                stream = await get_completion()
+            except OverloadedError as e:
+                root.record_error(e)
+                return overloaded_response(e)
+            except Exception as e:
+                stream_error = e
+            metrics.stage_duration.observe(time.perf_counter() - start, "upstream")
 
             async def event_stream() -> Any:
+                timer = StreamTimer(stream, model, started)
+                span = tracer.start_span("stream", root)
+                # 未正常结束也未出错（生成器被取消或关闭）即客户端提前断开
+                disconnected = True
                 try:
-                    stream = await openai_client.create_completion(url, key, payload)
-                    async for chunk in stream:
-                        yield f"data: {json.dumps(chunk.model_dump())}\n\n".encode()
+                    if stream_error is not None:
+                        raise stream_error
+                    async for event in stream_processor.process_stream(
+                        timer.chunks(), model, native_tools
+                    ):
+                        yield event
+                    disconnected = False
                 except Exception as e:
+                    disconnected = False
+                    span.record_error(e)
+                    root.record_error(e)
                     logger.exception("流式请求失败")
                     error_data = {
                         "type": "error",
@@ -134,41 +436,340 @@ async def proxy_messages(request: Request) -> Any:
                             "message": f"request failed: {str(e)}",
                         },
                     }
-                    yield f"data: {json.dumps(error_data)}\n\n".encode()
-
-            return StreamingResponse(event_stream(), media_type="text/event-stream")
+                    yield format_sse("error", error_data)
+                finally:
+                    if stream_error is None:
+                        timer.finish(disconnected)
+                    span.set("chunks", timer.chunk_count)
+                    span.set("output_tokens", timer.output_tokens)
+                    span.set("disconnected", disconnected)
+                    span.end()
+                    tracer.finish_trace(root)
+
+            # 客户端提前断开时也关闭上游流
+            streaming = True
+            return StreamingResponse(
+                event_stream(),
+                media_type="text/event-stream",
+                background=BackgroundTask(close_stream, stream),
+            )
         else:
+            start = time.perf_counter()
             try:
-                completion = await openai_client.create_completion(url, key, payload)
+                completion = await get_completion()
                 lm_resp = completion.model_dump()
                 logger.debug(f"非流式模型响应: {lm_resp}")
+            except OverloadedError as e:
+                root.record_error(e)
+                return overloaded_response(e)
             except Exception as e:
+                root.record_error(e)
                 logger.exception("非流式请求失败")
                 raise HTTPException(status_code=502, detail=f"request failed: {str(e)}")
+            finally:
+                metrics.stage_duration.observe(time.perf_counter() - start, "upstream")
 
             # 处理响应
-            anthropic_resp = response_processor.process_response(
-                lm_resp, settings.target_model_config["model"]
+            start = time.perf_counter()
+            with tracer.span("process_response") as span:
+                anthropic_resp = response_processor.process_response(
+                    lm_resp, model, native_tools
+                )
+                span.set("content_blocks", len(anthropic_resp["content"]))
+            metrics.stage_duration.observe(
+                time.perf_counter() - start, "process_response"
             )
             logger.debug(f"返回给客户端的响应: {anthropic_resp}")
-            return JSONResponse(content=anthropic_resp, status_code=200)
-
+            start = time.perf_counter()
+            response = JSONResponse(content=anthropic_resp, status_code=200)
+            metrics.stage_duration.observe(time.perf_counter() - start, "serialize")
+            return response
+
+    except HTTPException as e:
+        root.set("status_code", e.status_code)
+        raise
     except Exception as e:
+        root.record_error(e)
         logger.exception("处理请求失败")
         raise HTTPException(status_code=500, detail=f"internal error: {str(e)}")
+    finally:
+        if not streaming:
+            tracer.finish_trace(root)
+
+
+@app.post("/v1/messages/count_tokens", response_model=CountTokensResponse)
+async def count_tokens(request: Request) -> CountTokensResponse:
+    """本地计算请求的输入 token 数，与 /v1/messages 使用相同的转换流程，不访问上游
+
+    计数不做历史压缩，返回客户端所发送内容的完整 token 数。
+    """
+    # 客户端据此判断何时自行压缩上下文，计数结果不能是压缩后的数值
+    settings = config_manager.settings.model_copy(
+        update={"history_token_budgets": freeze({})}
+    )
+
+    try:
+        body = await request.json()
+    except Exception:
+        logger.exception("解析请求体失败")
+        raise HTTPException(status_code=400, detail="无效的JSON")
+
+    messages = body.get("messages", [])
+    if not messages:
+        raise HTTPException(status_code=400, detail="messages 不能为空")
+    if not isinstance(messages, list):
+        raise HTTPException(status_code=400, detail="messages 必须是一个列表")
+
+    payload = build_target_payload(body, settings)
+    counter = get_token_counter(settings)
+    input_tokens = counter.count_messages(payload["messages"])
+    input_tokens += counter.count_tools(payload.get("tools") or [])
+    logger.info(f"本地 token 计数: {input_tokens}，消息数: {len(payload['messages'])}")
+    return CountTokensResponse(input_tokens=input_tokens)
+
+
+def build_target_payload(body: Dict[str, Any], settings: Settings) -> Dict[str, Any]:
+    """转换消息并基于配置快照构建本次请求独立的目标模型 payload"""
+    model = settings.target_model_config.get("model") or body.get("model")
+    body["model"] = model
+    tools = body.get("tools") or []
+    native_tools = bool(tools) and supports_native_tools(
+        model, settings.native_tool_calling_models
+    )
+
+    # 转换消息格式
+    start = time.perf_counter()
+    with tracer.span(
+        "convert_messages", message_count=len(body.get("messages") or [])
+    ) as span:
+        openai_messages = message_converter.convert_anthropic_to_openai_messages(
+            body, settings, native_tools
+        )
+        span.set("output_messages", len(openai_messages))
+    metrics.stage_duration.observe(time.perf_counter() - start, "convert")
+    # 配置快照在请求间共享，基于快照构建本次请求独立的 payload
+    payload = {
+        **thaw(settings.target_model_config),
+        "model": model,
+        "stream": bool(body.get("stream")),
+        "messages": openai_messages,
+    }
+    if native_tools:
+        payload["tools"] = convert_tools_to_openai(tools)
+        anthropic_choice = body.get("tool_choice")
+        tool_choice = convert_tool_choice_to_openai(anthropic_choice)
+        if tool_choice is not None:
+            payload["tool_choice"] = tool_choice
+        if isinstance(anthropic_choice, dict) and anthropic_choice.get(
+            "disable_parallel_tool_use"
+        ):
+            payload["parallel_tool_calls"] = False
+    return payload
+
+
+def default_tool_selection(
+    all_tools: List[Dict[str, Any]], settings: Settings
+) -> List[Dict[str, Any]]:
+    """工具选择失败时使用的默认工具列表"""
+    # 优先从配置中的默认工具名称过滤可用工具
+    try:
+        default_tool_names = getattr(settings, "default_tools", []) or []
+        if default_tool_names:
+            filtered = [t for t in all_tools if t.get("name") in default_tool_names]
+            if filtered:
+                return filtered[: settings.max_tools_to_select]
+    except Exception as e:
+        # 安全回退，不阻断主流程
+        logger.exception(f"获取默认工具名称失败: {e}")
+    # 若未配置或未匹配到，则截取前N个
+    return all_tools[0 : settings.max_tools_to_select]
+
+
+# 推测执行统计：命中（直接使用推测请求）与未命中（取消后重新发起）次数
+speculation_stats: Dict[str, int] = {"hits": 0, "misses": 0}
+
+
+def should_speculate(
+    target_model: str,
+    recent_msgs: List[Dict[str, Any]],
+    all_tools: List[Dict[str, Any]],
+    settings: Settings,
+) -> bool:
+    """是否推测执行：仅在需要调用工具选择模型且结果缓存未命中时"""
+    if not settings.enable_speculative_execution:
+        return False
+    if settings.tool_selection_mode.lower() == "local":
+        return False
+    if settings.tool_selection_cache_enabled:
+        model = settings.tool_selection_model_config.get("model") or target_model
+        cache_key = tool_selection_cache.make_key(
+            all_tools, model or "", settings.max_tools_to_select, recent_msgs
+        )
+        if tool_selection_cache.peek(cache_key) is not None:
+            return False
+    return True
+
+
+async def cancel_completion(task: "asyncio.Task[Any]") -> None:
+    """取消推测发出的主请求：未完成时取消任务并断开上游连接，已返回的流则关闭"""
+    if not task.done():
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await task
+        return
+    if task.cancelled() or task.exception() is not None:
+        return
+    close = getattr(task.result(), "close", None)
+    if close is not None:
+        with contextlib.suppress(Exception):
+            await close()
+
+
+async def speculative_select_and_start(
+    body: Dict[str, Any],
+    recent_msgs: List[Dict[str, Any]],
+    all_tools: List[Dict[str, Any]],
+    settings: Settings,
+) -> Tuple[Dict[str, Any], "asyncio.Task[Any]"]:
+    """推测执行：工具选择与使用默认工具的主请求并行进行
+
+    选择结果与默认工具一致时直接使用已发出的主请求，否则取消后按选择
+    结果重新发起。返回 (payload, 主请求任务)，所选工具写入 body。
+    """
+    url = settings.target_base_url
+    key = settings.target_api_key
+    selection = asyncio.create_task(
+        select_tools(body.get("model", ""), recent_msgs, all_tools, settings)
+    )
+    # 让工具选择请求先发出，等待期间转换消息并发出推测请求
+    await asyncio.sleep(0)
+
+    speculative_tools = default_tool_selection(all_tools, settings)
+    spec_body = {**body, "tools": speculative_tools}
+    try:
+        spec_payload = build_target_payload(spec_body, settings)
+    except BaseException:
+        selection.cancel()
+        raise
+    spec_task = asyncio.create_task(
+        openai_client.create_completion(url, key, spec_payload)
+    )
+
+    try:
+        selected_tools = await selection
+    except BaseException:
+        await cancel_completion(spec_task)
+        raise
+    body["tools"] = selected_tools
+
+    selected_names = {t.get("name") for t in selected_tools}
+    if selected_names == {t.get("name") for t in speculative_tools}:
+        speculation_stats["hits"] += 1
+        body["model"] = spec_body["model"]
+        logger.info("推测执行命中，使用已发出的主请求")
+        return spec_payload, spec_task
+
+    speculation_stats["misses"] += 1
+    logger.info("推测执行未命中，取消推测请求并按选择结果重新发起")
+    await cancel_completion(spec_task)
+    payload = build_target_payload(body, settings)
+    return payload, asyncio.create_task(
+        openai_client.create_completion(url, key, payload)
+    )
+
+
+class ToolSelectionConfigError(ValueError):
+    """工具选择配置错误（不回退到默认工具）"""
 
 
 async def select_tools(
     target_model: str,
     recent_msgs: List[Dict[str, Any]],
     all_tools: List[Dict[str, Any]],
+    settings: Optional[Settings] = None,
 ) -> List[Dict[str, Any]]:
     if not all_tools:
         return []
-    # 重新加载配置
-    config_manager.reload()
-    settings = config_manager.settings
+    settings = settings or config_manager.settings
+    mode = settings.tool_selection_mode.lower()
 
+    with tracer.span("select_tools", mode=mode, tool_count=len(all_tools)) as span:
+        try:
+            if mode == "local":
+                # 本地排序选择，无需调用工具选择模型
+                selected_names = local_tool_selector.select(
+                    recent_msgs,
+                    all_tools,
+                    settings.max_tools_to_select,
+                    settings.default_tools,
+                )
+                logger.info(f"本地工具选择结果: {selected_names}")
+            else:
+                selected_names = await select_tool_names_cached(
+                    target_model, recent_msgs, all_tools, settings
+                )
+
+            # 过滤出选择的工具
+            logger.debug(f"所有可用工具: {all_tools}")
+            selected_tools = [t for t in all_tools if t["name"] in selected_names]
+
+            # 确保Read工具被包含
+            read_tool = next((t for t in all_tools if t["name"] == "Read"), None)
+            if read_tool and read_tool not in selected_tools:
+                selected_tools.append(read_tool)
+                logger.info("补充Read工具到选择列表")
+
+            logger.info(
+                f"从 {len(all_tools)} 个工具中选择了 {len(selected_tools)} 个工具"
+            )
+            span.set("selected", len(selected_tools))
+            return selected_tools
+        except ToolSelectionConfigError:
+            raise
+        except Exception as e:
+            logger.warning(f"选择工具失败: {e}。 使用默认工具列表。")
+            span.record_error(e)
+            return default_tool_selection(all_tools, settings)
+
+
+async def select_tool_names_cached(
+    target_model: str,
+    recent_msgs: List[Dict[str, Any]],
+    all_tools: List[Dict[str, Any]],
+    settings: Settings,
+) -> List[str]:
+    """带结果缓存的模型工具选择，仅缓存成功的选择结果"""
+    if not settings.tool_selection_cache_enabled:
+        return await select_tool_names_with_llm(
+            target_model, recent_msgs, all_tools, settings
+        )
+
+    tool_selection_cache.configure(
+        settings.tool_selection_cache_size, settings.tool_selection_cache_ttl
+    )
+    model = settings.tool_selection_model_config.get("model") or target_model
+    cache_key = tool_selection_cache.make_key(
+        all_tools, model or "", settings.max_tools_to_select, recent_msgs
+    )
+    cached = tool_selection_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"工具选择命中缓存: {cached}")
+        return cached
+
+    selected_names = await select_tool_names_with_llm(
+        target_model, recent_msgs, all_tools, settings
+    )
+    tool_selection_cache.put(cache_key, selected_names)
+    return selected_names
+
+
+async def select_tool_names_with_llm(
+    target_model: str,
+    recent_msgs: List[Dict[str, Any]],
+    all_tools: List[Dict[str, Any]],
+    settings: Settings,
+) -> List[str]:
+    """调用工具选择模型，返回所选工具名称列表"""
     # 构建待选择工具列表
     tools_list = "\n".join(
         f"{{{t['name']}: '{t['description'][0:100]}...'}}," for t in all_tools
@@ -176,7 +777,9 @@ async def select_tools(
 
     # 构建最近消息列表
     out_recent_msgs = message_converter.convert_messages(
-        recent_msgs, settings.tool_selection_model_config.get("model", "")
+        recent_msgs,
+        settings.tool_selection_model_config.get("model", ""),
+        use_cache=False,
     )
 
     # 格式化提示词
@@ -185,59 +788,31 @@ async def select_tools(
         tools_list=tools_list,
     )
     logger.debug(f"工具选择提示词: {tool_selection_prompt}")
-    payload = settings.tool_selection_model_config
-    payload["model"] = payload.get("model") if payload.get("model") else target_model
-    payload["messages"] = [
-        {"role": "user", "content": tool_selection_prompt}
-    ] + out_recent_msgs
-    payload["stream"] = False
-    if not payload["model"]:
-        raise ValueError("工具选择模型未配置")
-
-    try:
-        url = settings.tool_selection_base_url
-        key = settings.tool_selection_api_key
-        # 记录实际调用目标
-        logger.info(
-            f"请求地址：{url}，"
-            f"模型：{settings.tool_selection_model_config['model']}"
-        )
-        logger.debug(f"工具选择请求消息: {payload['messages']}")
-        completion = await tool_selection_client.create_completion(url, key, payload)
-        response_content = completion.choices[0].message.content.strip()
-        logger.info(f"工具选择模型响应: {response_content}")
-
-        # 解析选择结果
-        selected_names = json.loads(response_content)
-        if not isinstance(selected_names, list):
-            raise ValueError("选择结果不是列表")
-
-        # 过滤出选择的工具
-        logger.debug(f"所有可用工具: {all_tools}")
-        selected_tools = [t for t in all_tools if t["name"] in selected_names]
-
-        # 确保Read工具被包含
-        read_tool = next((t for t in all_tools if t["name"] == "Read"), None)
-        if read_tool and read_tool not in selected_tools:
-            selected_tools.append(read_tool)
-            logger.info("补充Read工具到选择列表")
-
-        logger.info(f"从 {len(all_tools)} 个工具中选择了 {len(selected_tools)} 个工具")
-        return selected_tools
-    except Exception as e:
-        logger.warning(f"选择工具失败: {e}。 使用默认工具列表。")
-        # 优先从配置中的默认工具名称过滤可用工具
-        try:
-            default_tool_names = getattr(settings, "default_tools", []) or []
-            if default_tool_names:
-                filtered = [t for t in all_tools if t.get("name") in default_tool_names]
-                if filtered:
-                    return filtered[: settings.max_tools_to_select]
-        except Exception as e:
-            # 安全回退，不阻断主流程
-            logger.exception(f"获取默认工具名称失败: {e}")
-        # 若未配置或未匹配到，则截取前N个
-        return all_tools[0 : settings.max_tools_to_select]
+    model = settings.tool_selection_model_config.get("model") or target_model
+    if not model:
+        raise ToolSelectionConfigError("工具选择模型未配置")
+    payload = {
+        **thaw(settings.tool_selection_model_config),
+        "model": model,
+        "messages": [{"role": "user", "content": tool_selection_prompt}]
+        + out_recent_msgs,
+        "stream": False,
+    }
+
+    url = settings.tool_selection_base_url
+    key = settings.tool_selection_api_key
+    # 记录实际调用目标
+    logger.info(f"请求地址：{url}，模型：{model}")
+    logger.debug(f"工具选择请求消息: {payload['messages']}")
+    completion = await tool_selection_client.create_completion(url, key, payload)
+    response_content = completion.choices[0].message.content.strip()
+    logger.info(f"工具选择模型响应: {response_content}")
+
+    # 解析选择结果
+    selected_names = json.loads(response_content)
+    if not isinstance(selected_names, list):
+        raise ValueError("选择结果不是列表")
+    return selected_names
 
 
 def create_app() -> FastAPI:
@@ -3,14 +3,20 @@
 支持从配置文件和环境变量读取配置
 """
 
+import asyncio
 import json
 import logging
+import os
+import time
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
 
 import yaml
-from pydantic import Field
-from pydantic_settings import BaseSettings
+from pydantic import Field, ValidationError
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from . import metrics
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -19,7 +25,13 @@ logger = logging.getLogger(__name__)
 
 
 class Settings(BaseSettings):
-    """应用配置类"""
+    """应用配置类
+
+    实例不可变：请求间共享同一个快照，需要修改的字段（如模型参数）
+    应在请求内复制后再写入。
+    """
+
+    model_config = SettingsConfigDict(frozen=True)
 
     # 目标服务配置
     target_base_url: str = Field(
@@ -29,13 +41,185 @@ class Settings(BaseSettings):
     target_api_key_header: str = Field(
         default="Authorization", alias="TARGET_API_KEY_HEADER"
     )
-    target_model_config: dict = Field(default={}, alias="TARGET_MODEL_CONFIG")
+    target_model_config: Mapping[str, Any] = Field(
+        default={}, alias="TARGET_MODEL_CONFIG"
+    )
+
+    # 多后端负载均衡：配置后替代 target_base_url / tool_selection_base_url，
+    # 每个节点形如 {"url": ..., "weight": 1, "api_key": 可选，默认使用对应的 api_key}
+    target_backends: Sequence[Mapping[str, Any]] = Field(
+        default=[], alias="TARGET_BACKENDS"
+    )
+    tool_selection_backends: Sequence[Mapping[str, Any]] = Field(
+        default=[], alias="TOOL_SELECTION_BACKENDS"
+    )
+    # 负载均衡策略：least_outstanding（最少进行中请求）、ewma（EWMA 延迟加权）
+    # 或 prefix_affinity（按消息前缀一致性哈希，复用后端的 KV/前缀缓存）
+    load_balancing_strategy: str = Field(
+        default="least_outstanding", alias="LOAD_BALANCING_STRATEGY"
+    )
+    # 被动健康检查：连续失败次数达到阈值后剔除节点，剔除时长（秒）
+    backend_max_failures: int = Field(default=3, alias="BACKEND_MAX_FAILURES")
+    backend_ejection_time: float = Field(default=30.0, alias="BACKEND_EJECTION_TIME")
+    # 前缀亲和：参与哈希的用户消息条数，以及单个节点负载上限（平均负载的倍数）
+    prefix_affinity_turns: int = Field(default=1, alias="PREFIX_AFFINITY_TURNS")
+    prefix_affinity_load_factor: float = Field(
+        default=1.25, alias="PREFIX_AFFINITY_LOAD_FACTOR"
+    )
+
+    # 准入控制：目标模型与工具选择模型各自的并发上限（0 表示不限制），
+    # 单个后端节点的上限在节点配置的 max_concurrency 中设置；
+    # 超限的请求最多排队 admission_queue_size 个、等待 admission_queue_timeout 秒，
+    # 否则立即返回 529 overloaded_error
+    target_max_concurrency: int = Field(default=0, alias="TARGET_MAX_CONCURRENCY")
+    tool_selection_max_concurrency: int = Field(
+        default=0, alias="TOOL_SELECTION_MAX_CONCURRENCY"
+    )
+    admission_queue_size: int = Field(default=100, alias="ADMISSION_QUEUE_SIZE")
+    admission_queue_timeout: float = Field(
+        default=30.0, alias="ADMISSION_QUEUE_TIMEOUT"
+    )
+    # 等待队列的优先级与公平调度：请求按规则（首个匹配生效）归入优先级类别，
+    # 规则可匹配 route（target / tool_selection）、stream 与 caller（通配符），
+    # 未匹配时归入 default；各类别按权重分配名额，同一类别内各调用方公平排队
+    priority_classes: Mapping[str, float] = Field(
+        default={
+            "tool_selection": 4.0,
+            "interactive": 4.0,
+            "default": 2.0,
+            "bulk": 1.0,
+        },
+        alias="PRIORITY_CLASSES",
+    )
+    priority_rules: Sequence[Mapping[str, Any]] = Field(
+        default=[
+            {"route": "tool_selection", "class": "tool_selection"},
+            {"stream": True, "class": "interactive"},
+            {"stream": False, "class": "bulk"},
+        ],
+        alias="PRIORITY_RULES",
+    )
+    # 调用方标识：优先使用请求体的 metadata.user_id，否则使用该请求头（密钥类请求头取哈希）
+    caller_id_header: str = Field(default="x-api-key", alias="CALLER_ID_HEADER")
+
+    # 上游连接池配置（目标模型与工具选择模型共用）
+    upstream_max_connections: int = Field(default=100, alias="UPSTREAM_MAX_CONNECTIONS")
+    upstream_max_keepalive_connections: int = Field(
+        default=20, alias="UPSTREAM_MAX_KEEPALIVE_CONNECTIONS"
+    )
+    upstream_keepalive_expiry: float = Field(
+        default=60.0, alias="UPSTREAM_KEEPALIVE_EXPIRY"
+    )
+    upstream_http2: bool = Field(default=False, alias="UPSTREAM_HTTP2")
+
+    # 上游请求时限（秒，0 表示不限制）：连接、流式首个分块与单次尝试总时长
+    upstream_connect_timeout: float = Field(
+        default=10.0, alias="UPSTREAM_CONNECT_TIMEOUT"
+    )
+    upstream_first_byte_timeout: float = Field(
+        default=120.0, alias="UPSTREAM_FIRST_BYTE_TIMEOUT"
+    )
+    upstream_total_timeout: float = Field(default=600.0, alias="UPSTREAM_TOTAL_TIMEOUT")
+    # 重试：连接错误、超时、429 与 5xx 在返回任何数据之前按指数退避（全抖动）重试
+    upstream_max_retries: int = Field(default=2, alias="UPSTREAM_MAX_RETRIES")
+    upstream_retry_backoff: float = Field(default=0.5, alias="UPSTREAM_RETRY_BACKOFF")
+    upstream_retry_backoff_max: float = Field(
+        default=8.0, alias="UPSTREAM_RETRY_BACKOFF_MAX"
+    )
+    # 对冲请求：配置多个后端时，超过近期 p95 首字节延迟（不低于最小延迟）仍未响应，
+    # 则向另一个节点再发一次请求，先返回者胜出
+    upstream_hedging_enabled: bool = Field(
+        default=False, alias="UPSTREAM_HEDGING_ENABLED"
+    )
+    upstream_hedge_min_delay: float = Field(
+        default=1.0, alias="UPSTREAM_HEDGE_MIN_DELAY"
+    )
+
+    # 熔断：每个后端地址独立统计最近 circuit_window 次请求，样本数达到
+    # circuit_min_requests 且错误率或慢请求（首字节超过 circuit_slow_threshold 秒，
+    # 0 表示不统计）比例超过阈值时打开，circuit_open_time 秒后半开探测
+    circuit_breaker_enabled: bool = Field(
+        default=False, alias="CIRCUIT_BREAKER_ENABLED"
+    )
+    circuit_window: int = Field(default=20, alias="CIRCUIT_WINDOW")
+    circuit_min_requests: int = Field(default=10, alias="CIRCUIT_MIN_REQUESTS")
+    circuit_error_rate: float = Field(default=0.5, alias="CIRCUIT_ERROR_RATE")
+    circuit_slow_threshold: float = Field(default=0.0, alias="CIRCUIT_SLOW_THRESHOLD")
+    circuit_slow_rate: float = Field(default=0.5, alias="CIRCUIT_SLOW_RATE")
+    circuit_open_time: float = Field(default=30.0, alias="CIRCUIT_OPEN_TIME")
+    circuit_half_open_probes: int = Field(default=1, alias="CIRCUIT_HALF_OPEN_PROBES")
+    # 熔断降级目标：{"base_url": ..., "api_key": 可选, "model": 可选}，为空时
+    # 目标模型请求立即返回 529，工具选择直接使用默认工具
+    target_fallback: Mapping[str, Any] = Field(default={}, alias="TARGET_FALLBACK")
+    tool_selection_fallback: Mapping[str, Any] = Field(
+        default={}, alias="TOOL_SELECTION_FALLBACK"
+    )
+
+    # 响应缓存：仅缓存确定性请求（temperature 为 0 或指定了 seed）的非流式响应
+    response_cache_enabled: bool = Field(default=False, alias="RESPONSE_CACHE_ENABLED")
+    response_cache_size: int = Field(default=256, alias="RESPONSE_CACHE_SIZE")
+    response_cache_ttl: float = Field(default=3600.0, alias="RESPONSE_CACHE_TTL")
+    # 磁盘缓存的 SQLite 文件路径，为空时只使用内存缓存
+    response_cache_db: str = Field(default="", alias="RESPONSE_CACHE_DB")
+
+    # 请求合并：并发的相同上游请求（含工具选择请求）共享一次上游调用，
+    # 流式响应分发给各订阅者，每个订阅者最多缓冲 request_coalescing_buffer 个分块
+    request_coalescing_enabled: bool = Field(
+        default=False, alias="REQUEST_COALESCING_ENABLED"
+    )
+    request_coalescing_buffer: int = Field(
+        default=256, alias="REQUEST_COALESCING_BUFFER"
+    )
 
     # 服务配置
     host: str = Field(default="127.0.0.1", alias="HOST")
     port: int = Field(default=8000, alias="PORT")
     debug: bool = Field(default=False, alias="DEBUG")
     log_level: str = Field(default="INFO", alias="LOG_LEVEL")
+    # 配置文件热重载：轮询间隔（秒，<=0 关闭）与变更稳定等待时间（秒）
+    config_watch_interval: float = Field(default=1.0, alias="CONFIG_WATCH_INTERVAL")
+    config_reload_debounce: float = Field(default=0.5, alias="CONFIG_RELOAD_DEBOUNCE")
+    # 请求 ID：从该请求头读取（缺失时生成），回写到响应头并转发给上游
+    request_id_header: str = Field(default="x-request-id", alias="REQUEST_ID_HEADER")
+    # 请求级追踪：耗时达到阈值（秒）的追踪保存到内存环形缓冲区（/traces 查询），
+    # 配置 tracing_file 时同时追加写入 JSONL 文件
+    tracing_enabled: bool = Field(default=False, alias="TRACING_ENABLED")
+    tracing_slow_threshold: float = Field(default=0.0, alias="TRACING_SLOW_THRESHOLD")
+    tracing_buffer_size: int = Field(default=200, alias="TRACING_BUFFER_SIZE")
+    tracing_file: str = Field(default="", alias="TRACING_FILE")
+
+    # 对话历史压缩：按模型名称前缀配置输入 token 预算（"*" 为默认值，未配置时不压缩），
+    # 超出预算时截断最近 N 轮之前的过长工具结果，仍超出时删除最早的对话轮次
+    history_token_budgets: Mapping[str, int] = Field(
+        default={}, alias="HISTORY_TOKEN_BUDGETS"
+    )
+    history_keep_recent_turns: int = Field(default=4, alias="HISTORY_KEEP_RECENT_TURNS")
+    history_tool_result_max_chars: int = Field(
+        default=2000, alias="HISTORY_TOOL_RESULT_MAX_CHARS"
+    )
+
+    # 会话消息转换缓存：复用上一轮已转换的历史消息，容量为最多缓存的会话数，
+    # 并限制所有会话缓存的消息总条数（0 不限制）
+    conversion_cache_enabled: bool = Field(
+        default=True, alias="CONVERSION_CACHE_ENABLED"
+    )
+    conversion_cache_size: int = Field(default=64, alias="CONVERSION_CACHE_SIZE")
+    conversion_cache_max_messages: int = Field(
+        default=20000, alias="CONVERSION_CACHE_MAX_MESSAGES"
+    )
+
+    # 本地 token 计数（count_tokens 端点）：heuristic（启发式估算）或 bpe（本地词表文件）
+    tokenizer: str = Field(default="heuristic", alias="TOKENIZER")
+    # tiktoken 格式的 BPE 词表文件（每行 "<base64 token> <rank>"）
+    tokenizer_file: str = Field(default="", alias="TOKENIZER_FILE")
+    # 启发式估算的校准参数：非中日韩文本每个 token 的平均字符数、中日韩字符的 token 数
+    tokenizer_chars_per_token: float = Field(
+        default=4.0, alias="TOKENIZER_CHARS_PER_TOKEN"
+    )
+    tokenizer_cjk_tokens_per_char: float = Field(
+        default=1.0, alias="TOKENIZER_CJK_TOKENS_PER_CHAR"
+    )
+    token_count_cache_size: int = Field(default=4096, alias="TOKEN_COUNT_CACHE_SIZE")
 
     # 系统提示词相关配置
     enable_raw_system_prompt: bool = Field(
@@ -50,15 +234,17 @@ class Settings(BaseSettings):
 
     # 工具配置
     enable_tool_selection: bool = Field(default=False, alias="ENABLE_TOOL_SELECTION")
+    # 工具选择方式：llm（调用工具选择模型）或 local（本地 BM25 排序，无需调用模型）
+    tool_selection_mode: str = Field(default="llm", alias="TOOL_SELECTION_MODE")
     tool_selection_base_url: str = Field(
         default="http://127.0.0.1:1234", alias="TOOL_SELECTION_BASE_URL"
     )
     tool_selection_api_key: str = Field(default="key", alias="TOOL_SELECTION_API_KEY")
-    tool_selection_model_config: dict = Field(
+    tool_selection_model_config: Mapping[str, Any] = Field(
         default={}, alias="TOOL_SELECTION_MODEL_CONFIG"
     )
     # 当工具选择失败或未启用时的默认工具名称列表
-    default_tools: List[str] = Field(
+    default_tools: Sequence[str] = Field(
         default=["Read", "Edit", "Grep"], alias="DEFAULT_TOOLS"
     )
     tool_selection_prompt: str = Field(
@@ -76,6 +262,25 @@ Available tools: [
     )
     recent_messages_count: int = Field(default=5, alias="RECENT_MESSAGES_COUNT")
     max_tools_to_select: int = Field(default=3, alias="MAX_TOOLS_TO_SELECT")
+    # 推测执行：工具选择期间先用默认工具发出主请求，选择结果一致时直接使用
+    enable_speculative_execution: bool = Field(
+        default=False, alias="ENABLE_SPECULATIVE_EXECUTION"
+    )
+    # 工具选择结果缓存：相同工具集、模型与最近消息时跳过工具选择模型调用
+    tool_selection_cache_enabled: bool = Field(
+        default=True, alias="TOOL_SELECTION_CACHE_ENABLED"
+    )
+    tool_selection_cache_size: int = Field(
+        default=256, alias="TOOL_SELECTION_CACHE_SIZE"
+    )
+    tool_selection_cache_ttl: float = Field(
+        default=300.0, alias="TOOL_SELECTION_CACHE_TTL"
+    )
+    # 原生函数调用：目标模型名称匹配其中任一前缀（"*" 匹配所有模型）时，
+    # 工具定义以 OpenAI tools 字段发送，不再拼接 tool_use_prompt
+    native_tool_calling_models: Sequence[str] = Field(
+        default=[], alias="NATIVE_TOOL_CALLING_MODELS"
+    )
     tool_use_prompt: str = Field(
         default="""
 You have access to the following tools.
@@ -101,12 +306,44 @@ Use the tools to help complete the user's request.""",
     logger.info("环境配置加载完成")
 
 
+# 配置文件签名：(inode, mtime_ns, size)
+FileSignature = Tuple[int, int, int]
+
+
+def freeze(value: Any) -> Any:
+    """递归转换为只读结构：字典为 MappingProxyType，列表为元组"""
+    if isinstance(value, Mapping):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value: Any) -> Any:
+    """freeze 的逆操作：复制为普通的字典与列表，用于构建请求 payload"""
+    if isinstance(value, Mapping):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(v) for v in value]
+    return value
+
+
 class ConfigManager:
-    """配置管理器"""
+    """配置管理器
+
+    持有当前配置快照，仅在配置文件发生变更时重新解析并整体替换，
+    请求路径上直接读取 ``settings`` 即可，无需每次重新加载。
+    """
 
     def __init__(self, config_file: Optional[str] = None):
         self.config_file = config_file or self._find_config_file()
-        self.settings = self._load_settings()
+        self._signature: Optional[FileSignature] = None
+        self._pending: Optional[Tuple[Optional[FileSignature], float]] = None
+        try:
+            self.settings = self._load_settings()
+        except ValidationError as e:
+            logger.error(f"配置文件校验失败，使用默认配置: {e}")
+            self.settings = self._freeze(Settings())
 
     def _find_config_file(self) -> Optional[str]:
         """查找配置文件"""
@@ -125,20 +362,50 @@ class ConfigManager:
         logger.warning("没有找到配置文件，使用默认配置")
         return None
 
+    def _file_signature(self) -> Optional[FileSignature]:
+        """获取配置文件签名，文件不存在时返回None"""
+        if not self.config_file:
+            return None
+        try:
+            st = os.stat(self.config_file)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
     def _load_settings(self) -> Settings:
         """加载配置"""
+        # 先记录签名再读取，避免读取期间的修改被遗漏
+        self._signature = self._file_signature()
         settings = Settings()
 
         if self.config_file:
             config_data = self._load_config_file()
             if config_data:
-                # 更新设置
-                for key, value in config_data.items():
-                    if hasattr(settings, key):
-                        setattr(settings, key, value)
+                # 更新设置（配置文件优先于环境变量）
+                # 按别名合并后重新校验，类型错误的配置项直接报错
+                overrides = {
+                    field.alias or key: config_data[key]
+                    for key, field in Settings.model_fields.items()
+                    if key in config_data
+                }
+                settings = Settings.model_validate(
+                    {**settings.model_dump(by_alias=True), **overrides}
+                )
+
+        settings = self._freeze(settings)
         logger.info(f"配置加载完成: {self.config_file or '默认配置'}")
         return settings
 
+    @staticmethod
+    def _freeze(settings: Settings) -> Settings:
+        """字典与列表类配置（含嵌套）转换为只读结构，防止共享快照被请求修改"""
+        readonly = {
+            key: freeze(value)
+            for key, value in settings
+            if isinstance(value, (Mapping, list, tuple))
+        }
+        return settings.model_copy(update=readonly)
+
     def _load_config_file(self) -> Dict[str, Any]:
         """从配置文件加载数据"""
         if not self.config_file or not Path(self.config_file).exists():
@@ -160,8 +427,46 @@ class ConfigManager:
         return getattr(self.settings, key, default)
 
     def reload(self) -> None:
-        """重新加载配置"""
-        self.settings = self._load_settings()
+        """强制重新加载配置，新快照构建完成后整体替换"""
+        start = time.perf_counter()
+        try:
+            self.settings = self._load_settings()
+        except ValidationError as e:
+            logger.error(f"配置文件校验失败，保留当前配置: {e}")
+        metrics.stage_duration.observe(time.perf_counter() - start, "config_reload")
+
+    def check_for_changes(self) -> bool:
+        """检查配置文件是否变更
+
+        变更后需保持稳定 ``config_reload_debounce`` 秒才会重新加载，
+        避免编辑器分多次写入时加载到不完整的文件。返回是否发生了重载。
+        """
+        signature = self._file_signature()
+        if signature == self._signature:
+            self._pending = None
+            return False
+
+        now = time.monotonic()
+        if self._pending is None or self._pending[0] != signature:
+            self._pending = (signature, now)
+            return False
+        if now - self._pending[1] < self.settings.config_reload_debounce:
+            return False
+
+        self._pending = None
+        logger.info(f"检测到配置文件变更，重新加载: {self.config_file}")
+        self.reload()
+        return True
+
+    async def watch(self) -> None:
+        """后台轮询配置文件变更，直到任务被取消"""
+        while True:
+            interval = self.settings.config_watch_interval
+            await asyncio.sleep(interval if interval > 0 else 1.0)
+            try:
+                self.check_for_changes()
+            except Exception as e:
+                logger.exception(f"检查配置文件变更失败: {e}")
 
 
 # 全局配置实例
@@ -0,0 +1,373 @@
+"""
+进程内指标模块
+无第三方依赖的计数器、仪表与直方图，以 Prometheus 文本格式在 /metrics 导出。
+记录时只做字典查找与加法，已有的统计信息通过采集回调在抓取时读取。
+"""
+
+import math
+import time
+from bisect import bisect_left
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+Labels = Tuple[str, ...]
+# 采集回调返回的指标族：(名称, 类型, 说明, [(标签, 值)])
+Family = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+# 延迟直方图的默认分桶（秒）
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs: Iterable[Tuple[str, str]]) -> str:
+    body = ",".join(f'{k}="{_escape(str(v))}"' for k, v in pairs)
+    return "{" + body + "}" if body else ""
+
+
+class _Metric:
+    """指标基类：按标签值元组保存数据"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, Any] = {}
+
+    def _check(self, labels: Labels) -> None:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(
+                f"metric {self.name} expects labels {self.labelnames}, got {labels}"
+            )
+
+    def clear(self) -> None:
+        self._values.clear()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in sorted(self._values.items()):
+            pairs = zip(self.labelnames, labels)
+            lines.append(f"{self.name}{_format_labels(pairs)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """单调递增的计数器"""
+
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        values = self._values
+        if labels not in values:
+            self._check(labels)
+            values[labels] = 0.0
+        values[labels] += amount
+
+    def value(self, *labels: str) -> float:
+        return float(self._values.get(labels, 0.0))
+
+
+class Gauge(_Metric):
+    """可增可减的仪表"""
+
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        if labels not in self._values:
+            self._check(labels)
+        self._values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        values = self._values
+        if labels not in values:
+            self._check(labels)
+            values[labels] = 0.0
+        values[labels] += amount
+
+    def dec(self, *labels: str, amount: float = 1.0) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def value(self, *labels: str) -> float:
+        return float(self._values.get(labels, 0.0))
+
+
+class Histogram(_Metric):
+    """直方图：各分桶独立计数，导出时再累加为 Prometheus 的累计分桶"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str) -> None:
+        data = self._values.get(labels)
+        if data is None:
+            self._check(labels)
+            # [各分桶计数..., +Inf 分桶计数, 总和]
+            data = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        data[bisect_left(self.buckets, value)] += 1
+        data[-1] += value
+
+    def count(self, *labels: str) -> int:
+        data = self._values.get(labels)
+        return sum(data[:-1]) if data is not None else 0
+
+    def sum(self, *labels: str) -> float:
+        data = self._values.get(labels)
+        return float(data[-1]) if data is not None else 0.0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        bounds = [_format_value(b) for b in self.buckets] + ["+Inf"]
+        for labels, data in sorted(self._values.items()):
+            pairs = list(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, n in zip(bounds, data[:-1]):
+                cumulative += n
+                le = _format_labels(pairs + [("le", bound)])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            suffix = _format_labels(pairs)
+            lines.append(f"{self.name}_sum{suffix} {_format_value(data[-1])}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+class LabelSet:
+    """有界的标签取值集合
+
+    记录最先出现的 maxsize 个取值，之后的新取值统一归为 other。用于来自
+    客户端请求的标签（如未配置目标模型时的模型名），防止时间序列无限增长。
+    """
+
+    def __init__(self, maxsize: int, other: str = "other") -> None:
+        self.maxsize = maxsize
+        self.other = other
+        self._values: Set[str] = set()
+
+    def __call__(self, value: Optional[str]) -> str:
+        if not value:
+            return "unknown"
+        if value in self._values:
+            return value
+        if len(self._values) >= self.maxsize:
+            return self.other
+        self._values.add(value)
+        return value
+
+    def clear(self) -> None:
+        self._values.clear()
+
+
+M = TypeVar("M", bound=_Metric)
+
+
+class MetricsRegistry:
+    """指标注册表：持有直接记录的指标与抓取时调用的采集回调"""
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], Iterable[Family]]] = []
+
+    def _register(self, metric: M) -> M:
+        if metric.name in self._metrics:
+            raise ValueError(f"metric already registered: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def collector(
+        self, callback: Callable[[], Iterable[Family]]
+    ) -> Callable[[], Iterable[Family]]:
+        """注册采集回调（可作为装饰器使用），抓取时读取已有的统计信息"""
+        self._collectors.append(callback)
+        return callback
+
+    def get(self, name: str) -> _Metric:
+        return self._metrics[name]
+
+    def clear(self) -> None:
+        """清空所有已记录的数据（测试用）"""
+        for metric in self._metrics.values():
+            metric.clear()
+
+    def render(self) -> str:
+        """按 Prometheus 文本格式（0.0.4）导出全部指标"""
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        for callback in self._collectors:
+            for name, kind, help, samples in callback():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    pairs = labels.items()
+                    lines.append(
+                        f"{name}{_format_labels(pairs)} {_format_value(value)}"
+                    )
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """ASGI 中间件：统计指定路径的进行中请求数、响应状态码与端到端耗时
+
+    流式响应在最后一个分块发送完毕后才计为结束。
+    """
+
+    def __init__(self, app: Any, paths: Sequence[str]) -> None:
+        self.app = app
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope: Any, receive: Any, send: Any) -> None:
+        path = scope.get("path")
+        if scope["type"] != "http" or path not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        status = "500"
+
+        async def send_wrapper(message: Any) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        requests_in_flight.inc(path)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            requests_in_flight.dec(path)
+            requests_total.inc(path, status)
+            request_duration.observe(time.perf_counter() - start, path)
+
+
+# 全局指标注册表
+registry = MetricsRegistry()
+
+requests_in_flight = registry.gauge(
+    "adapter_requests_in_flight", "Requests currently being handled", ("path",)
+)
+requests_total = registry.counter(
+    "adapter_requests_total", "Handled requests by response status", ("path", "status")
+)
+request_duration = registry.histogram(
+    "adapter_request_duration_seconds",
+    "End-to-end request duration including streaming",
+    ("path",),
+)
+# 请求处理各阶段：config_reload、tool_selection、convert、upstream、
+# process_response、serialize
+stage_duration = registry.histogram(
+    "adapter_stage_duration_seconds", "Time spent in each processing stage", ("stage",)
+)
+# phase 为 first_byte（流式首个分块）或 total（完整响应 / 流结束）
+upstream_duration = registry.histogram(
+    "adapter_upstream_duration_seconds",
+    "Upstream attempt latency by route and phase",
+    ("route", "phase"),
+)
+upstream_responses = registry.counter(
+    "adapter_upstream_responses_total",
+    "Upstream attempts by route and status code (timeout / error without a status)",
+    ("route", "status"),
+)
+# 模型标签的取值上限，超出后的模型名记为 other
+MODEL_LABEL_LIMIT = 32
+model_labels = LabelSet(MODEL_LABEL_LIMIT)
+
+tokens_total = registry.counter(
+    "adapter_tokens_total",
+    "Tokens reported in upstream usage by model and type (input / output)",
+    ("model", "type"),
+)
+
+# 流式响应：按后端地址与模型分类，区分适配层与模型服务的耗时
+stream_ttft = registry.histogram(
+    "adapter_stream_ttft_seconds",
+    "Time from request arrival to the first upstream chunk",
+    ("backend", "model"),
+)
+stream_chunk_gap = registry.histogram(
+    "adapter_stream_chunk_gap_seconds",
+    "Gap between consecutive upstream chunks",
+    ("backend", "model"),
+    (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+stream_duration = registry.histogram(
+    "adapter_stream_duration_seconds",
+    "Time from request arrival to the end of the stream",
+    ("backend", "model"),
+)
+stream_tokens_per_second = registry.histogram(
+    "adapter_stream_output_tokens_per_second",
+    "Output tokens per second after the first chunk",
+    ("backend", "model"),
+    (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500),
+)
+stream_disconnects = registry.counter(
+    "adapter_stream_disconnects_total",
+    "Streams abandoned by the client before completion",
+    ("backend", "model"),
+)
@@ -57,8 +57,16 @@ class ChatResponse(BaseModel):
     content: List[ContentBlock]
 
 
+class CountTokensResponse(BaseModel):
+    """token 计数响应模型"""
+
+    input_tokens: int
+
+
 class HealthResponse(BaseModel):
     """健康检查响应模型"""
 
     ok: bool
     target_base: str
+    # 各路由（target / tool_selection）按后端地址的熔断器状态，未启用熔断时为空
+    circuit_breakers: Dict[str, Dict[str, Dict[str, Any]]] = {}
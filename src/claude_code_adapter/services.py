@@ -2,36 +2,273 @@
 服务层模块
 """
 
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import copy
+import fnmatch
+import hashlib
+import heapq
+import importlib.util
 import json
 import logging
+import math
+import random
 import re
-from typing import Any, Dict, List
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    cast,
+)
 
-from openai import AsyncOpenAI
+import httpx
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI
 
-from .config import settings
+from . import metrics
+from .config import Settings, config_manager, thaw
+from .tokenizer import get_token_counter
+from .tracing import current_request_id, tracer
 from .utils import (
+    MESSAGE_TOKEN_OVERHEAD,
+    IncrementalToolCallParser,
+    LRUCache,
     convert_tools_to_prompt,
+    estimate_tokens,
     flatten_content,
+    format_sse,
     get_structured_config,
-    is_multimodal_model,
+    lookup_model_value,
     parse_tool_calls_from_response,
+    payload_fingerprint,
+    prefix_affinity_key,
+    tool_result_text,
+    tools_fingerprint,
 )
 
 logger = logging.getLogger(__name__)
 
+# 当前请求追加在消息末尾的工具提示词消息（启用工具选择时），
+# 其内容随每轮所选工具变化，前缀亲和哈希按对象身份将其排除
+trailing_tool_prompt: contextvars.ContextVar[Optional[Dict[str, Any]]] = (
+    contextvars.ContextVar("trailing_tool_prompt", default=None)
+)
+
+
+class ConversionCache:
+    """会话消息转换缓存
+
+    Claude Code 每轮都会重新发送完整的对话历史。按会话缓存上一轮的原始消息与
+    每条消息转换后的 OpenAI 消息：会话以首条消息（及转换方式）的哈希识别，
+    新请求与上一轮逐条比较（字典相等比较在 C 层完成，远快于重新转换或哈希），
+    相同前缀直接复用，只转换新增或变化的尾部消息。
+    除会话数外还限制所有会话缓存的原始消息总条数，长会话较多时按最久未使用淘汰。
+    缓存的消息在请求间共享，调用方不得原地修改。
+    """
+
+    def __init__(self) -> None:
+        self._cache: LRUCache[
+            str, Tuple[List[Dict[str, Any]], List[List[Dict[str, Any]]]]
+        ] = LRUCache(0)
+
+    @property
+    def enabled(self) -> bool:
+        return self._cache.maxsize > 0
+
+    def configure(self, size: int, max_messages: int = 0) -> None:
+        """按配置调整缓存的会话数（<=0 关闭）与消息总条数上限（<=0 不限制）"""
+        max_messages = max(max_messages, 0)
+        if self._cache.maxsize != size or self._cache.maxweight != max_messages:
+            self._cache = LRUCache(size, maxweight=max_messages, weigher=self._weigh)
+
+    @staticmethod
+    def _weigh(entry: Tuple[List[Dict[str, Any]], List[List[Dict[str, Any]]]]) -> int:
+        return len(entry[0])
+
+    @staticmethod
+    def session_key(
+        structured_cfg: Dict[str, Any], native_tools: bool, first: Dict[str, Any]
+    ) -> str:
+        """会话键：转换方式不同的请求互不复用"""
+        raw = json.dumps(
+            [structured_cfg, native_tools, first],
+            ensure_ascii=False,
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def lookup(
+        self, key: str, msgs: List[Dict[str, Any]]
+    ) -> List[List[Dict[str, Any]]]:
+        """返回与上一轮相同的最长前缀对应的转换结果（每条消息一段）"""
+        cached = self._cache.get(key)
+        if cached is None:
+            return []
+        prev_msgs, prev_segments = cached
+        n = 0
+        limit = min(len(msgs), len(prev_msgs))
+        while n < limit and msgs[n] == prev_msgs[n]:
+            n += 1
+        return prev_segments[:n]
+
+    def store(
+        self,
+        key: str,
+        msgs: List[Dict[str, Any]],
+        segments: List[List[Dict[str, Any]]],
+    ) -> None:
+        self._cache.put(key, (list(msgs), segments))
+
+    def stats(self) -> Dict[str, int]:
+        """返回缓存统计信息"""
+        return self._cache.stats()
+
+
+class HistoryCompactor:
+    """对话历史压缩
+
+    转换后的消息超出目标模型的 token 预算时，按以下顺序压缩最近 N 轮之前的历史：
+    先从最早的消息开始截断过长的 tool_result 内容，仍超出预算时再整轮删除
+    最早的对话（保留首轮，其中通常包含项目上下文）。系统提示词、工具定义与
+    最近 N 轮对话始终保留。压缩结果只由原始消息决定，后续轮次得到相同的
+    截断结果，会话转换缓存与上游前缀缓存仍可复用。
+    """
+
+    TRUNCATION_MARKER = "\n[... truncated {count} characters ...]\n"
+
+    def __init__(self) -> None:
+        self.stats: Dict[str, int] = {"compacted": 0, "tokens_saved": 0}
+
+    @staticmethod
+    def is_turn_start(message: Dict[str, Any]) -> bool:
+        """用户发起的新一轮对话（而非仅回传工具结果）"""
+        if message.get("role") != "user":
+            return False
+        content = message.get("content")
+        if not isinstance(content, list):
+            return True
+        return any(
+            not (isinstance(b, dict) and b.get("type") == "tool_result")
+            for b in content
+        )
+
+    @staticmethod
+    def message_tokens(
+        message: Dict[str, Any], count: Callable[[str], int] = estimate_tokens
+    ) -> int:
+        """估算一条 Anthropic 格式消息的 token 数，文本部分由 count 计数"""
+        content = message.get("content")
+        tokens = MESSAGE_TOKEN_OVERHEAD + count(flatten_content(content))
+        for block in content if isinstance(content, list) else []:
+            if isinstance(block, dict) and block.get("type") == "tool_use":
+                tokens += count(
+                    json.dumps(block.get("input") or {}, ensure_ascii=False)
+                )
+        return tokens
+
+    def _truncate(
+        self, message: Dict[str, Any], max_chars: int, count: Callable[[str], int]
+    ) -> Tuple[Dict[str, Any], int]:
+        """截断消息中过长的 tool_result，返回 (新消息, 减少的 token 数)"""
+        content = message.get("content")
+        if not isinstance(content, list):
+            return message, 0
+        blocks = []
+        saved = 0
+        for block in content:
+            if isinstance(block, dict) and block.get("type") == "tool_result":
+                text = tool_result_text(block)
+                if len(text) > max_chars:
+                    half = max_chars // 2
+                    marker = self.TRUNCATION_MARKER.format(count=len(text) - 2 * half)
+                    short = text[:half] + marker + text[len(text) - half :]
+                    saved += count(text) - count(short)
+                    block = {**block, "content": short}
+            blocks.append(block)
+        if not saved:
+            return message, 0
+        return {**message, "content": blocks}, saved
+
+    def compact(
+        self,
+        msgs: List[Dict[str, Any]],
+        excess: int,
+        keep_turns: int,
+        max_chars: int,
+        count: Callable[[str], int] = estimate_tokens,
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """压缩历史使估算 token 数减少至少 excess，返回 (新消息列表, 估算减少量)
+
+        文本由 count 计数（与 count_tokens 端点使用同一分词器）。
+        不修改传入的消息；无法压缩到预算内时返回尽力压缩后的结果。
+        """
+        turn_starts = [i for i, m in enumerate(msgs) if self.is_turn_start(m)]
+        if len(turn_starts) <= keep_turns:
+            return msgs, 0
+        boundary = turn_starts[-keep_turns] if keep_turns > 0 else len(msgs)
+
+        out = list(msgs)
+        removed = 0
+        for i in range(boundary):
+            if removed >= excess:
+                break
+            out[i], saved = self._truncate(out[i], max_chars, count)
+            removed += saved
+
+        # 仍超出预算时保留首轮，从第二轮开始整轮删除，保持 tool_use 与 tool_result 成对
+        if len(turn_starts) > 1:
+            drop_from = drop_to = turn_starts[1]
+            for start, end in zip(turn_starts[1:], turn_starts[2:] + [len(msgs)]):
+                if removed >= excess or end > boundary:
+                    break
+                removed += sum(self.message_tokens(m, count) for m in out[start:end])
+                drop_to = end
+            out = out[:drop_from] + out[drop_to:]
+        if not removed:
+            return msgs, 0
+        return out, removed
+
 
 class MessageConverter:
     """消息转换服务"""
 
     def __init__(self) -> None:
-        self.tool_use_prompt = settings.tool_use_prompt
+        self.conversion_cache = ConversionCache()
+        self.compactor = HistoryCompactor()
 
     def convert_anthropic_to_openai_messages(
-        self, body: Dict[str, Any]
+        self,
+        body: Dict[str, Any],
+        settings: Optional[Settings] = None,
+        native_tools: bool = False,
     ) -> List[Dict[str, Any]]:
-        """将Anthropic格式消息转换为OpenAI格式"""
+        """将Anthropic格式消息转换为OpenAI格式
+
+        settings 为本次请求使用的配置快照，未传入时使用当前配置。
+        native_tools 为 True 时工具定义由 OpenAI tools 字段传递，不再生成工具提示词，
+        tool_use / tool_result 块转换为 tool_calls 与 tool 消息。
+        """
+        settings = settings or config_manager.settings
         logger.setLevel(settings.log_level)
+        self.conversion_cache.configure(
+            settings.conversion_cache_size if settings.conversion_cache_enabled else 0,
+            settings.conversion_cache_max_messages,
+        )
         out: List[Dict[str, Any]] = []
 
         # 构建系统提示词
@@ -47,8 +284,13 @@ class MessageConverter:
 
         # 处理工具定义
         tools = body.get("tools", [])
-        if tools:
-            tool_prompt = convert_tools_to_prompt(tools, self.tool_use_prompt)
+        tool_prompt = ""
+        if tools and native_tools:
+            logger.info(
+                f"目标模型支持原生函数调用，{len(tools)} 个工具通过 tools 字段传递"
+            )
+        elif tools:
+            tool_prompt = convert_tools_to_prompt(tools, settings.tool_use_prompt)
 
             if settings.enable_tool_selection:
                 # 启用工具选择时，追加到用户消息中
@@ -66,17 +308,65 @@ class MessageConverter:
 
         # 处理对话消息
         msgs = body.get("messages") or []
-        out = self.convert_messages(msgs, body.get("model", ""))
+        model = body.get("model", "")
+        history = self.convert_messages(msgs, model, native_tools)
 
         # 如果启用了工具选择，将工具定义作为用户消息追加
-        if settings.enable_tool_selection:
-            tools = body.get("tools", [])
-            if tools:
-                tool_prompt = convert_tools_to_prompt(tools, self.tool_use_prompt)
-                out.append({"role": "user", "content": tool_prompt})
-        logger.debug(f"转换后的OpenAI消息: {out}")
+        trailing: List[Dict[str, Any]] = []
+        if settings.enable_tool_selection and tool_prompt:
+            trailing.append({"role": "user", "content": tool_prompt})
+        trailing_tool_prompt.set(trailing[0] if trailing else None)
+
+        budget = lookup_model_value(model, settings.history_token_budgets)
+        if budget and msgs:
+            counter = get_token_counter(settings)
+            fixed = counter.count_messages(out + trailing)
+            if native_tools and tools:
+                fixed += counter.count_tools(tools)
+            history = self._compact_history(
+                msgs, history, model, native_tools, int(budget) - fixed, settings
+            )
+
+        out.extend(history)
+        out.extend(trailing)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"转换后的OpenAI消息: {out}")
         return out
 
+    def _compact_history(
+        self,
+        msgs: List[Dict[str, Any]],
+        history: List[Dict[str, Any]],
+        model: str,
+        native_tools: bool,
+        budget: int,
+        settings: Settings,
+    ) -> List[Dict[str, Any]]:
+        """历史超出预算时压缩原始消息并重新转换（未变化的前缀由转换缓存复用）"""
+        counter = get_token_counter(settings)
+        before = counter.count_messages(history)
+        if before <= budget:
+            return history
+        compacted, _ = self.compactor.compact(
+            msgs,
+            before - budget,
+            settings.history_keep_recent_turns,
+            settings.history_tool_result_max_chars,
+            counter.count_text,
+        )
+        if compacted is msgs:
+            logger.warning(f"对话历史约 {before} tokens，超出预算但没有可压缩的历史")
+            return history
+        history = self.convert_messages(compacted, model, native_tools)
+        after = counter.count_messages(history)
+        self.compactor.stats["compacted"] += 1
+        self.compactor.stats["tokens_saved"] += before - after
+        logger.info(
+            f"对话历史压缩：约 {before} → {after} tokens，节省 {before - after} tokens，"
+            f"消息数 {len(msgs)} → {len(compacted)}"
+        )
+        return history
+
     def convert_claude_structured(self, content: Any, cfg: Dict) -> Any:
         """通用转换器：Claude结构 → 目标模型结构（含 image/audio/video）"""
         if content is None:
@@ -161,49 +451,2087 @@ class MessageConverter:
         return str(content)
 
     def convert_messages(
-        self, msgs: List[Dict[str, Any]], model: str
+        self,
+        msgs: List[Dict[str, Any]],
+        model: str,
+        native_tools: bool = False,
+        use_cache: bool = True,
     ) -> List[Dict[str, Any]]:
-        """转换对话消息，处理多模态结构化内容"""
-        out = []
-        if not is_multimodal_model(model):
+        """转换对话消息，处理多模态结构化内容
+
+        已转换过的消息前缀从会话转换缓存中复用，只转换新增的消息。
+        ``use_cache=False`` 用于转换对话片段（如工具选择使用的最近消息）：
+        片段的首条消息每轮都在变化，写入缓存只会挤掉真实会话。
+        """
+        out: List[Dict[str, Any]] = []
+        structured_cfg = get_structured_config(model)
+        if not structured_cfg:
             logger.info("目标模型不支持多模态结构化内容，降级为纯文本处理")
-            for m in msgs:
-                role = m.get("role", "user")
-                content = m.get("content")
-                text = flatten_content(content)
-                if text:
-                    out.append({"role": role, "content": text})
         else:
             logger.info("目标模型支持多模态结构化内容，进行结构化内容转换")
+        if not use_cache or not self.conversion_cache.enabled:
             for m in msgs:
-                role = m.get("role", "user")
-                content = m.get("content")
-                converted_content = self.convert_claude_structured(
-                    content, get_structured_config(model)
-                )
-                out.append({"role": role, "content": converted_content})
+                out.extend(self._convert_message(m, structured_cfg, native_tools))
+            return out
+
+        if not msgs:
+            return out
+        key = self.conversion_cache.session_key(structured_cfg, native_tools, msgs[0])
+        segments = self.conversion_cache.lookup(key, msgs)
+        reused = len(segments)
+        for m in msgs[reused:]:
+            segments.append(self._convert_message(m, structured_cfg, native_tools))
+        self.conversion_cache.store(key, msgs, segments)
+        for segment in segments:
+            out.extend(segment)
+        logger.debug(f"消息转换：共 {len(msgs)} 条，复用 {reused} 条")
         return out
 
+    def _convert_message(
+        self, m: Dict[str, Any], structured_cfg: Dict[str, Any], native_tools: bool
+    ) -> List[Dict[str, Any]]:
+        """转换单条消息，返回对应的 OpenAI 消息（可能为0条或多条）"""
+        out: List[Dict[str, Any]] = []
+        role = m.get("role", "user")
+        content = m.get("content")
+        if native_tools and isinstance(content, list):
+            content = self._extract_tool_blocks(role, content, out)
+            if not content:
+                return out
+        if not structured_cfg:
+            text = flatten_content(content)
+            if text:
+                out.append({"role": role, "content": text})
+        else:
+            converted_content = self.convert_claude_structured(content, structured_cfg)
+            out.append({"role": role, "content": converted_content})
+        return out
+
+    @staticmethod
+    def _extract_tool_blocks(
+        role: str, content: List[Any], out: List[Dict[str, Any]]
+    ) -> List[Any]:
+        """原生函数调用：将 tool_use / tool_result 块转换为 OpenAI 消息
+
+        assistant 的 tool_use 块与文本合并为一条带 tool_calls 的消息；
+        user 的 tool_result 块转换为 tool 消息，按原顺序排在剩余内容之前。
+        返回仍需按普通内容转换的块。
+        """
+        rest = []
+        tool_calls = []
+        for block in content:
+            block_type = block.get("type") if isinstance(block, dict) else None
+            if block_type == "tool_use":
+                tool_calls.append(
+                    {
+                        "id": block.get("id", ""),
+                        "type": "function",
+                        "function": {
+                            "name": block.get("name", ""),
+                            "arguments": json.dumps(
+                                block.get("input") or {}, ensure_ascii=False
+                            ),
+                        },
+                    }
+                )
+            elif block_type == "tool_result":
+                text = tool_result_text(block)
+                if block.get("is_error"):
+                    text = f"Error: {text}"
+                out.append(
+                    {
+                        "role": "tool",
+                        "tool_call_id": block.get("tool_use_id", ""),
+                        "content": text,
+                    }
+                )
+            else:
+                rest.append(block)
+
+        if tool_calls and role == "assistant":
+            out.append(
+                {
+                    "role": "assistant",
+                    "content": flatten_content(rest) or None,
+                    "tool_calls": tool_calls,
+                }
+            )
+            return []
+        return rest
+
+
+# 本地工具选择的分词：驼峰/下划线拆分、数字、单个中日韩字符
+_TERM_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+|[\u4e00-\u9fff]")
+_STOPWORDS = frozenset(
+    "a an and are as at be by can do for from has have if in into is it its "
+    "of on or that the this to use used uses using was when will with you "
+    "your".split()
+)
+
+
+def _stem(term: str) -> str:
+    """极简词干化，合并常见的复数与进行时形式"""
+    if len(term) > 5 and term.endswith("ing"):
+        return term[:-3]
+    if len(term) > 4 and term.endswith(("ches", "shes", "xes", "sses")):
+        return term[:-2]
+    if len(term) > 3 and term.endswith("s") and not term.endswith("ss"):
+        return term[:-1]
+    return term
+
+
+def tokenize(text: str) -> List[str]:
+    """将文本切分为用于检索的词项"""
+    terms = []
+    for raw in _TERM_RE.findall(text):
+        term = raw.lower()
+        if term not in _STOPWORDS:
+            terms.append(_stem(term))
+    return terms
+
+
+class ToolIndex:
+    """工具定义的 BM25 倒排索引，建立时预先计算每个词项在各工具上的权重"""
+
+    # 工具名称中的词项在文档中重复的次数（提高名称匹配的权重）
+    NAME_BOOST = 3
+
+    def __init__(
+        self, tools: List[Dict[str, Any]], k1: float = 1.2, b: float = 0.75
+    ) -> None:
+        self.names = [str(t.get("name", "")) for t in tools]
+        docs: List[Dict[str, int]] = []
+        for tool, name in zip(tools, self.names):
+            terms = tokenize(name) * self.NAME_BOOST + tokenize(
+                str(tool.get("description") or "")
+            )
+            tf: Dict[str, int] = {}
+            for term in terms:
+                tf[term] = tf.get(term, 0) + 1
+            docs.append(tf)
+
+        lengths = [sum(tf.values()) for tf in docs]
+        avg_len = (sum(lengths) / len(lengths)) if lengths else 0.0
+        df: Dict[str, int] = {}
+        for tf in docs:
+            for term in tf:
+                df[term] = df.get(term, 0) + 1
+
+        n = len(docs)
+        self.postings: Dict[str, List[Tuple[int, float]]] = {}
+        for i, tf in enumerate(docs):
+            norm = k1 * (1 - b + b * lengths[i] / avg_len) if avg_len else k1
+            for term, freq in tf.items():
+                idf = math.log(1 + (n - df[term] + 0.5) / (df[term] + 0.5))
+                weight = idf * freq * (k1 + 1) / (freq + norm)
+                self.postings.setdefault(term, []).append((i, weight))
+
+    def score(self, query_terms: Dict[str, float]) -> List[float]:
+        """计算每个工具对查询的得分"""
+        scores = [0.0] * len(self.names)
+        for term, qweight in query_terms.items():
+            for i, weight in self.postings.get(term, ()):
+                scores[i] += qweight * weight
+        return scores
+
+
+class LocalToolSelector:
+    """本地工具选择服务
+
+    基于工具名称与描述的 BM25 索引，对最近消息进行排序选择，
+    无需额外调用模型。索引按工具列表指纹缓存，相同工具集只建立一次。
+    """
+
+    def __init__(self, cache_size: int = 16) -> None:
+        self._indexes: LRUCache[str, ToolIndex] = LRUCache(cache_size)
+
+    def _get_index(self, tools: List[Dict[str, Any]]) -> ToolIndex:
+        fingerprint = tools_fingerprint(tools)
+        index = self._indexes.get(fingerprint)
+        if index is None:
+            index = ToolIndex(tools)
+            self._indexes.put(fingerprint, index)
+        return index
+
+    @staticmethod
+    def _query_terms(recent_msgs: List[Dict[str, Any]]) -> Dict[str, float]:
+        """从最近消息构建查询，越新的消息权重越高，最近使用过的工具名也计入查询"""
+        query: Dict[str, float] = {}
+        total = len(recent_msgs)
+        for pos, msg in enumerate(recent_msgs):
+            content = msg.get("content")
+            parts = [flatten_content(content)]
+            blocks = content if isinstance(content, list) else [content]
+            for block in blocks:
+                if isinstance(block, dict) and block.get("type") == "tool_use":
+                    parts.append(str(block.get("name", "")))
+            weight = (pos + 1) / total
+            for term in tokenize(" ".join(p for p in parts if p)):
+                query[term] = query.get(term, 0.0) + weight
+        # 对词频取对数，避免长消息中的高频词主导排序
+        return {term: math.log1p(w) for term, w in query.items()}
+
+    def rank(
+        self, recent_msgs: List[Dict[str, Any]], tools: List[Dict[str, Any]]
+    ) -> List[Tuple[str, float]]:
+        """按相关性从高到低返回 (工具名, 得分)，仅包含得分大于0的工具"""
+        index = self._get_index(tools)
+        scores = index.score(self._query_terms(recent_msgs))
+        ranked = sorted(
+            ((name, score) for name, score in zip(index.names, scores) if score > 0),
+            key=lambda item: item[1],
+            reverse=True,
+        )
+        return ranked
+
+    def select(
+        self,
+        recent_msgs: List[Dict[str, Any]],
+        tools: List[Dict[str, Any]],
+        max_tools: int,
+        default_names: Optional[Sequence[str]] = None,
+    ) -> List[str]:
+        """选择最相关的工具名称，没有任何匹配时返回默认工具"""
+        ranked = self.rank(recent_msgs, tools)
+        logger.debug(f"本地工具选择排序: {ranked[: max_tools * 2]}")
+        if ranked:
+            return [name for name, _ in ranked[:max_tools]]
+        available = {t.get("name") for t in tools}
+        return [n for n in (default_names or []) if n in available][:max_tools]
+
+
+class ToolSelectionCache:
+    """工具选择结果缓存
+
+    缓存键由工具集指纹、工具选择模型、选择数量与归一化后的最近消息组成，
+    连续轮次或重试请求命中缓存时可直接复用上次的选择结果。
+    缓存容量与过期时间随配置变化时重建缓存。
+    """
+
+    def __init__(self) -> None:
+        self._cache: LRUCache[str, List[str]] = LRUCache(0)
+
+    def configure(self, size: int, ttl: float) -> None:
+        """按配置调整缓存容量与过期时间"""
+        if self._cache.maxsize != size or self._cache.ttl != ttl:
+            self._cache = LRUCache(size, ttl)
+
+    @staticmethod
+    def make_key(
+        tools: List[Dict[str, Any]],
+        model: str,
+        max_tools: int,
+        recent_msgs: List[Dict[str, Any]],
+    ) -> str:
+        """计算缓存键：消息内容按扁平化文本归一化，忽略空白差异"""
+        normalized = []
+        for msg in recent_msgs:
+            content = msg.get("content")
+            text = " ".join(str(flatten_content(content)).split())
+            blocks = content if isinstance(content, list) else [content]
+            used = [
+                str(b.get("name"))
+                for b in blocks
+                if isinstance(b, dict) and b.get("type") == "tool_use"
+            ]
+            normalized.append([msg.get("role", "user"), text, used])
+        raw = json.dumps(
+            [tools_fingerprint(tools), model, max_tools, normalized],
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        cached = self._cache.get(key)
+        return list(cached) if cached is not None else None
+
+    def peek(self, key: str) -> Optional[List[str]]:
+        """查询缓存但不计入命中统计"""
+        cached = self._cache.peek(key)
+        return list(cached) if cached is not None else None
+
+    def put(self, key: str, names: List[str]) -> None:
+        self._cache.put(key, list(names))
+
+    def stats(self) -> Dict[str, int]:
+        """返回缓存统计信息"""
+        return self._cache.stats()
+
+
+class ClientRegistry:
+    """上游客户端注册表
+
+    按 (base_url, api_key) 复用长生命周期的 AsyncOpenAI 客户端，
+    避免每次请求重新建立连接池与 TLS 握手；应用关闭时统一释放。
+    配置重载改变连接池参数时新建客户端替换旧客户端，旧客户端在
+    retire_delay 秒后（进行中的请求结束后）于后台关闭，避免泄漏连接池。
+    """
+
+    def __init__(self, retire_delay: float = 600.0) -> None:
+        self.retire_delay = retire_delay
+        self._clients: Dict[
+            Tuple[str, str], Tuple[Tuple[int, int, float, bool], AsyncOpenAI]
+        ] = {}
+        # 已被替换、等待关闭的客户端及其延迟关闭任务
+        self._retired: List[AsyncOpenAI] = []
+        self._closers: Set["asyncio.Task[None]"] = set()
+
+    @staticmethod
+    def pool_options(cfg: Settings) -> Tuple[int, int, float, bool]:
+        """从配置中提取连接池参数"""
+        http2 = cfg.upstream_http2
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("未安装 h2 依赖，HTTP/2 不可用，回退到 HTTP/1.1")
+            http2 = False
+        return (
+            cfg.upstream_max_connections,
+            cfg.upstream_max_keepalive_connections,
+            cfg.upstream_keepalive_expiry,
+            http2,
+        )
+
+    def get(
+        self, url: str, key: str, options: Tuple[int, int, float, bool]
+    ) -> AsyncOpenAI:
+        """获取（或创建）指定上游的客户端，连接池参数变化时替换旧客户端"""
+        entry = self._clients.get((url, key))
+        if entry is not None and entry[0] == options:
+            return entry[1]
+        max_conn, max_keepalive, keepalive_expiry, http2 = options
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_conn,
+                max_keepalive_connections=max_keepalive,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            http2=http2,
+            follow_redirects=True,
+        )
+        # 重试与超时由 OpenAIClient 统一控制，关闭 SDK 自带的重试
+        client = AsyncOpenAI(
+            base_url=url, api_key=key, http_client=http_client, max_retries=0
+        )
+        self._clients[(url, key)] = (options, client)
+        logger.info(f"创建上游客户端: {url}，最大连接数: {max_conn}，HTTP/2: {http2}")
+        if entry is not None:
+            self._retire(entry[1])
+        return client
+
+    def _retire(self, client: AsyncOpenAI) -> None:
+        """延迟关闭被替换的客户端；没有运行中的事件循环时留到 aclose 关闭"""
+        self._retired.append(client)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(self._close_later(client))
+        self._closers.add(task)
+        task.add_done_callback(self._closers.discard)
+
+    async def _close_later(self, client: AsyncOpenAI) -> None:
+        await asyncio.sleep(self.retire_delay)
+        await self._close(client)
+
+    async def _close(self, client: AsyncOpenAI) -> None:
+        if client in self._retired:
+            self._retired.remove(client)
+        try:
+            await client.close()
+        except Exception as e:
+            logger.warning(f"关闭上游客户端失败: {e}")
+
+    @property
+    def retired(self) -> int:
+        """等待关闭的旧客户端数"""
+        return len(self._retired)
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    async def aclose(self) -> None:
+        """关闭所有客户端（包括等待关闭的旧客户端）并释放连接"""
+        for task in list(self._closers):
+            task.cancel()
+        clients = [client for _, client in self._clients.values()]
+        clients += self._retired
+        self._clients.clear()
+        self._retired = []
+        for client in clients:
+            await self._close(client)
+
+
+# 全局客户端注册表，目标模型与工具选择模型共用
+client_registry = ClientRegistry()
+
+
+class CachedCompletion:
+    """缓存中的非流式响应，与 ChatCompletion 一样通过 model_dump() 读取"""
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self._data = data
+
+    def model_dump(self) -> Dict[str, Any]:
+        return copy.deepcopy(self._data)
+
+
+async def replay_as_stream(data: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+    """将缓存的非流式响应重放为 OpenAI 流式分块，由 StreamProcessor 转换为 SSE"""
+    for choice in data.get("choices") or []:
+        msg = choice.get("message") or {}
+        delta: Dict[str, Any] = {"role": "assistant", "content": msg.get("content")}
+        if msg.get("tool_calls"):
+            delta["tool_calls"] = [
+                {**tc, "index": i} for i, tc in enumerate(msg["tool_calls"])
+            ]
+        yield {
+            "id": data.get("id"),
+            "model": data.get("model"),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+        }
+        yield {
+            "id": data.get("id"),
+            "model": data.get("model"),
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {},
+                    "finish_reason": choice.get("finish_reason") or "stop",
+                }
+            ],
+            "usage": data.get("usage"),
+        }
+
+
+class ResponseCache:
+    """确定性请求的响应缓存
+
+    temperature 为 0 或指定了 seed 时，相同的 payload 会得到相同的回答。
+    以上游地址与 payload（不含 stream 字段）的规范化哈希为键，缓存非流式响应：
+    内存 LRU 为第一层，可选的 SQLite 文件为第二层，两层均有过期时间。
+    流式请求命中时将缓存的响应重放为流式分块。
+    """
+
+    def __init__(self) -> None:
+        self._memory: LRUCache[str, Dict[str, Any]] = LRUCache(0)
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_path = ""
+        self._lock = threading.Lock()
+        self.ttl = 0.0
+        self.disk_hits = 0
+
+    def configure(self, size: int, ttl: float, db_path: str) -> None:
+        """按配置调整缓存容量、过期时间与磁盘缓存文件"""
+        if self._memory.maxsize != size or self.ttl != ttl:
+            self._memory = LRUCache(size, ttl or None)
+            self.ttl = ttl
+        if db_path != self._db_path:
+            self.close()
+            self._db_path = db_path
+            if db_path:
+                self._db = self._open_db(db_path)
+
+    @staticmethod
+    def _open_db(path: str) -> Optional[sqlite3.Connection]:
+        try:
+            db = sqlite3.connect(path, check_same_thread=False)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            db.commit()
+            logger.info(f"响应磁盘缓存: {path}")
+            return db
+        except sqlite3.Error as e:
+            logger.exception(f"打开响应磁盘缓存失败 {path}: {e}")
+            return None
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    @staticmethod
+    def cacheable(payload: Dict[str, Any]) -> bool:
+        """仅缓存确定性请求"""
+        return payload.get("temperature") == 0 or payload.get("seed") is not None
+
+    @staticmethod
+    def make_key(url: str, payload: Dict[str, Any]) -> str:
+        """计算缓存键：payload 按键排序规范化，忽略 stream 字段"""
+        body = {k: v for k, v in payload.items() if k != "stream"}
+        return payload_fingerprint(url, body)
+
+    def _disk_get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return cast(Dict[str, Any], json.loads(row[0]))
+
+    def _disk_put(self, key: str, data: Dict[str, Any]) -> None:
+        expires_at = time.time() + self.ttl if self.ttl > 0 else math.inf
+        with self._lock:
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                (key, json.dumps(data, ensure_ascii=False), expires_at),
+            )
+            self._db.execute(
+                "DELETE FROM responses WHERE expires_at < ?", (time.time(),)
+            )
+            self._db.commit()
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        data = self._memory.get(key)
+        if data is None and self._db is not None:
+            data = await asyncio.to_thread(self._disk_get, key)
+            if data is not None:
+                self.disk_hits += 1
+                self._memory.put(key, data)
+        return data
+
+    async def put(self, key: str, data: Dict[str, Any]) -> None:
+        self._memory.put(key, data)
+        if self._db is not None:
+            try:
+                await asyncio.to_thread(self._disk_put, key, data)
+            except sqlite3.Error as e:
+                logger.warning(f"写入响应磁盘缓存失败: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        """返回缓存统计信息（内存层命中/未命中与磁盘层命中）"""
+        return {**self._memory.stats(), "disk_hits": self.disk_hits}
+
+
+class _StreamEnd:
+    """流结束标记，error 不为空时表示上游流异常结束"""
+
+    def __init__(self, error: Optional[BaseException] = None) -> None:
+        self.error = error
+
+
+class _StreamSubscriber:
+    """共享上游流的一个订阅者：先重放订阅前已收到的分块，再读取自己的有界队列"""
+
+    def __init__(self, fanout: "_StreamFanout", replay: List[Any], buffer: int):
+        self._fanout = fanout
+        self._replay = replay
+        self._replay_pos = 0
+        self._queue: "asyncio.Queue[Any]" = asyncio.Queue(buffer)
+        self._overflowed = False
+        # 队列已满时到达的结束标记，读完队列后再处理
+        self._end: Optional[_StreamEnd] = None
+
+    @property
+    def backend(self) -> Optional[str]:
+        """共享上游流所请求的后端地址"""
+        return self._fanout.backend
+
+    def push(self, item: Any) -> bool:
+        """写入分块，队列已满时返回 False（结束标记总能送达）"""
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            if isinstance(item, _StreamEnd):
+                self._end = item
+                return True
+            self._overflowed = True
+            return False
+
+    def __aiter__(self) -> "_StreamSubscriber":
+        return self
+
+    async def __anext__(self) -> Any:
+        if self._replay_pos < len(self._replay):
+            self._replay_pos += 1
+            return self._replay[self._replay_pos - 1]
+        if self._overflowed and self._queue.empty():
+            raise RuntimeError("共享流的订阅者消费过慢，缓冲区已满")
+        if self._end is not None and self._queue.empty():
+            item = self._end
+        else:
+            item = await self._queue.get()
+        if isinstance(item, _StreamEnd):
+            if item.error is not None:
+                raise item.error
+            raise StopAsyncIteration
+        return item
+
+    async def close(self) -> None:
+        """取消订阅，最后一个订阅者离开时取消上游流"""
+        self._fanout.unsubscribe(self)
+
+
+class _StreamFanout:
+    """将一个上游流式响应分发给多个订阅者
+
+    已收到的分块保存在重放缓冲区中供晚加入的订阅者重放；超过 max_replay 个
+    分块后不再接受新的订阅者（之后的相同请求发起新的上游调用）并释放缓冲区。
+    """
+
+    def __init__(
+        self,
+        start: Callable[[], Awaitable[Any]],
+        buffer: int,
+        on_done: Callable[[], None],
+        max_replay: int = 1024,
+    ) -> None:
+        self.buffer = buffer
+        self.max_replay = max_replay
+        self.history: List[Any] = []
+        self.subscribers: List[_StreamSubscriber] = []
+        self.backend: Optional[str] = None
+        self._on_done = on_done
+        # 上游请求发出（含准入控制与首个分块）后完成，失败时带上异常
+        self.started: "asyncio.Future[None]" = (
+            asyncio.get_running_loop().create_future()
+        )
+        self.started.add_done_callback(
+            lambda f: f.cancelled() or f.exception()  # 避免未读取异常的告警
+        )
+        self.task = asyncio.ensure_future(self._pump(start))
+
+    def subscribe(self) -> _StreamSubscriber:
+        subscriber = _StreamSubscriber(self, list(self.history), self.buffer)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: _StreamSubscriber) -> None:
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+        if not self.subscribers and not self.task.done():
+            self.task.cancel()
+
+    def _publish(self, item: Any) -> None:
+        for subscriber in list(self.subscribers):
+            if not subscriber.push(item):
+                logger.warning("共享流的订阅者消费过慢，已断开")
+                self.subscribers.remove(subscriber)
+                # 断开的是最后一个订阅者时停止读取上游（结束标记无需再取消）
+                if not self.subscribers and not isinstance(item, _StreamEnd):
+                    self.task.cancel()
+
+    async def _pump(self, start: Callable[[], Awaitable[Any]]) -> None:
+        stream = None
+        end = _StreamEnd()
+        try:
+            stream = await start()
+            self.backend = getattr(stream, "backend", None)
+            self.started.set_result(None)
+            accepting = True
+            async for chunk in stream:
+                if accepting:
+                    self.history.append(chunk)
+                    if len(self.history) >= self.max_replay:
+                        # 重放缓冲区已满：注销后不再有新的订阅者，缓冲区可以释放
+                        accepting = False
+                        self._on_done()
+                        self.history = []
+                self._publish(chunk)
+        except asyncio.CancelledError:
+            end = _StreamEnd(RuntimeError("上游流已取消"))
+            close = getattr(stream, "close", None)
+            if close is not None:
+                with contextlib.suppress(Exception):
+                    await close()
+        except Exception as e:
+            end = _StreamEnd(e)
+        finally:
+            if not self.started.done():
+                self.started.set_exception(end.error or RuntimeError("上游流已结束"))
+            # 先注销再发送结束标记，之后的相同请求会发起新的上游调用
+            self._on_done()
+            self._publish(end)
+
+
+class _Flight:
+    """进行中的非流式上游调用及其等待者数量"""
+
+    def __init__(self, future: "asyncio.Future[Any]") -> None:
+        self.future = future
+        self.waiters = 0
+
+
+class SingleFlight:
+    """相同上游调用的合并（singleflight）
+
+    以上游地址与 payload 的哈希为键，并发的相同请求共享同一次上游调用：
+    非流式请求共享同一个结果；流式请求由一个上游流分发给多个订阅者，
+    每个订阅者的缓冲区有界。所有等待者都取消时取消上游调用。
+    """
+
+    # 共享流重放缓冲区的最大分块数，超过后不再接受晚加入的订阅者
+    MAX_REPLAY = 1024
+
+    def __init__(self) -> None:
+        self._calls: Dict[str, _Flight] = {}
+        self._streams: Dict[str, _StreamFanout] = {}
+        self.stats: Dict[str, int] = {"upstream_calls": 0, "coalesced": 0}
+
+    async def call(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """非流式调用：相同键的并发调用共享结果"""
+        flight = self._calls.get(key)
+        if flight is None:
+            self.stats["upstream_calls"] += 1
+            flight = _Flight(asyncio.ensure_future(fn()))
+            self._calls[key] = flight
+            done_flight = flight
+            flight.future.add_done_callback(
+                lambda _: self._forget(self._calls, key, done_flight)
+            )
+        else:
+            self.stats["coalesced"] += 1
+            logger.info("合并相同的进行中请求")
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.future)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.future.done():
+                flight.future.cancel()
+
+    async def stream(
+        self, key: str, fn: Callable[[], Awaitable[Any]], buffer: int
+    ) -> _StreamSubscriber:
+        """流式调用：相同键的并发请求订阅同一个上游流
+
+        等到上游流建立（准入控制通过并收到首个分块）后才返回订阅者，
+        上游调用失败（如 OverloadedError）时直接抛出，调用方可以在开始
+        SSE 响应之前返回对应的状态码。
+        """
+        fanout = self._streams.get(key)
+        if fanout is None:
+            self.stats["upstream_calls"] += 1
+            fanout = _StreamFanout(
+                fn,
+                buffer,
+                lambda: self._forget(self._streams, key, fanout),
+                self.MAX_REPLAY,
+            )
+            self._streams[key] = fanout
+        else:
+            self.stats["coalesced"] += 1
+            logger.info("合并相同的进行中流式请求")
+        subscriber = fanout.subscribe()
+        try:
+            await asyncio.shield(fanout.started)
+        except BaseException:
+            await subscriber.close()
+            raise
+        return subscriber
+
+    @staticmethod
+    def _forget(registry: Dict[str, Any], key: str, value: Any) -> None:
+        if registry.get(key) is value:
+            del registry[key]
+
+    def __len__(self) -> int:
+        return len(self._calls) + len(self._streams)
+
+
+class OverloadedError(Exception):
+    """准入控制拒绝请求（等待队列已满或排队超时），对应 Anthropic 的 529 overloaded_error"""
+
+
+class ConcurrencyLimiter:
+    """并发限制器：计数信号量加有界加权公平等待队列
+
+    达到并发上限后请求进入等待队列；队列已满或等待超过 max_wait 秒时
+    立即抛出 OverloadedError，而不是让所有请求一起堆积到上游超时。
+    limit <= 0 表示不限制。
+
+    等待队列按流（优先级类别 + 调用方）做开始时间公平排队（SFQ）：
+    每个流的请求依次获得间隔 1 / 权重 的虚拟开始时间，名额释放时分配给
+    虚拟开始时间最小的请求。权重高的类别获得更多名额，同一类别中
+    请求量大的调用方也不会饿死其他调用方。
+    """
+
+    def __init__(
+        self, name: str, limit: int = 0, max_queue: int = 100, max_wait: float = 30.0
+    ) -> None:
+        self.name = name
+        self.limit = 0
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.queue_depth = 0
+        self._available = 0
+        # 等待队列：(虚拟开始时间, 序号, future)
+        self._waiters: List[Tuple[float, int, "asyncio.Future[None]"]] = []
+        self._seq = 0
+        self._vtime = 0.0
+        self._flow_finish: Dict[Any, float] = {}
+        self._stats: Dict[str, float] = {
+            "admitted": 0,
+            "rejected": 0,
+            "timed_out": 0,
+            "max_queue_depth": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
+        self.configure(limit, max_queue, max_wait)
+
+    def configure(self, limit: int, max_queue: int, max_wait: float) -> None:
+        """应用配置；并发上限变化时按差值调整可用名额"""
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        limit = max(limit, 0)
+        if limit != self.limit:
+            self._available += limit - self.limit
+            self.limit = limit
+            self._dispatch()
+
+    def _reject(self, reason: str) -> OverloadedError:
+        logger.warning(f"{self.name} 过载，拒绝请求: {reason}")
+        return OverloadedError(f"{self.name} is overloaded: {reason}")
+
+    def _admitted(self, waited: float) -> None:
+        stats = self._stats
+        stats["admitted"] += 1
+        stats["wait_time_total"] += waited
+        stats["wait_time_max"] = max(stats["wait_time_max"], waited)
+        self.in_flight += 1
+
+    def _dispatch(self) -> None:
+        """把空闲名额按虚拟开始时间顺序分配给等待中的请求"""
+        while self._available > 0 and self._waiters:
+            start, _, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue
+            self._vtime = start
+            self._available -= 1
+            fut.set_result(None)
+        if not self._waiters and len(self._flow_finish) > 1024:
+            self._flow_finish.clear()
+
+    def _release_slot(self) -> None:
+        self._available += 1
+        self._dispatch()
+
+    async def acquire(
+        self, flow: Any = None, weight: float = 1.0
+    ) -> Callable[[], None]:
+        """获取一个并发名额，返回只生效一次的释放函数
+
+        flow 标识请求所属的流（如 (优先级类别, 调用方)），weight 为该流的权重。
+        """
+        if self.limit <= 0:
+            self._admitted(0.0)
+            return self._releaser(False)
+        if self._available > 0 and not self._waiters:
+            self._available -= 1
+            self._admitted(0.0)
+            return self._releaser(True)
+        if self.queue_depth >= self.max_queue:
+            self._stats["rejected"] += 1
+            raise self._reject(f"队列已满（{self.queue_depth}）")
+
+        vstart = max(self._vtime, self._flow_finish.get(flow, 0.0))
+        self._flow_finish[flow] = vstart + 1.0 / (weight if weight > 0 else 1.0)
+        fut: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (vstart, self._seq, fut))
+        self.queue_depth += 1
+        self._stats["max_queue_depth"] = max(
+            self._stats["max_queue_depth"], self.queue_depth
+        )
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(fut, self.max_wait)
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():
+                # 名额已分配但等待方已放弃，转交给下一个请求
+                self._release_slot()
+            if isinstance(e, asyncio.TimeoutError):
+                self._stats["timed_out"] += 1
+                raise self._reject(f"排队超过 {self.max_wait} 秒")
+            raise
+        finally:
+            self.queue_depth -= 1
+        self._admitted(time.monotonic() - start)
+        return self._releaser(True)
+
+    def _releaser(self, limited: bool) -> Callable[[], None]:
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if released:
+                return
+            released = True
+            self.in_flight -= 1
+            if limited:
+                self._release_slot()
+
+        return release
+
+    def stats(self) -> Dict[str, float]:
+        """返回并发、队列深度与等待时间统计"""
+        admitted = self._stats["admitted"]
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            **self._stats,
+            "wait_time_avg": (
+                self._stats["wait_time_total"] / admitted if admitted else 0.0
+            ),
+        }
+
+
+class BackendLimiters:
+    """按后端地址共享的节点级并发限制器
+
+    同一地址出现在多个路由的节点配置中时（如目标模型与工具选择模型部署在
+    同一推理服务上），各路由的请求在同一个加权公平队列中排队，优先级类别的
+    权重在路由之间同样生效。同一地址在各处配置的 max_concurrency 应一致，
+    否则以最近重建的节点池为准。
+    """
+
+    def __init__(self) -> None:
+        self._limiters: Dict[str, ConcurrencyLimiter] = {}
+
+    def get(
+        self, url: str, limit: int, max_queue: int, max_wait: float
+    ) -> Optional[ConcurrencyLimiter]:
+        """获取（或创建）指定地址的限制器并应用配置，limit <= 0 时返回 None"""
+        if limit <= 0:
+            return None
+        limiter = self._limiters.get(url)
+        if limiter is None:
+            limiter = ConcurrencyLimiter(f"backend {url}", limit, max_queue, max_wait)
+            self._limiters[url] = limiter
+        else:
+            limiter.configure(limit, max_queue, max_wait)
+        return limiter
+
+
+# 当前请求的调用方标识，由请求入口设置，工具选择与推测执行的子任务自动继承
+current_caller: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "current_caller", default="anonymous"
+)
+
+
+def request_priority(
+    settings: Settings, route: str, stream: bool, caller: str
+) -> Tuple[str, float]:
+    """按优先级规则确定请求的类别与权重，首个匹配的规则生效"""
+    name = "default"
+    for rule in settings.priority_rules:
+        if "route" in rule and rule["route"] != route:
+            continue
+        if "stream" in rule and bool(rule["stream"]) != stream:
+            continue
+        if "caller" in rule and not fnmatch.fnmatchcase(caller, str(rule["caller"])):
+            continue
+        name = str(rule.get("class", "default"))
+        break
+    return name, float(settings.priority_classes.get(name, 1.0))
+
+
+class Backend:
+    """后端节点及其负载与健康状态"""
+
+    def __init__(
+        self,
+        url: str,
+        api_key: str,
+        weight: float = 1.0,
+        limiter: Optional[ConcurrencyLimiter] = None,
+    ) -> None:
+        self.url = url
+        self.api_key = api_key
+        self.weight = weight if weight > 0 else 1.0
+        # 节点级并发限制（节点配置中的 max_concurrency），None 表示不限制
+        self.limiter = limiter
+        self.in_flight = 0
+        # 响应延迟的指数加权移动平均（秒），None 表示尚无样本
+        self.ewma_latency: Optional[float] = None
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    def healthy(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "in_flight": self.in_flight,
+            "ewma_latency": self.ewma_latency,
+            "consecutive_failures": self.consecutive_failures,
+            "ejected": not self.healthy(time.monotonic()),
+            "admission": self.limiter.stats() if self.limiter else None,
+        }
+
+
+class BackendPool:
+    """后端节点池：负载均衡与被动健康剔除
+
+    选择策略：
+    - least_outstanding：按 (进行中请求数 + 1) / 权重 最小选择
+    - ewma：按 EWMA 延迟 × (进行中请求数 + 1) / 权重 最小选择，
+      尚无延迟样本的节点优先，用于探测
+    - prefix_affinity：按消息前缀哈希在一致性哈希环上选择节点，相同前缀
+      落到同一节点以复用其 KV/前缀缓存；节点负载超过
+      load_factor × 平均负载（按权重）时顺延到环上的下一个节点（有界负载）
+    连续失败达到阈值的节点被剔除一段时间，到期后重新参与选择；
+    所有节点都被剔除时仍选择最早恢复的节点，避免完全不可用。
+    """
+
+    EWMA_ALPHA = 0.3
+    # 每单位权重在哈希环上的虚拟节点数
+    VIRTUAL_NODES = 64
+    # 每隔多少次前缀亲和请求输出一次命中率
+    AFFINITY_LOG_INTERVAL = 100
+
+    def __init__(
+        self,
+        backends: List[Backend],
+        strategy: str = "least_outstanding",
+        max_failures: int = 3,
+        ejection_time: float = 30.0,
+        load_factor: float = 1.25,
+        affinity_cache_size: int = 4096,
+    ) -> None:
+        if not backends:
+            raise ValueError("后端节点池不能为空")
+        self.backends = backends
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.ejection_time = ejection_time
+        self.load_factor = max(load_factor, 1.0)
+        self._rr = 0
+        self._ring: List[Tuple[int, Backend]] = []
+        self._ring_keys: List[int] = []
+        if strategy == "prefix_affinity":
+            self._build_ring()
+        # 每个前缀上次路由到的节点，用于统计前缀命中率
+        self._affinity: LRUCache[str, str] = LRUCache(affinity_cache_size)
+        self.affinity_stats: Dict[str, int] = {
+            "requests": 0,
+            "hits": 0,
+            "misses": 0,
+            "spilled": 0,
+        }
+
+    @staticmethod
+    def _ring_hash(value: str) -> int:
+        return int.from_bytes(hashlib.sha1(value.encode("utf-8")).digest()[:8], "big")
+
+    def _build_ring(self) -> None:
+        ring = []
+        for backend in self.backends:
+            for i in range(max(1, round(self.VIRTUAL_NODES * backend.weight))):
+                ring.append((self._ring_hash(f"{backend.url}#{i}"), backend))
+        ring.sort(key=lambda item: item[0])
+        self._ring = ring
+        self._ring_keys = [pos for pos, _ in ring]
+
+    def _score(self, backend: Backend) -> float:
+        load = (backend.in_flight + 1) / backend.weight
+        if self.strategy == "ewma":
+            if backend.ewma_latency is None:
+                return 0.0
+            return backend.ewma_latency * load
+        return load
+
+    def _candidates(self, allowed: Optional[Sequence[Backend]] = None) -> List[Backend]:
+        backends = allowed or self.backends
+        now = time.monotonic()
+        healthy = [b for b in backends if b.healthy(now)]
+        if healthy:
+            return healthy
+        logger.warning("所有后端节点均已剔除，选择最早恢复的节点")
+        return [min(backends, key=lambda b: b.ejected_until)]
+
+    def _acquire_affinity(
+        self, affinity_key: str, candidates: List[Backend]
+    ) -> Backend:
+        """有界负载一致性哈希：从前缀的哈希位置沿环查找首个未超载的节点"""
+        total_weight = sum(b.weight for b in candidates)
+        total_load = sum(b.in_flight for b in candidates) + 1
+        allowed = {id(b) for b in candidates}
+        start = bisect.bisect(self._ring_keys, int(affinity_key[:16], 16))
+        primary: Optional[Backend] = None
+        chosen: Optional[Backend] = None
+        for i in range(len(self._ring)):
+            backend = self._ring[(start + i) % len(self._ring)][1]
+            if id(backend) not in allowed:
+                continue
+            if primary is None:
+                primary = backend
+            capacity = math.ceil(
+                self.load_factor * total_load * backend.weight / total_weight
+            )
+            if backend.in_flight < capacity:
+                chosen = backend
+                break
+        if chosen is None:
+            chosen = min(candidates, key=self._score)
+        self._record_affinity(affinity_key, chosen, chosen is not primary)
+        return chosen
+
+    def _record_affinity(
+        self, affinity_key: str, backend: Backend, spilled: bool
+    ) -> None:
+        stats = self.affinity_stats
+        stats["requests"] += 1
+        if spilled:
+            stats["spilled"] += 1
+        previous = self._affinity.peek(affinity_key)
+        if previous is not None:
+            stats["hits" if previous == backend.url else "misses"] += 1
+        if previous != backend.url:
+            self._affinity.put(affinity_key, backend.url)
+        if stats["requests"] % self.AFFINITY_LOG_INTERVAL == 0:
+            logger.info(
+                f"前缀亲和命中率: {self.affinity_hit_rate():.1%}，"
+                f"请求 {stats['requests']} 次，溢出 {stats['spilled']} 次"
+            )
+
+    def affinity_hit_rate(self) -> float:
+        """重复出现的前缀中，路由到与上次相同节点的比例"""
+        seen = self.affinity_stats["hits"] + self.affinity_stats["misses"]
+        return self.affinity_stats["hits"] / seen if seen else 0.0
+
+    def acquire(
+        self,
+        affinity_key: Optional[str] = None,
+        exclude: Sequence[Backend] = (),
+        allowed: Optional[Sequence[Backend]] = None,
+    ) -> Backend:
+        """选择一个节点并计入进行中请求
+
+        prefix_affinity 策略下按 affinity_key 选择，未提供时按最少进行中请求选择。
+        exclude 中的节点（如重试前失败的节点）仅在没有其他可用节点时才会选中；
+        allowed 不为空时只在其中选择（如跳过熔断的节点）。
+        """
+        candidates = self._candidates(allowed)
+        if exclude:
+            candidates = [b for b in candidates if b not in exclude] or candidates
+        if self.strategy == "prefix_affinity" and affinity_key:
+            backend = self._acquire_affinity(affinity_key, candidates)
+        else:
+            # 轮转起点，得分相同时在节点间均匀分布
+            self._rr = (self._rr + 1) % len(candidates)
+            rotated = candidates[self._rr :] + candidates[: self._rr]
+            backend = min(rotated, key=self._score)
+        backend.in_flight += 1
+        return backend
+
+    def release(
+        self, backend: Backend, latency: Optional[float], failed: Optional[bool] = False
+    ) -> None:
+        """请求结束：更新进行中请求数、延迟与健康状态
+
+        failed 为 None 表示请求没有真正发往节点（如被节点并发限制拒绝），
+        只释放进行中请求数，不影响健康状态。
+        """
+        backend.in_flight = max(0, backend.in_flight - 1)
+        if failed is None:
+            return
+        if failed:
+            backend.consecutive_failures += 1
+            if backend.consecutive_failures >= self.max_failures:
+                backend.ejected_until = time.monotonic() + self.ejection_time
+                logger.warning(
+                    f"后端节点连续失败 {backend.consecutive_failures} 次，"
+                    f"剔除 {self.ejection_time} 秒: {backend.url}"
+                )
+            return
+        backend.consecutive_failures = 0
+        if latency is not None:
+            if backend.ewma_latency is None:
+                backend.ewma_latency = latency
+            else:
+                backend.ewma_latency += self.EWMA_ALPHA * (
+                    latency - backend.ewma_latency
+                )
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """返回各节点状态"""
+        return [b.snapshot() for b in self.backends]
+
+
+class CircuitOpenError(OverloadedError):
+    """路由的所有后端熔断器均处于打开状态且未配置可用的降级目标"""
+
+
+class CircuitBreaker:
+    """单个后端的熔断器：closed → open → half_open → closed
+
+    closed 状态下在最近 window 次请求中统计错误率与慢请求比例，样本数达到
+    min_requests 且任一比例超过阈值时打开；打开期间直接跳过该后端，
+    open_time 秒后进入 half_open，放行少量探测请求，探测成功则关闭，
+    失败则重新打开。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.state = self.CLOSED
+        self.window = 20
+        self.min_requests = 10
+        self.error_rate = 0.5
+        self.slow_threshold = 0.0
+        self.slow_rate = 0.5
+        self.open_time = 30.0
+        self.half_open_probes = 1
+        self._outcomes: Deque[Tuple[bool, bool]] = deque(maxlen=self.window)
+        self._opened_at = 0.0
+        self._probes = 0
+        self.trips = 0
+
+    def configure(self, settings: Settings) -> None:
+        """应用熔断阈值配置"""
+        window = max(settings.circuit_window, 1)
+        if window != self.window:
+            self.window = window
+            self._outcomes = deque(self._outcomes, maxlen=window)
+        self.min_requests = settings.circuit_min_requests
+        self.error_rate = settings.circuit_error_rate
+        self.slow_threshold = settings.circuit_slow_threshold
+        self.slow_rate = settings.circuit_slow_rate
+        self.open_time = settings.circuit_open_time
+        self.half_open_probes = max(settings.circuit_half_open_probes, 1)
+
+    def _refresh(self) -> None:
+        if (
+            self.state == self.OPEN
+            and time.monotonic() - self._opened_at >= self.open_time
+        ):
+            self.state = self.HALF_OPEN
+            self._probes = 0
+            logger.info(f"熔断器进入半开状态，放行探测请求: {self.name}")
+
+    def available(self) -> bool:
+        """是否可以向该后端发送请求（不占用半开状态的探测名额）"""
+        self._refresh()
+        if self.state == self.CLOSED:
+            return True
+        return self.state == self.HALF_OPEN and self._probes < self.half_open_probes
+
+    def begin(self) -> None:
+        """开始一次请求，半开状态下占用一个探测名额"""
+        if self.state == self.HALF_OPEN:
+            self._probes += 1
+
+    def cancel(self) -> None:
+        """请求未产生结果（被取消或被本地拒绝），归还探测名额"""
+        if self.state == self.HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+
+    def _open(self, reason: str) -> None:
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self.trips += 1
+        logger.warning(
+            f"熔断器打开（{reason}），{self.open_time} 秒内跳过: {self.name}"
+        )
+
+    def record(self, failed: bool, latency: Optional[float]) -> None:
+        """记录一次请求的结果"""
+        slow = (
+            latency is not None
+            and self.slow_threshold > 0
+            and latency > self.slow_threshold
+        )
+        if self.state == self.HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+            if failed or slow:
+                self._open("探测请求失败" if failed else "探测请求过慢")
+            else:
+                self.state = self.CLOSED
+                self._outcomes.clear()
+                logger.info(f"熔断器关闭，后端恢复: {self.name}")
+            return
+        if self.state == self.OPEN:
+            # 打开前已发出的请求，结果不再计入
+            return
+        self._outcomes.append((failed, slow))
+        total = len(self._outcomes)
+        if total < self.min_requests:
+            return
+        errors = sum(1 for f, _ in self._outcomes if f) / total
+        slows = sum(1 for _, s in self._outcomes if s) / total
+        if errors >= self.error_rate:
+            self._open(f"错误率 {errors:.0%}")
+        elif self.slow_threshold > 0 and slows >= self.slow_rate:
+            self._open(f"慢请求比例 {slows:.0%}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回熔断器状态"""
+        self._refresh()
+        total = len(self._outcomes)
+        return {
+            "state": self.state,
+            "samples": total,
+            "error_rate": (
+                sum(1 for f, _ in self._outcomes if f) / total if total else 0.0
+            ),
+            "trips": self.trips,
+        }
+
+
+def is_backend_failure(error: BaseException) -> bool:
+    """是否计为后端故障：连接错误、超时与 5xx 计入，4xx（请求本身的问题）不计入"""
+    status = getattr(error, "status_code", None)
+    return not (isinstance(status, int) and status < 500)
+
+
+class UpstreamTimeoutError(Exception):
+    """单次上游尝试超过首字节或总时限"""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """是否可以重试：连接错误、超时、408/409/429 与 5xx 可重试，其余 4xx 与过载拒绝不重试"""
+    if isinstance(error, OverloadedError):
+        return False
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int):
+        return status in (408, 409, 429) or status >= 500
+    return isinstance(
+        error, (UpstreamTimeoutError, APIConnectionError, httpx.TransportError)
+    )
+
+
+async def _with_deadline(
+    aw: Awaitable[Any], deadline: Optional[float], phase: str
+) -> Any:
+    """在截止时间（time.monotonic）前等待，超时抛出 UpstreamTimeoutError"""
+    if deadline is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, max(deadline - time.monotonic(), 0.0))
+    except asyncio.TimeoutError:
+        raise UpstreamTimeoutError(f"upstream {phase} deadline exceeded")
+
+
+# 预取首个分块的标记：尚未预取 / 流在首个分块前已结束
+_NO_CHUNK = object()
+_STREAM_DONE = object()
+
+
+class _TrackedStream:
+    """包装上游流式响应
+
+    先返回重试阶段已预取的首个分块，之后的分块受总时限约束：整个流只设置
+    一个到期定时器，到期时取消正在等待分块的任务并抛出 UpstreamTimeoutError，
+    读取分块本身不再额外包装；
+    流结束（完成、出错、超时或关闭）时调用一次 on_done(failed)，释放节点与并发名额。
+    """
+
+    def __init__(
+        self,
+        stream: Any,
+        on_done: Callable[[bool], None],
+        iterator: Any = None,
+        first: Any = _NO_CHUNK,
+        deadline: Optional[float] = None,
+        backend: Optional[str] = None,
+    ) -> None:
+        self.backend = backend
+        self._stream = stream
+        self._iter = iterator if iterator is not None else stream.__aiter__()
+        self._on_done: Optional[Callable[[bool], None]] = on_done
+        self._first = first
+        self._deadline = deadline
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._waiter: Optional["asyncio.Task[Any]"] = None
+        self._expired = False
+
+    def _expire(self) -> None:
+        """总时限到期：取消正在等待分块的任务"""
+        self._expired = True
+        if self._waiter is not None:
+            self._waiter.cancel()
+
+    def _finish(self, failed: bool) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._on_done is not None:
+            on_done, self._on_done = self._on_done, None
+            on_done(failed)
+
+    def __aiter__(self) -> "_TrackedStream":
+        return self
+
+    async def __anext__(self) -> Any:
+        first = self._first
+        if first is not _NO_CHUNK:
+            self._first = _NO_CHUNK
+            if first is not _STREAM_DONE:
+                return first
+            self._finish(False)
+            raise StopAsyncIteration
+        if self._deadline is not None and self._timer is None:
+            # loop.time() 与 time.monotonic() 使用同一时钟
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_at(self._deadline, self._expire)
+        try:
+            if self._expired:
+                raise UpstreamTimeoutError("upstream total deadline exceeded")
+            self._waiter = asyncio.current_task()
+            try:
+                return await self._iter.__anext__()
+            finally:
+                self._waiter = None
+        except StopAsyncIteration:
+            self._finish(False)
+            raise
+        except asyncio.CancelledError:
+            if not self._expired:
+                self._finish(False)
+                raise
+            # 由到期定时器发起的取消，转换为超时错误
+            uncancel = getattr(asyncio.current_task(), "uncancel", None)
+            if uncancel is not None:
+                uncancel()
+            error = UpstreamTimeoutError("upstream total deadline exceeded")
+            self._finish(is_backend_failure(error))
+            raise error from None
+        except Exception as e:
+            self._finish(is_backend_failure(e))
+            raise
+
+    async def close(self) -> None:
+        self._finish(False)
+        close = getattr(self._stream, "close", None)
+        if close is not None:
+            await close()
+
+
+class _Attempt:
+    """一次上游尝试：占用的节点与节点并发名额，以及尝试结果"""
+
+    def __init__(
+        self,
+        pool: Optional["BackendPool"],
+        backend: Optional[Backend],
+        url: str = "",
+        key: str = "",
+        breaker: Optional[CircuitBreaker] = None,
+        model: Optional[str] = None,
+    ) -> None:
+        self.pool = pool
+        self.backend = backend
+        self.url = backend.url if backend is not None else url
+        self.key = backend.api_key if backend is not None else key
+        self.breaker = breaker
+        # 降级目标使用的模型，None 表示沿用 payload 中的模型
+        self.model = model
+        self.held: List[Callable[[], None]] = []
+        self.result: Any = None
+        self.iterator: Any = None
+        self.first: Any = _NO_CHUNK
+        self.latency: Optional[float] = None
+        self.started: Optional[float] = None
+        self.deadline: Optional[float] = None
+        self._done = False
+
+    def finish(self, failed: Optional[bool]) -> None:
+        """释放节点与名额（只生效一次），成功时记录首字节延迟
+
+        failed 为 None 时只释放，不向节点池记录成功或失败。
+        """
+        if self._done:
+            return
+        self._done = True
+        for release in self.held:
+            release()
+        if self.pool is not None and self.backend is not None:
+            latency = self.latency if failed is False else None
+            self.pool.release(self.backend, latency, failed)
+
+    async def discard(self) -> None:
+        """放弃尝试（对冲请求中落后的一方）：关闭流并释放"""
+        close = getattr(self.result, "close", None)
+        if close is not None and self.iterator is not None:
+            with contextlib.suppress(Exception):
+                await close()
+        self.finish(False)
+
 
 class OpenAIClient:
-    """OpenAI客户端服务"""
+    """OpenAI客户端服务
+
+    传入 response_cache 且配置启用时，确定性请求先查询响应缓存；
+    传入 coalescer 且配置启用时，并发的相同请求合并为一次上游调用；
+    backends_setting 指向的配置项中配置了多个后端节点时，在节点间负载均衡，
+    否则直接请求传入的地址。
+    concurrency_setting 指向的配置项为该路由的并发上限，节点配置中的
+    max_concurrency 为单个节点的并发上限；节点限制器来自 backend_limiters，
+    传入同一个实例的客户端在相同地址上共享排队。准入控制位于缓存与请求合并
+    之后，只限制真正发往上游的请求，超限时抛出 OverloadedError。
+    排队的请求按 (优先级类别, 调用方) 加权公平调度，route 为优先级规则中的路由名，
+    各类别的排队时间与延迟记录在 class_stats 中。
+    每次尝试受连接、首字节与总时限约束，可重试的错误在返回任何数据之前
+    带抖动退避重试；启用对冲时，超过近期 p95 延迟仍未响应的请求会向
+    另一个节点再发一次，先返回者胜出。
+    启用熔断时每个后端地址有独立的熔断器，熔断的节点直接跳过；全部熔断时改用
+    fallback_setting 指向的降级目标，未配置时立即抛出 CircuitOpenError。
+    """
+
+    HEDGE_MIN_SAMPLES = 20
+
+    def __init__(
+        self,
+        registry: Optional[ClientRegistry] = None,
+        response_cache: Optional[ResponseCache] = None,
+        coalescer: Optional[SingleFlight] = None,
+        backends_setting: Optional[str] = None,
+        concurrency_setting: Optional[str] = None,
+        route: str = "target",
+        fallback_setting: Optional[str] = None,
+        backend_limiters: Optional[BackendLimiters] = None,
+    ) -> None:
+        self.registry = registry or client_registry
+        self.backend_limiters = (
+            backend_limiters if backend_limiters is not None else BackendLimiters()
+        )
+        self.response_cache = response_cache
+        self.coalescer = coalescer
+        self.backends_setting = backends_setting
+        self.concurrency_setting = concurrency_setting
+        self.limiter = ConcurrencyLimiter(concurrency_setting or "upstream")
+        self.route = route
+        self.fallback_setting = fallback_setting
+        # 按后端地址的熔断器
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.class_stats: Dict[str, Dict[str, float]] = {}
+        # 最近的首字节延迟（用于计算对冲延迟）与每次尝试的结果统计
+        self._latencies: Deque[float] = deque(maxlen=256)
+        self.attempt_stats: Dict[str, int] = {
+            "ok": 0,
+            "error": 0,
+            "timeout": 0,
+            "cancelled": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+        }
+        self._pool: Optional[BackendPool] = None
+        self._pool_config: Any = None
+
+    @property
+    def pool(self) -> Optional[BackendPool]:
+        """当前的后端节点池，未配置多后端时为 None"""
+        return self._pool
+
+    def route_limiter(self, settings: Settings) -> Optional[ConcurrencyLimiter]:
+        """获取应用当前配置后的路由并发限制器，未配置并发上限时返回 None"""
+        if not self.concurrency_setting:
+            return None
+        self.limiter.configure(
+            int(getattr(settings, self.concurrency_setting, 0) or 0),
+            settings.admission_queue_size,
+            settings.admission_queue_timeout,
+        )
+        return self.limiter if self.limiter.limit > 0 else None
+
+    def backend_pool(
+        self, settings: Settings, default_key: str
+    ) -> Optional[BackendPool]:
+        """获取当前配置对应的后端节点池，未配置多个后端时返回 None
+
+        节点配置不变时复用同一个节点池，保留负载与健康状态。
+        """
+        if not self.backends_setting:
+            return None
+        entries = getattr(settings, self.backends_setting, None) or []
+        if not entries:
+            return None
+        config = (
+            json.dumps(thaw(entries), sort_keys=True, default=str),
+            default_key,
+            settings.load_balancing_strategy,
+            settings.backend_max_failures,
+            settings.backend_ejection_time,
+            settings.prefix_affinity_load_factor,
+            settings.admission_queue_size,
+            settings.admission_queue_timeout,
+        )
+        if self._pool is None or self._pool_config != config:
+            backends = []
+            for entry in entries:
+                limiter = self.backend_limiters.get(
+                    str(entry["url"]),
+                    int(entry.get("max_concurrency") or 0),
+                    settings.admission_queue_size,
+                    settings.admission_queue_timeout,
+                )
+                backends.append(
+                    Backend(
+                        str(entry["url"]),
+                        str(entry.get("api_key") or default_key),
+                        float(entry.get("weight", 1.0)),
+                        limiter,
+                    )
+                )
+            self._pool = BackendPool(
+                backends,
+                settings.load_balancing_strategy.lower(),
+                settings.backend_max_failures,
+                settings.backend_ejection_time,
+                settings.prefix_affinity_load_factor,
+            )
+            self._pool_config = config
+            logger.info(
+                f"后端节点池: {[b.url for b in backends]}，"
+                f"策略: {settings.load_balancing_strategy}"
+            )
+        return self._pool
+
+    def _record_class(
+        self, name: str, wait: float, latency: Optional[float], rejected: bool = False
+    ) -> None:
+        """记录优先级类别的排队时间与延迟（排队 + 首个响应）"""
+        stats = self.class_stats.get(name)
+        if stats is None:
+            stats = self.class_stats[name] = {
+                "requests": 0,
+                "rejected": 0,
+                "wait_time_total": 0.0,
+                "wait_time_max": 0.0,
+                "latency_total": 0.0,
+                "latency_max": 0.0,
+            }
+        if rejected:
+            stats["rejected"] += 1
+            return
+        stats["requests"] += 1
+        stats["wait_time_total"] += wait
+        stats["wait_time_max"] = max(stats["wait_time_max"], wait)
+        if latency is not None:
+            stats["latency_total"] += latency
+            stats["latency_max"] = max(stats["latency_max"], latency)
+
+    def hedge_delay(self) -> Optional[float]:
+        """对冲延迟：最近首字节延迟的 p95，样本不足时返回 None（不对冲）"""
+        if len(self._latencies) < self.HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def breaker(self, settings: Settings, url: str) -> Optional[CircuitBreaker]:
+        """获取后端的熔断器，未启用熔断时返回 None"""
+        if not settings.circuit_breaker_enabled:
+            return None
+        breaker = self.breakers.get(url)
+        if breaker is None:
+            breaker = self.breakers[url] = CircuitBreaker(url)
+        breaker.configure(settings)
+        return breaker
+
+    def _new_attempt(
+        self,
+        settings: Settings,
+        pool: Optional[BackendPool],
+        url: str,
+        key: str,
+        affinity_key: Optional[str],
+        tried: List[Backend],
+    ) -> _Attempt:
+        """为一次尝试选择节点：跳过熔断的节点，已尝试过的节点尽量避开
+
+        所有节点均已熔断时改用降级目标，未配置降级目标时抛出 CircuitOpenError。
+        """
+        if pool is None:
+            breaker = self.breaker(settings, url)
+            if breaker is None or breaker.available():
+                attempt = _Attempt(None, None, url, key, breaker)
+            else:
+                attempt = self._fallback_attempt(settings, key)
+        else:
+            allowed = pool.backends
+            if settings.circuit_breaker_enabled:
+                allowed = [
+                    b
+                    for b in pool.backends
+                    if cast(CircuitBreaker, self.breaker(settings, b.url)).available()
+                ]
+            if allowed:
+                backend = pool.acquire(affinity_key, exclude=tried, allowed=allowed)
+                tried.append(backend)
+                attempt = _Attempt(
+                    pool, backend, breaker=self.breaker(settings, backend.url)
+                )
+            else:
+                attempt = self._fallback_attempt(settings, key)
+        if attempt.breaker is not None:
+            attempt.breaker.begin()
+        return attempt
+
+    def _fallback_attempt(self, settings: Settings, key: str) -> _Attempt:
+        """熔断时的降级目标"""
+        fallback: Mapping[str, Any] = (
+            getattr(settings, self.fallback_setting, None) or {}
+            if self.fallback_setting
+            else {}
+        )
+        url = fallback.get("base_url")
+        if url:
+            breaker = self.breaker(settings, url)
+            if breaker is None or breaker.available():
+                logger.info(f"{self.route} 后端已熔断，降级到 {url}")
+                return _Attempt(
+                    None,
+                    None,
+                    url,
+                    fallback.get("api_key") or key,
+                    breaker,
+                    fallback.get("model"),
+                )
+        raise CircuitOpenError(f"{self.route} backends are unavailable (circuit open)")
+
+    async def _run_attempt(
+        self,
+        attempt: _Attempt,
+        settings: Settings,
+        options: Any,
+        payload: Dict[str, Any],
+        flow: Any,
+        weight: float,
+    ) -> _Attempt:
+        """执行一次尝试：非流式等到完整响应，流式等到首个分块，均受时限约束"""
+        backend = attempt.backend
+        url, key = attempt.url, attempt.key
+        if attempt.model:
+            payload = {**payload, "model": attempt.model}
+        breaker = attempt.breaker
+        stream = bool(payload.get("stream"))
+        total = settings.upstream_total_timeout
+        first_byte = settings.upstream_first_byte_timeout
+        span = tracer.start_span("upstream_attempt", backend=url)
+        # 请求 ID 随请求头转发给上游，便于关联两端日志
+        request_id = current_request_id.get()
+        if request_id and settings.request_id_header:
+            payload = {
+                **payload,
+                "extra_headers": {settings.request_id_header: request_id},
+            }
+        try:
+            if backend is not None and backend.limiter is not None:
+                attempt.held.append(await backend.limiter.acquire(flow, weight))
+            client = self.registry.get(url, key, options)
+            start = attempt.started = time.monotonic()
+            attempt.deadline = start + total if total > 0 else None
+            first_deadline = attempt.deadline
+            if stream and first_byte > 0:
+                first_deadline = min(first_deadline or math.inf, start + first_byte)
+            timeout = httpx.Timeout(
+                total if total > 0 else None,
+                connect=settings.upstream_connect_timeout or None,
+            )
+            attempt.result = await _with_deadline(
+                client.chat.completions.create(**{**payload, "timeout": timeout}),
+                first_deadline,
+                "first byte" if stream else "total",
+            )
+            if stream:
+                attempt.iterator = attempt.result.__aiter__()
+                try:
+                    attempt.first = await _with_deadline(
+                        attempt.iterator.__anext__(), first_deadline, "first byte"
+                    )
+                except StopAsyncIteration:
+                    attempt.first = _STREAM_DONE
+            attempt.latency = time.monotonic() - start
+        except OverloadedError:
+            # 被节点并发限制拒绝，请求没有发往节点，不计入节点的健康状态
+            if breaker is not None:
+                breaker.cancel()
+            attempt.finish(None)
+            raise
+        except asyncio.CancelledError as e:
+            span.record_error(e)
+            if breaker is not None:
+                breaker.cancel()
+            await attempt.discard()
+            raise
+        except Exception as e:
+            span.record_error(e)
+            timed_out = isinstance(e, (UpstreamTimeoutError, APITimeoutError))
+            self.attempt_stats["timeout" if timed_out else "error"] += 1
+            status = getattr(e, "status_code", None)
+            metrics.upstream_responses.inc(
+                self.route,
+                str(status) if status else "timeout" if timed_out else "error",
+            )
+            if breaker is not None:
+                breaker.record(is_backend_failure(e), None)
+            with contextlib.suppress(Exception):
+                close = getattr(attempt.result, "close", None)
+                if stream and close is not None:
+                    await close()
+            attempt.finish(is_backend_failure(e))
+            raise
+        finally:
+            span.set("latency_ms", round((attempt.latency or 0.0) * 1000, 3))
+            span.end()
+        self.attempt_stats["ok"] += 1
+        self._latencies.append(attempt.latency)
+        metrics.upstream_responses.inc(self.route, "200")
+        metrics.upstream_duration.observe(
+            attempt.latency, self.route, "first_byte" if stream else "total"
+        )
+        if breaker is not None:
+            breaker.record(False, attempt.latency)
+        if not stream:
+            attempt.finish(False)
+        return attempt
+
+    async def _hedged_attempt(
+        self,
+        settings: Settings,
+        pool: Optional[BackendPool],
+        select: Callable[[], _Attempt],
+        run: Callable[[_Attempt], Awaitable[_Attempt]],
+    ) -> _Attempt:
+        """执行一次尝试；启用对冲且超过 p95 延迟仍未返回时，向另一个节点发出对冲请求"""
+        primary = select()
+        delay = None
+        if settings.upstream_hedging_enabled and pool is not None:
+            delay = self.hedge_delay()
+            if delay is not None:
+                delay = max(delay, settings.upstream_hedge_min_delay)
+        if delay is None:
+            return await run(primary)
+
+        tasks = [asyncio.ensure_future(run(primary))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            hedge: Optional[_Attempt] = None
+            if not done:
+                try:
+                    hedge = select()
+                except OverloadedError as e:
+                    # 其余节点均已熔断（且无降级目标），只等待主请求
+                    logger.info(f"无法发出对冲请求，继续等待主请求: {e}")
+            if hedge is not None:
+                if hedge.backend is primary.backend or hedge.backend is None:
+                    # 没有其他可用节点，不对冲
+                    if hedge.breaker is not None:
+                        hedge.breaker.cancel()
+                    hedge.finish(False)
+                else:
+                    self.attempt_stats["hedges"] += 1
+                    logger.info(
+                        f"上游 {delay:.2f} 秒未响应，"
+                        f"向 {hedge.backend.url} 发出对冲请求"
+                    )
+                    tasks.append(asyncio.ensure_future(run(hedge)))
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                winners = [t for t in done if t.exception() is None]
+                for task in done:
+                    if task.exception() is not None and error is None:
+                        error = task.exception()
+                if winners:
+                    for loser in winners[1:]:
+                        await loser.result().discard()
+                    winner = winners[0].result()
+                    if winner is not primary:
+                        self.attempt_stats["hedge_wins"] += 1
+                    return winner
+            assert error is not None
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                    self.attempt_stats["cancelled"] += 1
+                    with contextlib.suppress(asyncio.CancelledError, Exception):
+                        await task
 
     async def create_completion(
         self, url: str, key: str, payload: Dict[str, Any]
     ) -> Any:
-        """创建完成请求"""
-        client = AsyncOpenAI(base_url=url, api_key=key)
-        return await client.chat.completions.create(**payload)
+        """创建完成请求，追踪中记录为 upstream span（流式请求到首个分块为止）"""
+        with tracer.span(
+            "upstream",
+            route=self.route,
+            model=payload.get("model"),
+            stream=bool(payload.get("stream")),
+            message_count=len(payload.get("messages") or []),
+        ) as span:
+            if span.recording:
+                # 仅在追踪时计算请求体大小
+                span.set("payload_bytes", len(json.dumps(payload, default=str)))
+            return await self._create_completion(url, key, payload)
+
+    async def _create_completion(
+        self, url: str, key: str, payload: Dict[str, Any]
+    ) -> Any:
+        settings = config_manager.settings
+        cache = self.response_cache
+        cache_key = None
+        if cache is not None and settings.response_cache_enabled:
+            cache.configure(
+                settings.response_cache_size,
+                settings.response_cache_ttl,
+                settings.response_cache_db,
+            )
+            if cache.cacheable(payload):
+                cache_key = cache.make_key(url, payload)
+                cached = await cache.get(cache_key)
+                if cached is not None:
+                    logger.info("命中响应缓存")
+                    if payload.get("stream"):
+                        return replay_as_stream(cached)
+                    return CachedCompletion(cached)
+
+        options = self.registry.pool_options(settings)
+        pool = self.backend_pool(settings, key)
+        route_limiter = self.route_limiter(settings)
+
+        async def send() -> Any:
+            caller = current_caller.get()
+            priority, weight = request_priority(
+                settings, self.route, bool(payload.get("stream")), caller
+            )
+            flow = (priority, caller)
+            queued_at = time.monotonic()
+            release_route: Callable[[], None] = lambda: None
+            if route_limiter is not None:
+                try:
+                    release_route = await route_limiter.acquire(flow, weight)
+                except OverloadedError:
+                    self._record_class(priority, 0.0, None, rejected=True)
+                    raise
+            wait = time.monotonic() - queued_at
+
+            affinity_key = None
+            if pool is not None and pool.strategy == "prefix_affinity":
+                affinity_key = prefix_affinity_key(
+                    payload.get("messages") or [],
+                    settings.prefix_affinity_turns,
+                    trailing_tool_prompt.get(),
+                )
+
+            def select() -> _Attempt:
+                return self._new_attempt(settings, pool, url, key, affinity_key, tried)
+
+            async def run(attempt: _Attempt) -> _Attempt:
+                return await self._run_attempt(
+                    attempt, settings, options, payload, flow, weight
+                )
+
+            # 重试只发生在返回任何数据之前：流式请求在首个分块到达后才交给调用方
+            tried: List[Backend] = []
+            retries = max(settings.upstream_max_retries, 0)
+            try:
+                for n in range(retries + 1):
+                    try:
+                        attempt = await self._hedged_attempt(
+                            settings, pool, select, run
+                        )
+                        break
+                    except Exception as e:
+                        if n >= retries or not is_retryable(e):
+                            raise
+                        self.attempt_stats["retries"] += 1
+                        backoff = random.uniform(
+                            0,
+                            min(
+                                settings.upstream_retry_backoff_max,
+                                settings.upstream_retry_backoff * 2**n,
+                            ),
+                        )
+                        logger.warning(
+                            f"上游请求失败，{backoff:.2f} 秒后第 {n + 1} 次重试: {e}"
+                        )
+                        await asyncio.sleep(backoff)
+            except OverloadedError:
+                release_route()
+                self._record_class(priority, wait, None, rejected=True)
+                raise
+            except BaseException:
+                release_route()
+                raise
+            self._record_class(priority, wait, time.monotonic() - queued_at)
+
+            if not payload.get("stream"):
+                release_route()
+                return attempt.result
+
+            def on_done(failed: bool) -> None:
+                if attempt.started is not None:
+                    metrics.upstream_duration.observe(
+                        time.monotonic() - attempt.started, self.route, "total"
+                    )
+                attempt.finish(failed)
+                release_route()
+
+            return _TrackedStream(
+                attempt.result,
+                on_done,
+                attempt.iterator,
+                attempt.first,
+                attempt.deadline,
+                attempt.url,
+            )
+
+        async def upstream() -> Any:
+            completion = await send()
+            if (
+                cache_key is not None
+                and cache is not None
+                and not payload.get("stream")
+            ):
+                await cache.put(cache_key, completion.model_dump())
+            return completion
+
+        if self.coalescer is None or not settings.request_coalescing_enabled:
+            return await upstream()
+        flight_key = payload_fingerprint(url, payload)
+        if payload.get("stream"):
+            return await self.coalescer.stream(
+                flight_key, upstream, settings.request_coalescing_buffer
+            )
+        return await self.coalescer.call(flight_key, upstream)
+
+
+def record_usage(model: Optional[str], usage: Optional[Mapping[str, Any]]) -> None:
+    """按模型记录上游 usage 中的输入与输出 token 数（模型标签取值有界）"""
+    if not usage:
+        return
+    label = metrics.model_labels(model)
+    metrics.tokens_total.inc(label, "input", amount=usage.get("prompt_tokens") or 0)
+    metrics.tokens_total.inc(
+        label, "output", amount=usage.get("completion_tokens") or 0
+    )
 
 
 class ResponseProcessor:
     """响应处理服务"""
 
     def process_response(
-        self, lm_resp: Dict[str, Any], target_model: str
+        self, lm_resp: Dict[str, Any], target_model: str, native_tools: bool = False
     ) -> Dict[str, Any]:
-        """处理模型响应，转换为Anthropic格式"""
-        logger.setLevel(settings.log_level)
+        """处理模型响应，转换为Anthropic格式
+
+        响应中的原生 tool_calls 直接转换为 tool_use 块；native_tools 为 True 时
+        不再从文本中解析工具调用。
+        """
+        logger.setLevel(config_manager.settings.log_level)
         content_blocks = []
 
         logger.debug(f"原始响应内容: {lm_resp}")
@@ -212,16 +2540,24 @@ class ResponseProcessor:
             content = msg.get("content", "")
 
             # 检查是否包含工具调用
-            tool_calls, content = parse_tool_calls_from_response(content)
+            if msg.get("tool_calls"):
+                tool_calls = msg["tool_calls"]
+                content = content or ""
+            elif native_tools:
+                tool_calls = []
+            else:
+                tool_calls, content = parse_tool_calls_from_response(content)
 
             if tool_calls:
                 # 有工具调用，转换为Anthropic格式
                 logger.info(f"在响应中找到 {len(tool_calls)} 个工具调用")
 
-                # 先添加可能存在的文本内容
-                text_content = re.sub(
-                    r"```json.*?```", "", content, flags=re.DOTALL
-                ).strip()
+                # 先添加可能存在的文本内容；仅提示词模拟模式下去掉 ```json 代码块
+                text_content = content.strip()
+                if not native_tools:
+                    text_content = re.sub(
+                        r"```json.*?```", "", text_content, flags=re.DOTALL
+                    ).strip()
                 if text_content:
                     content_blocks.append({"type": "text", "text": text_content})
 
@@ -255,8 +2591,6 @@ class ResponseProcessor:
                     content_blocks.append({"type": "text", "text": content})
 
         # 构建Anthropic格式响应
-        import time
-
         anthropic_resp = {
             "id": lm_resp.get("id") or f"msg_{int(time.time())}",
             "type": "message",
@@ -275,8 +2609,299 @@ class ResponseProcessor:
             "content": content_blocks or [{"type": "text", "text": ""}],
         }
 
+        record_usage(target_model, lm_resp.get("usage"))
         logger.info(f"返回响应: {len(content_blocks)} 个块")
         logger.debug(
             f"响应内容: {json.dumps(anthropic_resp, ensure_ascii=False, indent=2)}"
         )
         return anthropic_resp
+
+
+class AnthropicStreamBuilder:
+    """按 Anthropic 流式协议组装 SSE 事件，负责内容块的编号、开启与关闭"""
+
+    def __init__(self, message_id: str, model: str) -> None:
+        self.message_id = message_id
+        self.model = model
+        self.index = -1
+        self.open_block: Optional[str] = None
+        self.has_tool_use = False
+        # 尚未开启文本块时收到的纯空白文本，避免产生空白文本块
+        self._pending_ws = ""
+
+    def message_start(self, input_tokens: int = 0) -> bytes:
+        return format_sse(
+            "message_start",
+            {
+                "type": "message_start",
+                "message": {
+                    "id": self.message_id,
+                    "type": "message",
+                    "role": "assistant",
+                    "model": self.model,
+                    "content": [],
+                    "stop_reason": None,
+                    "stop_sequence": None,
+                    "usage": {"input_tokens": input_tokens, "output_tokens": 0},
+                },
+            },
+        )
+
+    def _start_block(self, block: Dict[str, Any]) -> List[bytes]:
+        out = self.close_block()
+        self.index += 1
+        self.open_block = block["type"]
+        out.append(
+            format_sse(
+                "content_block_start",
+                {
+                    "type": "content_block_start",
+                    "index": self.index,
+                    "content_block": block,
+                },
+            )
+        )
+        return out
+
+    def _delta(self, delta: Dict[str, Any], index: Optional[int] = None) -> bytes:
+        return format_sse(
+            "content_block_delta",
+            {
+                "type": "content_block_delta",
+                "index": self.index if index is None else index,
+                "delta": delta,
+            },
+        )
+
+    def close_block(self) -> List[bytes]:
+        """关闭当前内容块"""
+        if self.open_block is None:
+            return []
+        self.open_block = None
+        return [
+            format_sse(
+                "content_block_stop",
+                {"type": "content_block_stop", "index": self.index},
+            )
+        ]
+
+    def text(self, text: str) -> List[bytes]:
+        """产出文本增量，必要时开启新的文本块"""
+        out: List[bytes] = []
+        if self.open_block != "text":
+            if not text.strip():
+                self._pending_ws += text
+                return out
+            text = self._pending_ws + text
+            self._pending_ws = ""
+            out.extend(self._start_block({"type": "text", "text": ""}))
+        out.append(self._delta({"type": "text_delta", "text": text}))
+        return out
+
+    def tool_start(self, tool_id: str, name: str) -> List[bytes]:
+        """开启工具调用块"""
+        self._pending_ws = ""
+        self.has_tool_use = True
+        return self._start_block(
+            {"type": "tool_use", "id": tool_id, "name": name, "input": {}}
+        )
+
+    def input_json(self, partial_json: str, index: Optional[int] = None) -> List[bytes]:
+        """产出工具调用参数的 JSON 增量，index 为空时写入当前内容块"""
+        return [
+            self._delta(
+                {"type": "input_json_delta", "partial_json": partial_json}, index
+            )
+        ]
+
+    def parser_events(self, events: List[Dict[str, Any]]) -> List[bytes]:
+        """将增量解析器产出的事件转换为 SSE 事件"""
+        out: List[bytes] = []
+        for ev in events:
+            if ev["type"] == "text":
+                out.extend(self.text(ev["text"]))
+            elif ev["type"] == "tool_use_start":
+                out.extend(self.tool_start(ev["id"], ev["name"]))
+            elif ev["type"] == "input_json_delta":
+                out.extend(self.input_json(ev["partial_json"]))
+            elif ev["type"] == "tool_use_stop":
+                out.extend(self.close_block())
+        return out
+
+    def finish(
+        self, finish_reason: Optional[str], output_tokens: int = 0
+    ) -> List[bytes]:
+        """关闭所有内容块并结束消息"""
+        out = self.close_block()
+        if self.index < 0:
+            # 保证至少有一个内容块，与非流式响应保持一致
+            out.extend(self._start_block({"type": "text", "text": ""}))
+            out.extend(self.close_block())
+        if self.has_tool_use:
+            stop_reason = "tool_use"
+        elif finish_reason == "length":
+            stop_reason = "max_tokens"
+        else:
+            stop_reason = "end_turn"
+        out.append(
+            format_sse(
+                "message_delta",
+                {
+                    "type": "message_delta",
+                    "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+                    "usage": {"output_tokens": output_tokens},
+                },
+            )
+        )
+        out.append(format_sse("message_stop", {"type": "message_stop"}))
+        return out
+
+
+class StreamTimer:
+    """流式响应计时
+
+    包装上游分块流，记录从请求到达到首个分块的延迟（TTFT）、分块间隔、
+    流总时长与输出速率，按后端地址与模型分类；客户端提前断开时计入断开次数。
+    输出 token 数优先取上游 usage，未返回时按分块数估算。
+    """
+
+    def __init__(self, stream: Any, model: Optional[str], started: float) -> None:
+        self.stream = stream
+        # 模型名可能来自客户端请求，标签取值有界
+        self.model = metrics.model_labels(model)
+        self.started = started
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+        self.chunk_count = 0
+        self.output_tokens: Optional[int] = None
+        self._labels: Tuple[str, str] = ("unknown", self.model)
+
+    @property
+    def backend(self) -> str:
+        return getattr(self.stream, "backend", None) or "unknown"
+
+    async def chunks(self) -> AsyncIterator[Any]:
+        """逐个返回上游分块并计时"""
+        async for chunk in self.stream:
+            now = time.perf_counter()
+            if self.last is None:
+                # 共享流与降级目标的后端地址在首个分块到达后才确定
+                self._labels = (self.backend, self.model)
+                self.first = now
+                metrics.stream_ttft.observe(now - self.started, *self._labels)
+            else:
+                metrics.stream_chunk_gap.observe(now - self.last, *self._labels)
+            self.last = now
+            self.chunk_count += 1
+            usage = (
+                chunk.get("usage")
+                if isinstance(chunk, dict)
+                else getattr(chunk, "usage", None)
+            )
+            if usage:
+                tokens = (
+                    usage.get("completion_tokens")
+                    if isinstance(usage, dict)
+                    else getattr(usage, "completion_tokens", None)
+                )
+                if tokens:
+                    self.output_tokens = tokens
+            yield chunk
+
+    def finish(self, disconnected: bool) -> None:
+        """流结束（完成、出错或客户端断开）时记录总时长与输出速率"""
+        labels = self._labels
+        if self.first is None:
+            labels = (self.backend, self.model)
+        metrics.stream_duration.observe(time.perf_counter() - self.started, *labels)
+        if disconnected:
+            metrics.stream_disconnects.inc(*labels)
+            return
+        if self.first is not None and self.last is not None:
+            elapsed = self.last - self.first
+            tokens = self.output_tokens or self.chunk_count
+            if elapsed > 0 and tokens > 1:
+                metrics.stream_tokens_per_second.observe(tokens / elapsed, *labels)
+
+
+class StreamProcessor:
+    """流式响应处理服务：将 OpenAI 流式分块转换为 Anthropic SSE 事件
+
+    文本增量立即转发；```json 形式的工具调用由增量解析器识别，
+    以 tool_use 块和 input_json_delta 增量的形式产出。
+    """
+
+    async def process_stream(
+        self, stream: AsyncIterator[Any], target_model: str, native_tools: bool = False
+    ) -> AsyncIterator[bytes]:
+        """逐块转换模型流式响应
+
+        原生 tool_calls 增量按 index 开启 tool_use 块并转发参数增量，
+        参数增量始终写入该工具调用自己的内容块；
+        native_tools 为 True 时文本直接转发，不再经过增量解析器，
+        工具调用块开启期间收到的文本暂存，待工具调用结束后作为文本块输出。
+        """
+        parser = IncrementalToolCallParser()
+        builder: Optional[AnthropicStreamBuilder] = None
+        finish_reason: Optional[str] = None
+        usage: Dict[str, Any] = {}
+        # 当前正在转发的原生工具调用 index
+        tool_index: Optional[int] = None
+        # 原生工具调用 index -> 内容块 index
+        tool_blocks: Dict[int, int] = {}
+        # 原生工具调用块开启期间收到的文本
+        held_text: List[str] = []
+
+        async for chunk in stream:
+            data = chunk.model_dump() if hasattr(chunk, "model_dump") else chunk
+            if builder is None:
+                builder = AnthropicStreamBuilder(
+                    data.get("id") or f"msg_{int(time.time())}",
+                    data.get("model") or target_model,
+                )
+                yield builder.message_start()
+            if data.get("usage"):
+                usage = data["usage"]
+            for choice in data.get("choices") or []:
+                delta = choice.get("delta") or {}
+                content = delta.get("content")
+                if content:
+                    if native_tools and tool_index is not None:
+                        held_text.append(content)
+                    elif native_tools:
+                        for event in builder.text(content):
+                            yield event
+                    else:
+                        for event in builder.parser_events(parser.feed(content)):
+                            yield event
+                for tc in delta.get("tool_calls") or []:
+                    func = tc.get("function") or {}
+                    index = tc.get("index", 0)
+                    if index not in tool_blocks:
+                        tool_index = index
+                        tool_id = tc.get("id") or f"call_{int(time.time())}_{index}"
+                        for event in builder.tool_start(
+                            tool_id, func.get("name") or ""
+                        ):
+                            yield event
+                        tool_blocks[index] = builder.index
+                    if func.get("arguments"):
+                        for event in builder.input_json(
+                            func["arguments"], tool_blocks[index]
+                        ):
+                            yield event
+                if choice.get("finish_reason"):
+                    finish_reason = choice["finish_reason"]
+
+        if builder is None:
+            builder = AnthropicStreamBuilder(f"msg_{int(time.time())}", target_model)
+            yield builder.message_start()
+        if held_text:
+            for event in builder.text("".join(held_text)):
+                yield event
+        for event in builder.parser_events(parser.close()):
+            yield event
+        for event in builder.finish(finish_reason, usage.get("completion_tokens") or 0):
+            yield event
+        record_usage(target_model, usage)
+        logger.info(f"流式响应结束，共 {builder.index + 1} 个块")
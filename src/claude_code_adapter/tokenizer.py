@@ -0,0 +1,216 @@
+"""
+本地 token 计数模块
+提供可插拔的分词器（校准后的启发式估算，或从本地文件加载的字节级 BPE），
+并按消息内容缓存计数结果，无需调用上游服务。
+"""
+
+import abc
+import base64
+import hashlib
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import Settings
+from .utils import LRUCache, estimate_message_tokens, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class Tokenizer(abc.ABC):
+    """分词器基类：只需实现文本的 token 计数"""
+
+    name = "base"
+
+    @abc.abstractmethod
+    def count(self, text: str) -> int:
+        """返回文本的 token 数"""
+
+
+class HeuristicTokenizer(Tokenizer):
+    """启发式分词器：即 ``utils.estimate_tokens``，比例可按目标模型校准"""
+
+    name = "heuristic"
+
+    def __init__(
+        self, chars_per_token: float = 4.0, cjk_tokens_per_char: float = 1.0
+    ) -> None:
+        self.chars_per_token = chars_per_token if chars_per_token > 0 else 4.0
+        self.cjk_tokens_per_char = cjk_tokens_per_char
+
+    def count(self, text: str) -> int:
+        return estimate_tokens(text, self.chars_per_token, self.cjk_tokens_per_char)
+
+
+class BPETokenizer(Tokenizer):
+    """字节级 BPE 分词器
+
+    词表为 tiktoken 格式的本地文件（每行 ``<base64 token> <rank>``）。
+    文本先按正则预切分，每个片段的 token 数单独缓存：代码与对话中的片段
+    高度重复，命中缓存时无需重新合并。
+    """
+
+    name = "bpe"
+
+    # 近似 cl100k 的预切分规则（标准库 re 不支持 \p{L}，以 [^\W\d_] 表示字母）
+    PATTERN = re.compile(
+        r"'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+[\r\n]*"
+        r"|\s*[\r\n]+|\s+(?!\S)|\s+"
+    )
+
+    def __init__(self, ranks: Dict[bytes, int], piece_cache_size: int = 65536) -> None:
+        self.ranks = ranks
+        self.piece_cache_size = piece_cache_size
+        self._pieces: Dict[str, int] = {}
+
+    @classmethod
+    def from_file(cls, path: str) -> "BPETokenizer":
+        """从 tiktoken 格式的词表文件加载"""
+        ranks: Dict[bytes, int] = {}
+        with open(path, "rb") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    ranks[base64.b64decode(parts[0])] = int(parts[1])
+        if not ranks:
+            raise ValueError(f"词表文件为空: {path}")
+        logger.info(f"加载 BPE 词表: {path}，共 {len(ranks)} 个 token")
+        return cls(ranks)
+
+    def _merge_count(self, piece: bytes) -> int:
+        """按合并优先级（rank 越小越先合并）合并字节对，返回 token 数"""
+        if piece in self.ranks:
+            return 1
+        parts = [piece[i : i + 1] for i in range(len(piece))]
+        ranks = self.ranks
+        while len(parts) > 1:
+            best_rank: Optional[int] = None
+            best_i = -1
+            for i in range(len(parts) - 1):
+                rank = ranks.get(parts[i] + parts[i + 1])
+                if rank is not None and (best_rank is None or rank < best_rank):
+                    best_rank = rank
+                    best_i = i
+            if best_rank is None:
+                break
+            parts[best_i : best_i + 2] = [parts[best_i] + parts[best_i + 1]]
+        return len(parts)
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        pieces = self._pieces
+        total = 0
+        for piece in self.PATTERN.findall(text):
+            n = pieces.get(piece)
+            if n is None:
+                n = self._merge_count(piece.encode("utf-8"))
+                if len(pieces) >= self.piece_cache_size:
+                    pieces.clear()
+                pieces[piece] = n
+            total += n
+        return total
+
+
+class TokenCounter:
+    """消息 token 计数服务
+
+    每条 OpenAI 格式消息的计数按内容缓存：Claude Code 每轮重发完整历史，
+    除新增消息外都能直接命中缓存。缓存键为消息内容的 BLAKE2 摘要，
+    缓存不持有消息正文。计数规则与 ``utils.estimate_message_tokens`` 相同，
+    只是文本部分交给所配置的分词器。
+    """
+
+    def __init__(self, tokenizer: Tokenizer, cache_size: int = 4096) -> None:
+        self.tokenizer = tokenizer
+        self._cache: LRUCache[bytes, int] = LRUCache(cache_size)
+
+    def count_text(self, text: str) -> int:
+        return self.tokenizer.count(text)
+
+    @staticmethod
+    def _digest(*parts: Any) -> bytes:
+        h = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            if not isinstance(part, str):
+                part = json.dumps(part, ensure_ascii=False, separators=(",", ":"))
+            h.update(part.encode("utf-8", "surrogatepass"))
+            h.update(b"\0")
+        return h.digest()
+
+    @classmethod
+    def _cache_key(cls, message: Dict[str, Any]) -> bytes:
+        return cls._digest(
+            "message",
+            message.get("role"),
+            message.get("content"),
+            message.get("tool_calls"),
+            message.get("tool_call_id"),
+        )
+
+    def count_message(self, message: Dict[str, Any]) -> int:
+        """计算一条 OpenAI 格式消息的 token 数"""
+        key = self._cache_key(message)
+        tokens = self._cache.get(key)
+        if tokens is None:
+            tokens = estimate_message_tokens(message, self.tokenizer.count)
+            self._cache.put(key, tokens)
+        return tokens
+
+    def count_messages(self, messages: List[Dict[str, Any]]) -> int:
+        return sum(self.count_message(m) for m in messages)
+
+    def count_tools(self, tools: List[Dict[str, Any]]) -> int:
+        """计算 OpenAI tools 字段的 token 数"""
+        if not tools:
+            return 0
+        raw = json.dumps(tools, ensure_ascii=False, separators=(",", ":"))
+        key = self._digest("tools", raw)
+        tokens = self._cache.get(key)
+        if tokens is None:
+            tokens = self.tokenizer.count(raw)
+            self._cache.put(key, tokens)
+        return tokens
+
+    def stats(self) -> Dict[str, int]:
+        """返回缓存统计信息"""
+        return self._cache.stats()
+
+
+def create_tokenizer(settings: Settings) -> Tokenizer:
+    """按配置创建分词器，BPE 词表加载失败时回退到启发式估算"""
+    if settings.tokenizer.lower() == "bpe":
+        if settings.tokenizer_file:
+            try:
+                return BPETokenizer.from_file(settings.tokenizer_file)
+            except Exception as e:
+                logger.exception(f"加载 BPE 词表失败，回退到启发式估算: {e}")
+        else:
+            logger.warning("未配置 tokenizer_file，回退到启发式估算")
+    return HeuristicTokenizer(
+        settings.tokenizer_chars_per_token, settings.tokenizer_cjk_tokens_per_char
+    )
+
+
+_counters: Dict[Tuple[Any, ...], TokenCounter] = {}
+
+
+def get_token_counter(settings: Settings) -> TokenCounter:
+    """获取当前配置对应的计数服务（相同分词器配置复用同一实例及其缓存）"""
+    key = (
+        settings.tokenizer.lower(),
+        settings.tokenizer_file,
+        settings.tokenizer_chars_per_token,
+        settings.tokenizer_cjk_tokens_per_char,
+        settings.token_count_cache_size,
+    )
+    counter = _counters.get(key)
+    if counter is None:
+        # 配置变更后旧的计数服务不再使用，直接替换
+        _counters.clear()
+        counter = TokenCounter(
+            create_tokenizer(settings), settings.token_count_cache_size
+        )
+        _counters[key] = counter
+    return counter
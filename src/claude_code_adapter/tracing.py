@@ -0,0 +1,361 @@
+"""
+请求级追踪模块
+以请求 ID 串联一次请求内的嵌套 span（耗时与属性），请求结束后整体交给本地导出器：
+内存环形缓冲区（由 /traces 端点查询）与可选的 JSONL 文件，也可注册自定义导出器。
+未启用追踪时 span 为空操作，不产生额外开销。
+"""
+
+import abc
+import contextlib
+import contextvars
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Optional, Sequence
+
+from .config import Settings
+
+logger = logging.getLogger(__name__)
+
+# 当前请求的请求 ID（来自请求头或自动生成），由 RequestIdMiddleware 设置
+current_request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "current_request_id", default=None
+)
+
+
+class Trace:
+    """一次请求的追踪：已结束的 span 记录与请求 ID"""
+
+    def __init__(self, request_id: str) -> None:
+        self.request_id = request_id
+        self.spans: List[Dict[str, Any]] = []
+        self.exported = False
+
+
+class Span:
+    """追踪中的一个 span：名称、父 span、起止时间、属性与错误"""
+
+    recording = True
+
+    def __init__(
+        self,
+        name: str,
+        trace: Optional[Trace],
+        parent_id: Optional[str] = None,
+        attributes: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self.name = name
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes: Dict[str, Any] = attributes or {}
+        self.error: Optional[str] = None
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration: Optional[float] = None
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def record_error(self, error: BaseException) -> None:
+        self.error = f"{type(error).__name__}: {error}"
+
+    def end(self) -> None:
+        """结束 span（只生效一次），记录到所属追踪中"""
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._start
+        if self.trace is not None and not self.trace.exported:
+            self.trace.spans.append(self.to_dict())
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start_time,
+            "duration_ms": round((self.duration or 0.0) * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _NoopSpan(Span):
+    """未启用追踪时使用的空 span"""
+
+    recording = False
+
+    def __init__(self) -> None:
+        super().__init__("noop", None)
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+    def record_error(self, error: BaseException) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+
+NOOP_SPAN: Span = _NoopSpan()
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+class TraceExporter(abc.ABC):
+    """导出器基类：接收一次请求的完整追踪
+
+    ``export`` 在事件循环中调用，耗时的导出应自行转交后台线程。
+    """
+
+    @abc.abstractmethod
+    def export(self, trace: Dict[str, Any]) -> None:
+        """导出一条追踪"""
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryExporter(TraceExporter):
+    """内存环形缓冲区，保留最近的 maxsize 条追踪"""
+
+    def __init__(self, maxsize: int = 200) -> None:
+        self.traces: Deque[Dict[str, Any]] = deque(maxlen=max(maxsize, 1))
+
+    def resize(self, maxsize: int) -> None:
+        if self.traces.maxlen != max(maxsize, 1):
+            self.traces = deque(self.traces, maxlen=max(maxsize, 1))
+
+    def export(self, trace: Dict[str, Any]) -> None:
+        self.traces.append(trace)
+
+    def recent(
+        self, limit: int = 20, min_duration_ms: float = 0.0
+    ) -> List[Dict[str, Any]]:
+        """按时间倒序返回最近的追踪，可按最短耗时过滤"""
+        result = []
+        for trace in reversed(self.traces):
+            if trace["duration_ms"] >= min_duration_ms:
+                result.append(trace)
+                if len(result) >= limit:
+                    break
+        return result
+
+    def get(self, request_id: str) -> Optional[Dict[str, Any]]:
+        for trace in reversed(self.traces):
+            if trace["request_id"] == request_id:
+                return trace
+        return None
+
+
+class JsonlExporter(TraceExporter):
+    """追加写入 JSONL 文件，每行一条追踪
+
+    事件循环只把追踪放入有界队列，序列化与写入由后台线程批量完成；
+    队列已满（磁盘过慢）时丢弃追踪并计数，不阻塞请求。
+    """
+
+    QUEUE_SIZE = 1024
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.dropped = 0
+        self._file = open(path, "a", encoding="utf-8")
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(
+            self.QUEUE_SIZE
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="trace-writer", daemon=True
+        )
+        self._thread.start()
+
+    def export(self, trace: Dict[str, Any]) -> None:
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                logger.warning(f"追踪写入队列已满，已丢弃 {self.dropped} 条追踪")
+
+    def _run(self) -> None:
+        """后台写入：取出队列中已有的全部追踪后一次写入并刷新，收到 None 时退出"""
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                running = False
+            try:
+                self._file.write(
+                    "".join(
+                        json.dumps(trace, ensure_ascii=False, default=str) + "\n"
+                        for trace in batch
+                    )
+                )
+                self._file.flush()
+            except (OSError, TypeError, ValueError) as e:
+                logger.warning(f"写入追踪文件失败 {self.path}: {e}")
+        self._file.close()
+
+    def close(self) -> None:
+        """写完已排队的追踪后关闭文件"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+
+class Tracer:
+    """追踪器
+
+    请求入口调用 ``start_trace`` 创建根 span，其余代码用 ``span()`` 创建子 span；
+    根 span 结束时，耗时达到 ``tracing_slow_threshold`` 的追踪交给各导出器。
+    ``add_exporter`` 可注册自定义导出器。
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.slow_threshold = 0.0
+        self.memory = MemoryExporter()
+        self.exporters: List[TraceExporter] = []
+        self._file_exporter: Optional[JsonlExporter] = None
+
+    def configure(self, settings: Settings) -> None:
+        """应用当前配置（配置未变化时只做比较）"""
+        self.enabled = settings.tracing_enabled
+        self.slow_threshold = settings.tracing_slow_threshold
+        self.memory.resize(settings.tracing_buffer_size)
+        path = settings.tracing_file if self.enabled else None
+        current = self._file_exporter.path if self._file_exporter else None
+        if path != current:
+            if self._file_exporter is not None:
+                self._file_exporter.close()
+                self._file_exporter = None
+            if path:
+                try:
+                    self._file_exporter = JsonlExporter(path)
+                except OSError as e:
+                    logger.warning(f"打开追踪文件失败 {path}: {e}")
+
+    def add_exporter(self, exporter: TraceExporter) -> None:
+        self.exporters.append(exporter)
+
+    def start_trace(self, name: str, **attributes: Any) -> Span:
+        """为当前请求创建根 span 并设为当前 span，未启用追踪时返回空 span"""
+        if not self.enabled:
+            return NOOP_SPAN
+        request_id = current_request_id.get() or uuid.uuid4().hex
+        root = Span(name, Trace(request_id), attributes=attributes)
+        _current_span.set(root)
+        return root
+
+    def finish_trace(self, root: Span) -> None:
+        """结束根 span 并导出整条追踪"""
+        if not root.recording or root.trace is None or root.trace.exported:
+            return
+        root.end()
+        trace = root.trace
+        trace.exported = True
+        duration = root.duration or 0.0
+        if duration < self.slow_threshold:
+            return
+        record = {
+            "request_id": trace.request_id,
+            "name": root.name,
+            "start": root.start_time,
+            "duration_ms": round(duration * 1000, 3),
+            "error": root.error,
+            "spans": sorted(trace.spans, key=lambda s: s["start"]),
+        }
+        exporters: List[TraceExporter] = [self.memory, *self.exporters]
+        if self._file_exporter is not None:
+            exporters.append(self._file_exporter)
+        for exporter in exporters:
+            try:
+                exporter.export(record)
+            except Exception as e:
+                logger.warning(f"导出追踪失败: {e}")
+
+    def start_span(
+        self, name: str, parent: Optional[Span] = None, **attributes: Any
+    ) -> Span:
+        """创建子 span 但不设为当前 span，由调用方负责 ``end()``
+
+        父 span 默认为当前 span，不在追踪中时返回空 span。适用于跨越多次
+        yield 的流式响应等无法使用 ``with`` 的场景。
+        """
+        parent = parent or _current_span.get()
+        if parent is None or not parent.recording:
+            return NOOP_SPAN
+        return Span(name, parent.trace, parent.span_id, attributes)
+
+    @contextlib.contextmanager
+    def span(
+        self, name: str, parent: Optional[Span] = None, **attributes: Any
+    ) -> Iterator[Span]:
+        """创建子 span 并在 with 块内设为当前 span；不在追踪中时返回空 span"""
+        child = self.start_span(name, parent, **attributes)
+        if not child.recording:
+            yield child
+            return
+        token = _current_span.set(child)
+        try:
+            yield child
+        except BaseException as e:
+            child.record_error(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            child.end()
+
+    def close(self) -> None:
+        if self._file_exporter is not None:
+            self._file_exporter.close()
+            self._file_exporter = None
+
+
+class RequestIdMiddleware:
+    """ASGI 中间件：从请求头读取请求 ID（缺失时生成），写入上下文并回写到响应头"""
+
+    def __init__(self, app: Any, paths: Sequence[str], header: Any) -> None:
+        self.app = app
+        self.paths = frozenset(paths)
+        # 返回请求头名称的回调，配置变更后无需重建中间件
+        self.header = header
+
+    async def __call__(self, scope: Any, receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or scope.get("path") not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        name = self.header().lower().encode("latin-1")
+        request_id = ""
+        for key, value in scope.get("headers") or []:
+            if key == name:
+                request_id = value.decode("latin-1")[:128]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        current_request_id.set(request_id)
+
+        async def send_wrapper(message: Any) -> None:
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers") or [])
+                headers.append((name, request_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+# 全局追踪器
+tracer = Tracer()
@@ -2,17 +2,133 @@
 工具函数模块
 """
 
+import hashlib
 import json
 import logging
+import math
 import re
+import threading
 import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import Any, Dict, List, Tuple, cast
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    cast,
+)
 
-from .config import settings
+from .config import config_manager
 
 logger = logging.getLogger(__name__)
 
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """有界 LRU 缓存，可选条目过期时间（秒），记录命中与未命中次数
+
+    指定 ``weigher`` 与 ``maxweight`` 时，除条目数外还限制条目权重之和
+    （如缓存的消息条数），超出时同样淘汰最久未使用的条目。
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: Optional[float] = None,
+        maxweight: int = 0,
+        weigher: Optional[Callable[[V], int]] = None,
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight if weigher is not None else 0
+        self.weigher = weigher
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[K, Tuple[float, V]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _weigh(self, value: V) -> int:
+        return self.weigher(value) if self.weigher is not None else 0
+
+    def get(self, key: K) -> Optional[V]:
+        """读取缓存，命中时将其移动到最近使用位置，过期条目视为未命中"""
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.weight -= self._weigh(value)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key: K) -> Optional[V]:
+        """读取缓存但不更新使用顺序与命中统计"""
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def put(self, key: K, value: V) -> None:
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else math.inf
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.weight -= self._weigh(previous[1])
+            self._data[key] = (expires_at, value)
+            self.weight += self._weigh(value)
+            while len(self._data) > self.maxsize or (
+                self.maxweight and self.weight > self.maxweight and self._data
+            ):
+                _, (_, evicted) = self._data.popitem(last=False)
+                self.weight -= self._weigh(evicted)
+
+    def clear(self) -> None:
+        """清空缓存及统计"""
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        """返回缓存统计信息"""
+        stats = {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+        if self.maxweight:
+            stats["weight"] = self.weight
+            stats["maxweight"] = self.maxweight
+        return stats
+
 
 def flatten_content(content: Any) -> Any:
     """将复杂内容结构扁平化为字符串，仅支持文本和工具调用结果类型"""
@@ -26,17 +142,7 @@ def flatten_content(content: Any) -> Any:
         elif content.get("type") == "tool_result":
             # 处理工具调用结果
             tool_id = content.get("tool_use_id", "unknown")
-            result_content = content.get("content", "")
-            if isinstance(result_content, list):
-                result_text = ""
-                for item in result_content:
-                    if isinstance(item, dict) and item.get("type") == "text":
-                        result_text += item.get("text", "")
-                    else:
-                        result_text += str(item)
-            else:
-                result_text = str(result_content)
-            return f"Tool {tool_id} result: {result_text}"
+            return f"Tool {tool_id} result: {tool_result_text(content)}"
         # 其他类型的内容暂不处理，返回空字符串，避免LLM无法理解的内容浪费token
         return ""
     if isinstance(content, list):
@@ -48,55 +154,183 @@ def flatten_content(content: Any) -> Any:
     return ""
 
 
+def tool_result_text(block: Dict[str, Any]) -> str:
+    """提取 tool_result 块中的结果文本"""
+    result_content = block.get("content", "")
+    if isinstance(result_content, list):
+        result_text = ""
+        for item in result_content:
+            if isinstance(item, dict) and item.get("type") == "text":
+                result_text += item.get("text", "")
+            else:
+                result_text += str(item)
+    else:
+        result_text = str(result_content)
+    return result_text
+
+
+# 工具提示词缓存：Claude Code 每轮都会发送相同的工具定义
+TOOL_PROMPT_CACHE_SIZE = 32
+_tool_prompt_cache: LRUCache[Tuple[str, str], str] = LRUCache(TOOL_PROMPT_CACHE_SIZE)
+
+
+def tools_fingerprint(tools: List[Dict[str, Any]]) -> str:
+    """计算工具列表的稳定指纹（保留字段顺序，与渲染结果一一对应）"""
+    # 紧凑格式走 C 编码器，远快于带缩进的渲染
+    raw = json.dumps(tools, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def payload_fingerprint(url: str, payload: Dict[str, Any]) -> str:
+    """上游调用的规范化指纹：地址与按键排序的 payload"""
+    raw = json.dumps(
+        [url, payload], ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def prefix_affinity_key(
+    messages: List[Dict[str, Any]],
+    turns: int,
+    exclude: Optional[Dict[str, Any]] = None,
+) -> str:
+    """前缀亲和键：系统提示词与前 turns 条用户消息的哈希
+
+    只包含到第 turns 条用户消息为止，同一会话后续轮次的键保持不变。
+    exclude 为不参与哈希的消息（按对象身份比较），用于排除每轮变化的
+    工具选择提示词。tools 字段不参与哈希：启用工具选择时所选工具每轮不同，
+    加入后同一会话会在节点间来回切换；tools 变化时节点上的前缀缓存只能
+    复用到 tools 之前的部分，这是为会话粘性所做的取舍。
+    """
+    h = hashlib.sha1()
+    seen = 0
+    for message in messages:
+        if message is exclude:
+            continue
+        content = message.get("content")
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False, separators=(",", ":"))
+        h.update(f"{message.get('role')}\0{content}\0".encode("utf-8"))
+        if message.get("role") == "user":
+            seen += 1
+            if seen >= turns:
+                break
+    return h.hexdigest()
+
+
 def convert_tools_to_prompt(tools: List[Dict[str, Any]], template: str) -> str:
-    """将工具定义转换为提示词"""
+    """将工具定义转换为提示词，相同工具列表与模板的结果会被缓存"""
     if not tools:
         return ""
 
+    cache_key = (tools_fingerprint(tools), template)
+    cached = _tool_prompt_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     tools_json = json.dumps(tools, indent=2, ensure_ascii=False)
     # 使用 replace 方法避免 format() 的花括号冲突问题
-    return template.replace("{tools_json}", tools_json)
+    prompt = template.replace("{tools_json}", tools_json)
+    _tool_prompt_cache.put(cache_key, prompt)
+    return prompt
 
 
-def extract_json_objects(text: str, mode: str = "object") -> List[Tuple[str, int, int]]:
-    """
-    从文本中提取所有 JSON 对象或数组（支持嵌套）。
-    mode: "object" 只提取 {...}，"array" 只提取 [...]
-    返回: [(json_str, start_idx, end_idx), ...]
-    """
-    results = []
+def tool_prompt_cache_stats() -> Dict[str, int]:
+    """工具提示词缓存的命中统计"""
+    return _tool_prompt_cache.stats()
 
-    # 先处理 ```json ... ``` 包裹的情况
-    fenced_matches = list(
-        re.finditer(r"```\s*json\s*([\s\S]*?)```", text, re.MULTILINE)
-    )
-    for m in fenced_matches:
-        json_str = m.group(1).strip()
-        results.append((json_str, m.start(), m.end()))
-
-    # 如果 fenced code block 里已经有了 JSON，就不再从裸文本里重复找
-    if results:
-        return results
-
-    # 裸 JSON 扫描器
-    stack: list[str] = []
-    start_idx = None
-    opening_char = "{" if mode == "object" else "["
-    closing_char = "}" if mode == "object" else "]"
-
-    for i, ch in enumerate(text):
-        if ch == opening_char:
-            if not stack:
-                start_idx = i
-            stack.append(ch)
-        elif ch == closing_char:
-            if not stack:
-                continue
-            stack.pop()
-            if not stack and start_idx is not None:
-                results.append((text[start_idx : i + 1], start_idx, i + 1))
-                start_idx = None
-    return results
+
+def supports_native_tools(
+    model_name: Optional[str], model_prefixes: Sequence[str]
+) -> bool:
+    """目标模型是否使用原生函数调用（按模型名称前缀匹配，"*" 匹配所有模型）"""
+    name = (model_name or "").lower()
+    return any(p == "*" or name.startswith(p.lower()) for p in model_prefixes if p)
+
+
+def lookup_model_value(model_name: Optional[str], values: Mapping[str, Any]) -> Any:
+    """按模型名称前缀查找配置值：最长前缀优先，"*" 作为默认值，未匹配时返回 None"""
+    name = (model_name or "").lower()
+    best: Optional[str] = None
+    for prefix in values:
+        if prefix != "*" and name.startswith(prefix.lower()):
+            if best is None or len(prefix) > len(best):
+                best = prefix
+    if best is not None:
+        return values[best]
+    return values.get("*")
+
+
+# 中日韩字符（约一个字符一个 token），其余字符按约 4 个字符一个 token 估算
+CJK_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]")
+# 每条消息的格式开销（角色与分隔符）
+MESSAGE_TOKEN_OVERHEAD = 4
+# 图片等非文本内容按固定 token 数估算
+MEDIA_TOKEN_ESTIMATE = 765
+
+
+def estimate_tokens(
+    text: str, chars_per_token: float = 4.0, cjk_tokens_per_char: float = 1.0
+) -> int:
+    """快速估算文本的 token 数，比例可按目标模型校准"""
+    if not text:
+        return 0
+    if text.isascii():
+        return math.ceil(len(text) / chars_per_token)
+    cjk = len(CJK_RE.findall(text))
+    return math.ceil(cjk * cjk_tokens_per_char + (len(text) - cjk) / chars_per_token)
+
+
+def estimate_message_tokens(
+    message: Dict[str, Any], count: Callable[[str], int] = estimate_tokens
+) -> int:
+    """估算一条 OpenAI 格式消息的 token 数，文本部分由 count 计数"""
+    tokens = MESSAGE_TOKEN_OVERHEAD
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += count(content)
+    elif isinstance(content, list):
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "text":
+                tokens += count(part.get("text", ""))
+            elif part:
+                tokens += MEDIA_TOKEN_ESTIMATE
+    for tc in message.get("tool_calls") or []:
+        func = tc.get("function") or {}
+        tokens += count(func.get("name", ""))
+        tokens += count(func.get("arguments", ""))
+    return tokens
+
+
+def convert_tools_to_openai(tools: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """将 Anthropic 工具定义转换为 OpenAI tools 字段"""
+    converted = []
+    for tool in tools:
+        function: Dict[str, Any] = {"name": tool.get("name", "")}
+        if tool.get("description"):
+            function["description"] = tool["description"]
+        function["parameters"] = tool.get("input_schema") or {
+            "type": "object",
+            "properties": {},
+        }
+        converted.append({"type": "function", "function": function})
+    return converted
+
+
+def convert_tool_choice_to_openai(tool_choice: Any) -> Any:
+    """将 Anthropic tool_choice 转换为 OpenAI tool_choice，无法识别时返回 None"""
+    if not isinstance(tool_choice, dict):
+        return None
+    choice_type = tool_choice.get("type")
+    if choice_type == "auto":
+        return "auto"
+    if choice_type == "any":
+        return "required"
+    if choice_type == "none":
+        return "none"
+    if choice_type == "tool" and tool_choice.get("name"):
+        return {"type": "function", "function": {"name": tool_choice["name"]}}
+    return None
 
 
 def fix_invalid_json(json_str: str) -> str:
@@ -123,39 +357,184 @@ def remove_json_objects(text: str, objects: List[Tuple[str, int, int]]) -> str:
     return "".join(clean_parts).strip()
 
 
+class JsonCandidate(NamedTuple):
+    """文本中的 JSON 候选片段"""
+
+    value: Any
+    start: int
+    end: int
+    fenced: bool
+    valid: bool
+
+
+# 候选起始位置：```json 代码块，或后面紧跟合法 JSON 起始字符的 { / [
+# （预先过滤代码中的括号，避免对其逐一调用解析器）
+_CANDIDATE_RE = re.compile(r"```\s*json|\{\s*[\"'}]|\[\s*[-\d\"'\[{\]tfn]")
+# 单引号修复时的括号匹配：字符串外需要关注的字符
+_LENIENT_START_RE = re.compile(r"[{\[]\s*'")
+_LENIENT_STRUCT_RE = re.compile(r"[{}\[\]\"']")
+# 连续的左括号（嵌套过深时整体跳过，不再逐个尝试）
+_OPENERS_RE = re.compile(r"(?:[{\[]\s*)+")
+_DECODER = json.JSONDecoder()
+# 单段文本中裸 JSON 解析失败的次数上限：超出后只再识别 ```json 代码块，
+# 避免截断或深度嵌套的文本在每个括号处重新解析到末尾（二次方耗时）
+MAX_JSON_DECODE_FAILURES = 32
+
+
+def _decode_lenient(json_str: str) -> Tuple[Any, bool]:
+    """非法 JSON 的兜底解析，仅对疑似工具调用的片段进行单引号修复"""
+    if "tool_use" not in json_str:
+        return None, False
+    try:
+        return json.loads(fix_invalid_json(json_str)), True
+    except json.JSONDecodeError:
+        return None, False
+
+
+def _decode_fenced(content: str) -> Tuple[Any, bool]:
+    """解析代码块内容，要求整体为一个 JSON 值"""
+    content = content.strip()
+    try:
+        value, end = _DECODER.raw_decode(content)
+    except json.JSONDecodeError:
+        return _decode_lenient(content)
+    if end != len(content):
+        return _decode_lenient(content)
+    return value, True
+
+
+def _balanced_end(text: str, start: int) -> int:
+    """从 start 处的括号开始做字符串感知的括号匹配（兼容单引号字符串），
+    返回匹配结束位置，未闭合时返回 -1"""
+    depth = 0
+    pos = start
+    while True:
+        m = _LENIENT_STRUCT_RE.search(text, pos)
+        if m is None:
+            return -1
+        ch = m.group()
+        if ch in "\"'":
+            # 跳过字符串（处理转义）
+            pos = m.end()
+            while True:
+                q = text.find(ch, pos)
+                if q < 0:
+                    return -1
+                backslashes = 0
+                while text[q - 1 - backslashes] == "\\":
+                    backslashes += 1
+                pos = q + 1
+                if backslashes % 2 == 0:
+                    break
+            continue
+        pos = m.end()
+        if ch in "{[":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return pos
+
+
+def iter_json_candidates(text: str) -> Iterator[JsonCandidate]:
+    """单次线性扫描文本，按出现顺序产出 ```json 代码块与裸 JSON 候选
+
+    裸 JSON 直接用 ``JSONDecoder.raw_decode`` 解析，字符串内的括号不会
+    干扰匹配；解析成功后跳过整个片段，不会重复扫描其内部。
+    非法片段仅在疑似工具调用时才尝试单引号修复。单个候选解析出错
+    （包括嵌套过深导致的 RecursionError）只跳过该候选；失败次数超过
+    ``MAX_JSON_DECODE_FAILURES`` 后不再尝试裸 JSON。
+    """
+    pos = 0
+    failures = 0
+    while True:
+        m = _CANDIDATE_RE.search(text, pos)
+        if m is None:
+            return
+        start = m.start()
+
+        if m.group().startswith("`"):
+            close = text.find("```", m.end())
+            if close < 0:
+                # 未闭合的代码块，按裸文本继续扫描
+                pos = m.end()
+                continue
+            value, valid = _decode_fenced(text[m.end() : close])
+            yield JsonCandidate(value, start, close + 3, True, valid)
+            pos = close + 3
+            continue
+
+        if failures >= MAX_JSON_DECODE_FAILURES:
+            pos = m.end()
+            continue
+        try:
+            value, end = _DECODER.raw_decode(text, start)
+        except RecursionError:
+            # 嵌套过深：跳过这一串左括号
+            failures += 1
+            pos = _OPENERS_RE.match(text, start).end()  # type: ignore[union-attr]
+            continue
+        except ValueError:
+            failures += 1
+            lenient = _LENIENT_START_RE.match(text, start)
+            end = _balanced_end(text, start) if lenient else -1
+            valid = False
+            if end > 0:
+                try:
+                    value, valid = _decode_lenient(text[start:end])
+                except RecursionError:
+                    valid = False
+            if not valid:
+                pos = start + 1
+                continue
+        yield JsonCandidate(value, start, end, False, True)
+        pos = end
+
+
+def is_tool_use(value: Any) -> bool:
+    """判断解析结果是否为 tool_use 对象"""
+    return (
+        isinstance(value, dict)
+        and value.get("type") == "tool_use"
+        and "name" in value
+        and "input" in value
+    )
+
+
 def parse_tool_calls_from_response(content: str) -> Tuple[List[Dict[str, Any]], str]:
-    """解析工具调用，并返回 (tool_calls, clean_content)"""
-    logger.setLevel(settings.log_level)
-    tool_calls = []
+    """解析工具调用，并返回 (tool_calls, clean_content)
+
+    存在 ```json 代码块时只使用代码块中的 JSON，否则使用裸 JSON；
+    JSON 数组中的元素全部为工具调用时同样视为工具调用。
+    """
+    logger.setLevel(config_manager.settings.log_level)
+    tool_calls: List[Dict[str, Any]] = []
     clean_content = content
 
     try:
-        # 先尝试匹配对象
-        json_candidates = extract_json_objects(content, mode="object")
-        if not json_candidates:
-            json_candidates = extract_json_objects(content, mode="array")
+        candidates = list(iter_json_candidates(content))
+        # 如果 fenced code block 里已经有了 JSON，就不再使用裸文本中的 JSON
+        if any(c.fenced for c in candidates):
+            candidates = [c for c in candidates if c.fenced]
 
         # 保存需要移除的 JSON 片段
         tool_json_segments = []
-
-        for idx, (json_str, start, end) in enumerate(json_candidates):
-            try:
-                # 先尝试直接解析
-                try:
-                    parsed = json.loads(json_str)
-                except json.JSONDecodeError:
-                    fixed_str = fix_invalid_json(json_str)
-                    parsed = json.loads(fixed_str)
-
-                # 验证是否是工具调用
-                if (
-                    isinstance(parsed, dict)
-                    and parsed.get("type") == "tool_use"
-                    and "name" in parsed
-                    and "input" in parsed
-                ):
-                    tool_call = {
-                        "id": parsed.get("id", f"call_{int(time.time())}_{idx}"),
+        for candidate in candidates:
+            if not candidate.valid:
+                logger.debug(f"跳过无效 JSON 片段: {candidate.start}-{candidate.end}")
+                continue
+            value = candidate.value
+            items = value if isinstance(value, list) else [value]
+            if not items or not all(is_tool_use(item) for item in items):
+                continue
+            for parsed in items:
+                # 缺少 id 时按已解析的工具调用数编号，数组中的多个调用各不相同
+                tool_id = (
+                    parsed.get("id") or f"call_{int(time.time())}_{len(tool_calls)}"
+                )
+                tool_calls.append(
+                    {
+                        "id": tool_id,
                         "type": "function",
                         "function": {
                             "name": parsed["name"],
@@ -164,13 +543,8 @@ def parse_tool_calls_from_response(content: str) -> Tuple[List[Dict[str, Any]],
                             ),
                         },
                     }
-                    tool_calls.append(tool_call)
-                    # 直接使用原版的移除逻辑
-                    tool_json_segments.append((json_str, start, end))
-
-            except (json.JSONDecodeError, Exception) as e:
-                logger.debug(f"跳过无效 JSON 片段: {e}")
-                continue
+                )
+            tool_json_segments.append(("", candidate.start, candidate.end))
 
         # 移除工具调用 JSON 内容，返回干净文本
         if tool_json_segments:
@@ -182,6 +556,296 @@ def parse_tool_calls_from_response(content: str) -> Tuple[List[Dict[str, Any]],
     return tool_calls, clean_content
 
 
+def load_tool_use(json_str: str) -> Optional[Dict[str, Any]]:
+    """解析单个 JSON 片段，若为 tool_use 对象则返回，否则返回None"""
+    value, valid = _decode_fenced(json_str)
+    if valid and is_tool_use(value):
+        return cast(Dict[str, Any], value)
+    return None
+
+
+# ```json 代码块起始标记
+_FENCE_OPEN_RE = re.compile(r"```\s*json")
+# 文本末尾可能是不完整的代码块起始标记，需要等待更多文本
+_FENCE_PARTIAL_RE = re.compile(r"```\s*(?:j(?:s(?:o)?)?)?$|`{1,2}$")
+# input 值扫描：字符串外需要关注的字符 / 字符串内需要关注的字符
+_JSON_STRUCT_RE = re.compile(r'[{}\[\]"]')
+_JSON_STRING_RE = re.compile(r'["\\]')
+_WS = " \t\r\n"
+
+
+class IncrementalToolCallParser:
+    """流式工具调用解析器
+
+    逐段接收模型输出文本：普通文本立即产出；遇到 ```json 代码块时，
+    若能依次解析出 type=tool_use、name 以及 input 的起始位置，则立即产出
+    工具调用开始事件，并将 input 的原始 JSON 增量产出，无需等待代码块结束。
+    无法增量解析的代码块在闭合后整体解析，与非流式解析结果保持一致。
+
+    产出的事件：
+    - {"type": "text", "text": ...}
+    - {"type": "tool_use_start", "id": ..., "name": ...}
+    - {"type": "input_json_delta", "partial_json": ...}
+    - {"type": "tool_use_stop"}
+    """
+
+    def __init__(self) -> None:
+        self._buf = ""
+        self._in_fence = False
+        self._tool_count = 0
+        self._decoder = json.JSONDecoder()
+        self._reset_fence("", "")
+
+    def _reset_fence(self, marker: str, content: str) -> None:
+        self._fence_open = marker
+        self._fence = content
+        # header / input / tail / fallback
+        self._state = "header"
+        self._opened = False
+        self._header: Dict[str, Any] = {}
+        self._pos = 0
+        self._emitted = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        """接收一段模型输出文本，返回可立即产出的事件"""
+        events: List[Dict[str, Any]] = []
+        if self._in_fence:
+            self._fence += text
+        else:
+            self._buf += text
+        while self._scan_fence(events) if self._in_fence else self._scan_text(events):
+            pass
+        return events
+
+    def close(self) -> List[Dict[str, Any]]:
+        """输出结束，产出所有剩余事件"""
+        events: List[Dict[str, Any]] = []
+        if self._in_fence:
+            if self._state == "input":
+                events.append({"type": "tool_use_stop"})
+            elif self._state != "tail":
+                self._finish_block(events, self._fence, closed=False)
+            self._in_fence = False
+        else:
+            self._emit_text(events, self._buf)
+            self._buf = ""
+        return events
+
+    @staticmethod
+    def _emit_text(events: List[Dict[str, Any]], text: str) -> None:
+        if text:
+            events.append({"type": "text", "text": text})
+
+    def _next_id(self, header: Dict[str, Any]) -> str:
+        idx = self._tool_count
+        self._tool_count += 1
+        tool_id = header.get("id")
+        if isinstance(tool_id, str) and tool_id:
+            return tool_id
+        return f"call_{int(time.time())}_{idx}"
+
+    def _skip_ws(self, pos: int) -> int:
+        fence = self._fence
+        n = len(fence)
+        while pos < n and fence[pos] in _WS:
+            pos += 1
+        return pos
+
+    def _scan_text(self, events: List[Dict[str, Any]]) -> bool:
+        """文本状态：产出普通文本，遇到代码块起始标记时切换状态"""
+        buf = self._buf
+        m = _FENCE_OPEN_RE.search(buf)
+        if m:
+            self._emit_text(events, buf[: m.start()])
+            self._buf = ""
+            self._in_fence = True
+            self._reset_fence(m.group(0), buf[m.end() :])
+            return True
+        hold = _FENCE_PARTIAL_RE.search(buf)
+        cut = hold.start() if hold else len(buf)
+        self._emit_text(events, buf[:cut])
+        self._buf = buf[cut:]
+        return False
+
+    def _scan_fence(self, events: List[Dict[str, Any]]) -> bool:
+        """代码块状态：增量解析工具调用，代码块闭合时返回 True"""
+        if self._state == "header":
+            self._scan_header(events)
+        if self._state == "input":
+            self._scan_input(events)
+        if self._state == "input":
+            # input 未结束时 ``` 可能位于字符串内，继续等待
+            return False
+
+        search_from = self._pos if self._state == "tail" else 0
+        close = self._fence.find("```", search_from)
+        if close < 0:
+            return False
+        if self._state != "tail":
+            self._finish_block(events, self._fence[:close], closed=True)
+        rest = self._fence[close + 3 :]
+        self._in_fence = False
+        self._reset_fence("", "")
+        self._buf = rest
+        return True
+
+    def _scan_header(self, events: List[Dict[str, Any]]) -> None:
+        """解析 input 之前的顶层字段，解析到 input 起始位置后开始工具调用"""
+        fence = self._fence
+        n = len(fence)
+        while True:
+            pos = self._skip_ws(self._pos)
+            if pos >= n:
+                return
+            ch = fence[pos]
+            if not self._opened:
+                if ch != "{":
+                    self._state = "fallback"
+                    return
+                self._opened = True
+                self._pos = pos + 1
+                continue
+            if ch == ",":
+                self._pos = pos + 1
+                continue
+            if ch != '"':
+                # 没有 input 字段或格式不规范，等待代码块闭合后整体解析
+                self._state = "fallback"
+                return
+            try:
+                key, key_end = self._decoder.raw_decode(fence, pos)
+            except json.JSONDecodeError:
+                return
+            colon = self._skip_ws(key_end)
+            if colon >= n:
+                return
+            if fence[colon] != ":":
+                self._state = "fallback"
+                return
+            value_pos = self._skip_ws(colon + 1)
+            if value_pos >= n:
+                return
+
+            if key == "input":
+                name = self._header.get("name")
+                if (
+                    self._header.get("type") != "tool_use"
+                    or not isinstance(name, str)
+                    or fence[value_pos] not in "{["
+                ):
+                    self._state = "fallback"
+                    return
+                events.append(
+                    {
+                        "type": "tool_use_start",
+                        "id": self._next_id(self._header),
+                        "name": name,
+                    }
+                )
+                self._state = "input"
+                self._pos = self._emitted = value_pos
+                return
+
+            try:
+                value, value_end = self._decoder.raw_decode(fence, value_pos)
+            except json.JSONDecodeError:
+                return
+            # 确认值之后已有分隔符，避免数字等标量被截断
+            if self._skip_ws(value_end) >= n:
+                return
+            self._header[key] = value
+            self._pos = value_end
+
+    def _scan_input(self, events: List[Dict[str, Any]]) -> None:
+        """扫描 input 值（字符串感知的括号匹配），增量产出其原始 JSON"""
+        fence = self._fence
+        n = len(fence)
+        i = self._pos
+        depth = self._depth
+        in_string = self._in_string
+        done = False
+
+        if self._escape:
+            # 上一段以反斜杠结尾，跳过被转义的字符
+            if i >= n:
+                return
+            i += 1
+            self._escape = False
+
+        while i < n:
+            if in_string:
+                m = _JSON_STRING_RE.search(fence, i)
+                if m is None:
+                    i = n
+                    break
+                if m.group() == "\\":
+                    if m.start() + 1 >= n:
+                        self._escape = True
+                        i = n
+                        break
+                    i = m.start() + 2
+                    continue
+                in_string = False
+                i = m.end()
+                continue
+            m = _JSON_STRUCT_RE.search(fence, i)
+            if m is None:
+                i = n
+                break
+            ch = m.group()
+            i = m.end()
+            if ch == '"':
+                in_string = True
+            elif ch in "{[":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    done = True
+                    break
+
+        partial = fence[self._emitted : i]
+        if partial:
+            events.append({"type": "input_json_delta", "partial_json": partial})
+        self._emitted = self._pos = i
+        self._depth = depth
+        self._in_string = in_string
+        if done:
+            events.append({"type": "tool_use_stop"})
+            self._state = "tail"
+
+    def _finish_block(
+        self, events: List[Dict[str, Any]], content: str, closed: bool
+    ) -> None:
+        """整体解析代码块：是工具调用则产出完整调用，否则原样作为文本"""
+        parsed = load_tool_use(content.strip())
+        if parsed is not None:
+            events.append(
+                {
+                    "type": "tool_use_start",
+                    "id": self._next_id(parsed),
+                    "name": parsed["name"],
+                }
+            )
+            events.append(
+                {
+                    "type": "input_json_delta",
+                    "partial_json": json.dumps(parsed["input"], ensure_ascii=False),
+                }
+            )
+            events.append({"type": "tool_use_stop"})
+            return
+        self._emit_text(events, self._fence_open + content + ("```" if closed else ""))
+
+
+def format_sse(event: str, data: Dict[str, Any]) -> bytes:
+    """按 SSE 格式编码单个事件"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+
 def build_chat_completion_args(params: dict) -> dict:
     """
     将原始参数字典转换为符合 OpenAI create() 方法要求的关键字参数。
@@ -255,36 +919,108 @@ CONFIG_PATH = Path("structured_content_map.json")
 
 
 # 加载模型映射配置
-def load_model_map() -> dict[str, Any]:
-    if CONFIG_PATH.exists():
-        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+def load_model_map(path: Path = CONFIG_PATH) -> dict[str, Any]:
+    if path.exists():
+        with open(path, "r", encoding="utf-8") as f:
             return cast(dict[str, Any], json.load(f))
     return {}
 
 
+class StructuredConfigIndex:
+    """结构化内容配置索引
+
+    映射文件只在内容变更时重新加载（按修改时间与大小判断，
+    检查频率受 ``check_interval`` 限制），前缀按长度降序预排序，
+    每个模型的匹配结果记在有界 LRU 缓存中（模型名称来自客户端，不能无限增长）。
+    """
+
+    MEMO_SIZE = 256
+
+    def __init__(self, path: Path, check_interval: float = 1.0) -> None:
+        self.path = path
+        self.check_interval = check_interval
+        self._loaded = False
+        self._signature: Optional[Tuple[int, int]] = None
+        self._checked_at: Optional[float] = None
+        self._model_map: dict[str, Any] = {}
+        self._prefixes: List[str] = []
+        self._memo: LRUCache[str, dict[str, Any]] = LRUCache(self.MEMO_SIZE)
+        self._lock = threading.Lock()
+
+    def _file_signature(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = self.path.stat()
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _refresh(self) -> None:
+        """按需检查映射文件，变更时重新加载并重建索引"""
+        now = time.monotonic()
+        if (
+            self._checked_at is not None
+            and now - self._checked_at < self.check_interval
+        ):
+            return
+        with self._lock:
+            self._checked_at = now
+            signature = self._file_signature()
+            if self._loaded and signature == self._signature:
+                return
+            try:
+                model_map = load_model_map(self.path)
+            except Exception as e:
+                logger.warning(f"加载结构化内容配置失败: {e}")
+                model_map = {}
+            self._loaded = True
+            self._signature = signature
+            self._model_map = model_map
+            self._prefixes = sorted(model_map, key=len, reverse=True)
+            self._memo.clear()
+            logger.debug(f"结构化内容配置已加载，共 {len(model_map)} 个模型")
+
+    def lookup(self, model_name: str) -> dict[str, Any]:
+        """查找模型配置：精确匹配优先，其次最长前缀匹配"""
+        self._refresh()
+        name = model_name.lower()
+        cached = self._memo.get(name)
+        if cached is not None:
+            return cached
+
+        model_map = self._model_map
+        if name in model_map:
+            logger.debug(f"模型 '{model_name}' 精确匹配到配置")
+            cfg = cast(dict[str, Any], model_map[name])
+        else:
+            best_key = next((k for k in self._prefixes if name.startswith(k)), None)
+            if best_key is not None:
+                logger.debug(f"模型 '{model_name}' 前缀匹配到配置: '{best_key}'")
+                cfg = cast(dict[str, Any], model_map[best_key])
+            else:
+                logger.debug(f"未找到模型 '{model_name}' 的结构化内容配置")
+                cfg = {}
+        self._memo.put(name, cfg)
+        return cfg
+
+    def clear(self) -> None:
+        """丢弃已加载的映射，下次查找时重新读取文件"""
+        with self._lock:
+            self._loaded = False
+            self._signature = None
+            self._checked_at = None
+            self._model_map = {}
+            self._prefixes = []
+            self._memo.clear()
+
+
+_structured_index = StructuredConfigIndex(CONFIG_PATH)
+
+
 # 获取指定模型的结构化内容配置
 def get_structured_config(model_name: str) -> dict[str, Any]:
-    """获取指定模型的结构化内容配置，支持前缀匹配"""
-    logger.setLevel(settings.log_level)
-    model_map = load_model_map()
-    name = model_name.lower()
-
-    # 1. 精确匹配
-    if name in model_map:
-        logger.debug(f"模型 '{model_name}' 精确匹配到配置")
-        return cast(dict[str, Any], model_map[name])
-
-    # 2. 前缀匹配（最长匹配优先）
-    matches = [cfg for key, cfg in model_map.items() if name.startswith(key)]
-    if matches:
-        # 可按匹配长度排序，选择最“长前缀”匹配项
-        best_key = max((k for k in model_map.keys() if name.startswith(k)), key=len)
-        logger.debug(f"模型 '{model_name}' 前缀匹配到配置: '{best_key}'")
-        return cast(dict[str, Any], model_map[best_key])
-
-    logger.debug(f"未找到模型 '{model_name}' 的结构化内容配置")
-    # 3. 未匹配到，返回空配置
-    return {}
+    """获取指定模型的结构化内容配置，支持前缀匹配（最长匹配优先）"""
+    logger.setLevel(config_manager.settings.log_level)
+    return _structured_index.lookup(model_name)
 
 
 # 判断模型是否支持多模态结构化内容
@@ -2,13 +2,62 @@
 应用测试
 """
 
+import asyncio
+import json
+import random
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+import httpx
+import pytest
 from fastapi.testclient import TestClient
 
+from src.claude_code_adapter import app as app_module
 from src.claude_code_adapter.app import app
+from src.claude_code_adapter.services import (
+    CircuitBreaker,
+    OverloadedError,
+    ToolSelectionCache,
+    current_caller,
+)
 
 client = TestClient(app)
 
 
+class _Completion:
+    """模拟的非流式模型响应"""
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self._data = data
+
+    def model_dump(self) -> Dict[str, Any]:
+        return self._data
+
+
+class EchoClient:
+    """模拟上游：随机延迟后原样回显最后一条消息"""
+
+    def __init__(self) -> None:
+        self.payloads: List[Dict[str, Any]] = []
+
+    async def create_completion(
+        self, url: str, key: str, payload: Dict[str, Any]
+    ) -> Any:
+        self.payloads.append(payload)
+        last = payload["messages"][-1]["content"]
+        await asyncio.sleep(random.uniform(0, 0.01))
+        # 延迟后再次读取，检测 payload 是否被其他请求改写
+        assert payload["messages"][-1]["content"] == last
+        return _Completion(
+            {
+                "id": "chatcmpl-test",
+                "model": payload["model"],
+                "choices": [{"message": {"content": last}}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1},
+            }
+        )
+
+
 class TestHealthEndpoint:
     """测试健康检查端点"""
 
@@ -43,3 +92,446 @@ class TestMessagesEndpoint:
         response = client.post("/v1/messages", json=request_data)
         # 基本请求应该返回200、500或502，模型配置来自配置文件
         assert response.status_code in [200, 500, 502]
+
+
+class SelectionClient:
+    """模拟工具选择模型：返回固定的工具名称列表"""
+
+    def __init__(self, names: List[str]) -> None:
+        self.names = names
+        self.calls = 0
+
+    async def create_completion(
+        self, url: str, key: str, payload: Dict[str, Any]
+    ) -> Any:
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        message = SimpleNamespace(content=json.dumps(self.names))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class TestConcurrency:
+    """测试并发请求之间互不干扰"""
+
+    def test_no_cross_talk_under_concurrency(
+        self, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        """测试数百个并发请求各自的 payload 与响应保持独立"""
+        echo = EchoClient()
+        monkeypatch.setattr(app_module, "openai_client", echo)
+        total = 300
+
+        async def run() -> List[httpx.Response]:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://test"
+            ) as ac:
+                return await asyncio.gather(
+                    *(
+                        ac.post(
+                            "/v1/messages",
+                            json={
+                                "model": "test-model",
+                                "messages": [
+                                    {"role": "user", "content": f"request-{i}"}
+                                ],
+                            },
+                        )
+                        for i in range(total)
+                    )
+                )
+
+        responses = asyncio.run(run())
+        for i, response in enumerate(responses):
+            assert response.status_code == 200
+            assert response.json()["content"][0]["text"] == f"request-{i}"
+        assert len(echo.payloads) == total
+        assert len({id(p) for p in echo.payloads}) == total
+        assert "messages" not in app_module.config_manager.settings.target_model_config
+
+
+class TestSelectTools:
+    """测试工具选择"""
+
+    def test_local_mode_skips_model_call(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        """测试本地模式不调用工具选择模型，且保证包含Read工具"""
+        echo = EchoClient()
+        monkeypatch.setattr(app_module, "tool_selection_client", echo)
+        settings = app_module.config_manager.settings.model_copy(
+            update={"tool_selection_mode": "local", "max_tools_to_select": 1}
+        )
+        tools = [
+            {"name": "Read", "description": "Reads a file."},
+            {"name": "Bash", "description": "Executes a shell command."},
+        ]
+        msgs = [{"role": "user", "content": "run this shell command"}]
+        selected = asyncio.run(app_module.select_tools("m", msgs, tools, settings))
+        assert [t["name"] for t in selected] == ["Bash", "Read"]
+        assert echo.payloads == []
+
+    def test_llm_selection_cached(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        """测试相同工具集与最近消息时复用工具选择结果"""
+        selector = SelectionClient(["Bash"])
+        monkeypatch.setattr(app_module, "tool_selection_client", selector)
+        monkeypatch.setattr(app_module, "tool_selection_cache", ToolSelectionCache())
+        settings = app_module.config_manager.settings.model_copy(
+            update={
+                "tool_selection_mode": "llm",
+                "tool_selection_cache_enabled": True,
+                "tool_selection_model_config": {"model": "selector"},
+            }
+        )
+        tools = [
+            {"name": "Read", "description": "Reads a file."},
+            {"name": "Bash", "description": "Executes a shell command."},
+        ]
+
+        async def run() -> None:
+            for content in ("run  the tests", "run the tests "):
+                msgs = [{"role": "user", "content": content}]
+                selected = await app_module.select_tools("m", msgs, tools, settings)
+                assert [t["name"] for t in selected] == ["Bash", "Read"]
+            msgs = [{"role": "user", "content": "something else"}]
+            await app_module.select_tools("m", msgs, tools, settings)
+
+        asyncio.run(run())
+        assert selector.calls == 2
+        assert app_module.tool_selection_cache.stats()["hits"] == 1
+
+
+class SlowEchoClient(EchoClient):
+    """模拟较慢的上游，记录被取消的请求"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.cancelled = 0
+
+    async def create_completion(
+        self, url: str, key: str, payload: Dict[str, Any]
+    ) -> Any:
+        try:
+            await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return await super().create_completion(url, key, payload)
+
+
+class TestSpeculativeExecution:
+    """测试工具选择与主请求的推测并行执行"""
+
+    TOOLS = [
+        {"name": name, "description": f"{name} tool"}
+        for name in ("Read", "Edit", "Grep", "Bash")
+    ]
+
+    def _run(
+        self, monkeypatch: pytest.MonkeyPatch, selected: List[str]
+    ) -> SlowEchoClient:
+        upstream = SlowEchoClient()
+        monkeypatch.setattr(app_module, "openai_client", upstream)
+        monkeypatch.setattr(
+            app_module, "tool_selection_client", SelectionClient(selected)
+        )
+        monkeypatch.setattr(app_module, "speculation_stats", {"hits": 0, "misses": 0})
+        settings = app_module.config_manager.settings.model_copy(
+            update={
+                "enable_tool_selection": True,
+                "enable_speculative_execution": True,
+                "tool_selection_mode": "llm",
+                "tool_selection_cache_enabled": False,
+                "tool_selection_model_config": {"model": "selector"},
+                "default_tools": ["Read", "Edit", "Grep"],
+                "max_tools_to_select": 3,
+            }
+        )
+        monkeypatch.setattr(app_module.config_manager, "settings", settings)
+        response = client.post(
+            "/v1/messages",
+            json={
+                "model": "test-model",
+                "messages": [{"role": "user", "content": "hello"}],
+                "tools": self.TOOLS,
+            },
+        )
+        assert response.status_code == 200
+        return upstream
+
+    def test_speculation_hit(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        """测试选择结果与默认工具一致时复用推测请求"""
+        upstream = self._run(monkeypatch, ["Edit", "Grep"])
+        assert len(upstream.payloads) == 1
+        assert upstream.cancelled == 0
+        assert app_module.speculation_stats == {"hits": 1, "misses": 0}
+
+    def test_speculation_miss(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        """测试选择结果不一致时取消推测请求并重新发起"""
+        upstream = self._run(monkeypatch, ["Bash"])
+        assert upstream.cancelled == 1
+        assert len(upstream.payloads) == 1
+        assert "Bash" in upstream.payloads[0]["messages"][-1]["content"]
+        assert app_module.speculation_stats == {"hits": 0, "misses": 1}
+
+
+class TestNativeToolCalling:
+    """测试原生函数调用模式"""
+
+    def test_tools_sent_as_functions(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        """测试工具定义通过 tools 字段发送，不再拼接工具提示词"""
+        echo = EchoClient()
+        monkeypatch.setattr(app_module, "openai_client", echo)
+        settings = app_module.config_manager.settings.model_copy(
+            update={
+                "enable_tool_selection": False,
+                "native_tool_calling_models": ["*"],
+            }
+        )
+        monkeypatch.setattr(app_module.config_manager, "settings", settings)
+        response = client.post(
+            "/v1/messages",
+            json={
+                "model": "test-model",
+                "messages": [{"role": "user", "content": "hello"}],
+                "tools": [
+                    {
+                        "name": "Read",
+                        "description": "Reads a file.",
+                        "input_schema": {"type": "object", "properties": {}},
+                    }
+                ],
+                "tool_choice": {"type": "tool", "name": "Read"},
+            },
+        )
+        assert response.status_code == 200
+        payload = echo.payloads[0]
+        assert payload["tools"] == [
+            {
+                "type": "function",
+                "function": {
+                    "name": "Read",
+                    "description": "Reads a file.",
+                    "parameters": {"type": "object", "properties": {}},
+                },
+            }
+        ]
+        assert payload["tool_choice"] == {
+            "type": "function",
+            "function": {"name": "Read"},
+        }
+        assert all("Reads a file" not in m["content"] for m in payload["messages"])
+
+
+class TestCountTokens:
+    """测试本地 token 计数端点"""
+
+    def test_count_tokens(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        """测试本地计数且不访问上游"""
+        echo = EchoClient()
+        monkeypatch.setattr(app_module, "openai_client", echo)
+        request_data = {
+            "model": "test-model",
+            "messages": [{"role": "user", "content": "Hello " * 100}],
+        }
+        response = client.post("/v1/messages/count_tokens", json=request_data)
+        assert response.status_code == 200
+        tokens = response.json()["input_tokens"]
+        assert tokens > 100
+        request_data["messages"].append({"role": "assistant", "content": "Hi"})
+        response = client.post("/v1/messages/count_tokens", json=request_data)
+        assert response.json()["input_tokens"] > tokens
+        assert echo.payloads == []
+
+    def test_count_tokens_not_compacted(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        """测试计数不受历史压缩预算影响"""
+        request_data = {
+            "model": "test-model",
+            "messages": [
+                {"role": "user", "content": "Start"},
+                {"role": "assistant", "content": "Ok"},
+                {"role": "user", "content": "Hello " * 200},
+                {"role": "assistant", "content": "Hi " * 200},
+                {"role": "user", "content": "Again"},
+            ],
+        }
+        full = client.post("/v1/messages/count_tokens", json=request_data)
+        settings = app_module.config_manager.settings.model_copy(
+            update={"history_token_budgets": {"*": 50}, "history_keep_recent_turns": 1}
+        )
+        monkeypatch.setattr(app_module.config_manager, "settings", settings)
+        compacted = app_module.message_converter.compactor.stats["compacted"]
+        response = client.post("/v1/messages/count_tokens", json=request_data)
+        assert response.json()["input_tokens"] == full.json()["input_tokens"]
+        assert app_module.message_converter.compactor.stats["compacted"] == compacted
+
+    def test_count_tokens_empty(self) -> None:
+        """测试空消息"""
+        response = client.post("/v1/messages/count_tokens", json={"messages": []})
+        assert response.status_code == 400
+
+
+class OverloadedClient:
+    """模拟准入控制拒绝的上游客户端"""
+
+    async def create_completion(
+        self, url: str, key: str, payload: Dict[str, Any]
+    ) -> Any:
+        raise OverloadedError("target_max_concurrency is overloaded")
+
+
+class TestAdmissionControl:
+    """测试过载时返回 529"""
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_overloaded(self, monkeypatch: pytest.MonkeyPatch, stream: bool) -> None:
+        """测试流式与非流式请求在过载时都直接返回 overloaded_error"""
+        monkeypatch.setattr(app_module, "openai_client", OverloadedClient())
+        response = client.post(
+            "/v1/messages",
+            json={
+                "model": "test-model",
+                "stream": stream,
+                "messages": [{"role": "user", "content": "hello"}],
+            },
+        )
+        assert response.status_code == 529
+        assert response.json()["error"]["type"] == "overloaded_error"
+
+
+class CallerRecorder(EchoClient):
+    """记录每次请求的调用方标识"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.callers: List[str] = []
+
+    async def create_completion(
+        self, url: str, key: str, payload: Dict[str, Any]
+    ) -> Any:
+        self.callers.append(current_caller.get())
+        return await super().create_completion(url, key, payload)
+
+
+class TestCallerIdentity:
+    """测试调用方标识"""
+
+    def test_caller_identity(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        """测试优先使用 metadata.user_id，否则使用密钥请求头的哈希"""
+        recorder = CallerRecorder()
+        monkeypatch.setattr(app_module, "openai_client", recorder)
+        request_data: Dict[str, Any] = {
+            "model": "test-model",
+            "messages": [{"role": "user", "content": "hello"}],
+        }
+        client.post("/v1/messages", json=request_data, headers={"x-api-key": "sk-1"})
+        request_data["metadata"] = {"user_id": "alice"}
+        client.post("/v1/messages", json=request_data, headers={"x-api-key": "sk-1"})
+        assert recorder.callers[0].startswith("key:")
+        assert "sk-1" not in recorder.callers[0]
+        assert recorder.callers[1] == "alice"
+
+
+class TestCircuitBreakerHealth:
+    """测试健康检查中的熔断器状态"""
+
+    def test_breakers_in_health(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        """测试 /health 返回各路由的熔断器状态"""
+        monkeypatch.setattr(
+            app_module.openai_client,
+            "breakers",
+            {"http://a": CircuitBreaker("http://a")},
+        )
+        response = client.get("/health")
+        assert response.status_code == 200
+        breakers = response.json()["circuit_breakers"]
+        assert breakers["target"]["http://a"]["state"] == "closed"
+
+
+class TestMetricsEndpoint:
+    """测试 /metrics 端点"""
+
+    def test_metrics(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        """测试请求后导出各阶段耗时、状态码、token 数与缓存统计"""
+        monkeypatch.setattr(app_module, "openai_client", EchoClient())
+        request_data = {
+            "model": "test-model",
+            "messages": [{"role": "user", "content": "Hello"}],
+        }
+        assert client.post("/v1/messages", json=request_data).status_code == 200
+        monkeypatch.undo()
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        text = response.text
+        assert 'adapter_requests_total{path="/v1/messages",status="200"}' in text
+        assert 'adapter_stage_duration_seconds_count{stage="convert"}' in text
+        assert 'adapter_stage_duration_seconds_count{stage="serialize"}' in text
+        assert 'adapter_tokens_total{model="' in text
+        assert 'adapter_cache_hits_total{cache="tool_prompt"}' in text
+        assert 'adapter_upstream_attempts_total{route="target",outcome="ok"}' in text
+
+    def test_stream_metrics(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        """测试流式请求按后端地址与模型记录 TTFT、总时长与输出速率"""
+
+        class BackendStream:
+            backend = "http://stream-backend"
+
+            async def __aiter__(self) -> Any:
+                for _ in range(3):
+                    await asyncio.sleep(0.005)
+                    yield {"choices": [{"delta": {"content": "hi"}}]}
+
+        class StreamClient:
+            async def create_completion(
+                self, url: str, key: str, payload: Dict[str, Any]
+            ) -> Any:
+                return BackendStream()
+
+        monkeypatch.setattr(app_module, "openai_client", StreamClient())
+        request_data = {
+            "model": "test-model",
+            "stream": True,
+            "messages": [{"role": "user", "content": "Hello"}],
+        }
+        response = client.post("/v1/messages", json=request_data)
+        assert response.status_code == 200
+        assert "message_stop" in response.text
+        monkeypatch.undo()
+        text = client.get("/metrics").text
+        for name in (
+            "adapter_stream_ttft_seconds_count",
+            "adapter_stream_duration_seconds_count",
+            "adapter_stream_output_tokens_per_second_count",
+        ):
+            assert f'{name}{{backend="http://stream-backend",model="' in text
+
+
+class TestTracing:
+    """测试请求 ID 与请求追踪"""
+
+    def test_request_id_and_trace(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        """测试请求 ID 回写到响应头，追踪可按请求 ID 查询"""
+        settings = app_module.config_manager.settings.model_copy(
+            update={"tracing_enabled": True}
+        )
+        monkeypatch.setattr(app_module.config_manager, "settings", settings)
+        monkeypatch.setattr(app_module, "openai_client", EchoClient())
+        request_data = {
+            "model": "test-model",
+            "messages": [{"role": "user", "content": "Hello"}],
+        }
+        response = client.post(
+            "/v1/messages", json=request_data, headers={"x-request-id": "trace-1"}
+        )
+        assert response.status_code == 200
+        assert response.headers["x-request-id"] == "trace-1"
+        generated = client.post("/v1/messages", json=request_data)
+        assert generated.headers["x-request-id"]
+
+        trace = client.get("/traces/trace-1").json()
+        names = [s["name"] for s in trace["spans"]]
+        assert "convert_messages" in names and "process_response" in names
+        root = next(s for s in trace["spans"] if s["name"] == "proxy_messages")
+        assert root["attributes"]["message_count"] == 1
+        recent = client.get("/traces", params={"limit": 1}).json()["traces"]
+        assert recent[0]["request_id"] == generated.headers["x-request-id"]
+        assert client.get("/traces/missing").status_code == 404
@@ -0,0 +1,102 @@
+"""
+配置管理测试
+"""
+
+import os
+from pathlib import Path
+
+import pytest
+
+from src.claude_code_adapter.config import ConfigManager, thaw
+
+
+def _write_config(path: Path, content: str) -> None:
+    """写入配置文件并推进修改时间，确保签名发生变化"""
+    path.write_text(content, encoding="utf-8")
+    st = path.stat()
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+
+class TestConfigReload:
+    """测试配置文件变更检测"""
+
+    def test_no_reload_without_changes(self, tmp_path: Path) -> None:
+        """测试文件未变更时不重新加载"""
+        config_file = tmp_path / "config.yaml"
+        _write_config(config_file, "max_tools_to_select: 4\n")
+        manager = ConfigManager(str(config_file))
+        snapshot = manager.settings
+        assert manager.check_for_changes() is False
+        assert manager.settings is snapshot
+
+    def test_reload_after_change_is_stable(self, tmp_path: Path) -> None:
+        """测试文件变更并稳定后重新加载"""
+        config_file = tmp_path / "config.yaml"
+        _write_config(
+            config_file, "max_tools_to_select: 4\nconfig_reload_debounce: 0\n"
+        )
+        manager = ConfigManager(str(config_file))
+        assert manager.settings.max_tools_to_select == 4
+
+        _write_config(
+            config_file, "max_tools_to_select: 7\nconfig_reload_debounce: 0\n"
+        )
+        # 第一次检测只记录变更，第二次确认稳定后才重新加载
+        assert manager.check_for_changes() is False
+        assert manager.settings.max_tools_to_select == 4
+        assert manager.check_for_changes() is True
+        assert manager.settings.max_tools_to_select == 7
+        assert manager.check_for_changes() is False
+
+
+class TestSettingsSnapshot:
+    """测试配置快照不可变"""
+
+    def test_settings_are_frozen(self, tmp_path: Path) -> None:
+        """测试配置快照及其模型参数不可修改"""
+        config_file = tmp_path / "config.yaml"
+        _write_config(config_file, "target_model_config:\n  model: m\n")
+        manager = ConfigManager(str(config_file))
+        with pytest.raises(Exception):
+            manager.settings.max_tools_to_select = 9  # type: ignore[misc]
+        with pytest.raises(TypeError):
+            manager.settings.target_model_config["messages"] = []  # type: ignore
+        assert dict(manager.settings.target_model_config) == {"model": "m"}
+
+    def test_nested_values_are_frozen(self, tmp_path: Path) -> None:
+        """测试嵌套的字典与列表同样只读，构建 payload 时可复制为普通结构"""
+        config_file = tmp_path / "config.yaml"
+        _write_config(
+            config_file,
+            "target_model_config:\n"
+            "  model: m\n"
+            "  extra_body:\n"
+            "    stop: [a]\n"
+            "priority_rules:\n"
+            "  - {route: target, class: bulk}\n"
+            "default_tools: [Read]\n",
+        )
+        settings = ConfigManager(str(config_file)).settings
+        with pytest.raises(TypeError):
+            settings.target_model_config["extra_body"]["stop"] = []  # type: ignore
+        with pytest.raises(TypeError):
+            settings.priority_rules[0]["class"] = "x"  # type: ignore[index]
+        assert isinstance(settings.default_tools, tuple)
+        payload = thaw(settings.target_model_config)
+        payload["extra_body"]["stop"].append("b")
+        assert payload == {"model": "m", "extra_body": {"stop": ["a", "b"]}}
+        assert settings.target_model_config["extra_body"]["stop"] == ("a",)
+
+    def test_invalid_values_rejected(self, tmp_path: Path) -> None:
+        """测试配置文件中的值经过校验，重载失败时保留当前配置"""
+        config_file = tmp_path / "config.yaml"
+        _write_config(
+            config_file, "max_tools_to_select: '4'\nconfig_reload_debounce: 0\n"
+        )
+        manager = ConfigManager(str(config_file))
+        # 按字段类型转换
+        assert manager.settings.max_tools_to_select == 4
+        snapshot = manager.settings
+        _write_config(config_file, "max_tools_to_select: many\n")
+        manager.reload()
+        assert manager.settings is snapshot
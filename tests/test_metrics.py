@@ -0,0 +1,104 @@
+"""
+指标模块测试
+"""
+
+import asyncio
+from typing import Any, Dict, List
+
+import pytest
+
+from src.claude_code_adapter.metrics import (
+    LabelSet,
+    MetricsMiddleware,
+    MetricsRegistry,
+    request_duration,
+    requests_in_flight,
+    requests_total,
+)
+
+
+class TestMetricsRegistry:
+    """测试指标注册表与文本格式导出"""
+
+    def test_counter_and_gauge(self) -> None:
+        """测试计数器与仪表的记录和导出"""
+        registry = MetricsRegistry()
+        counter = registry.counter("c_total", "A counter", ("route",))
+        gauge = registry.gauge("g", "A gauge")
+        counter.inc("target")
+        counter.inc("target", amount=2)
+        gauge.inc()
+        gauge.dec(amount=0.5)
+        assert counter.value("target") == 3
+        text = registry.render()
+        assert "# TYPE c_total counter" in text
+        assert 'c_total{route="target"} 3' in text
+        assert "g 0.5" in text
+
+    def test_label_count_checked(self) -> None:
+        """测试标签数量与定义不一致时报错"""
+        registry = MetricsRegistry()
+        counter = registry.counter("c_total", "A counter", ("route",))
+        with pytest.raises(ValueError):
+            counter.inc()
+        with pytest.raises(ValueError):
+            registry.counter("c_total", "Duplicate")
+
+    def test_histogram_buckets(self) -> None:
+        """测试直方图导出为累计分桶，边界值计入对应分桶"""
+        registry = MetricsRegistry()
+        hist = registry.histogram("h_seconds", "A histogram", ("stage",), (0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5.0):
+            hist.observe(value, "convert")
+        assert hist.count("convert") == 4
+        assert hist.sum("convert") == pytest.approx(5.65)
+        text = registry.render()
+        assert 'h_seconds_bucket{stage="convert",le="0.1"} 2' in text
+        assert 'h_seconds_bucket{stage="convert",le="1"} 3' in text
+        assert 'h_seconds_bucket{stage="convert",le="+Inf"} 4' in text
+        assert 'h_seconds_count{stage="convert"} 4' in text
+
+    def test_collector_and_escaping(self) -> None:
+        """测试采集回调在导出时调用，标签值中的特殊字符被转义"""
+        registry = MetricsRegistry()
+
+        @registry.collector
+        def collect() -> Any:
+            yield ("x_total", "counter", "Collected", [({"url": 'a"b\\c'}, 7)])
+
+        assert 'x_total{url="a\\"b\\\\c"} 7' in registry.render()
+
+    def test_label_set_bounded(self) -> None:
+        """测试超出上限的新标签取值归为 other，已记录的取值保持不变"""
+        labels = LabelSet(2)
+        assert labels("a") == "a"
+        assert labels("b") == "b"
+        assert labels("c") == "other"
+        assert labels("a") == "a"
+        assert labels(None) == "unknown"
+
+
+class TestMetricsMiddleware:
+    """测试 ASGI 指标中间件"""
+
+    def test_status_and_in_flight(self) -> None:
+        """测试按路径统计状态码，流式响应发送完毕后才结束计数"""
+        seen: List[float] = []
+
+        async def inner(scope: Dict[str, Any], receive: Any, send: Any) -> None:
+            await send({"type": "http.response.start", "status": 201})
+            seen.append(requests_in_flight.value("/tracked"))
+            await send({"type": "http.response.body", "body": b""})
+
+        async def send(message: Dict[str, Any]) -> None:
+            pass
+
+        middleware = MetricsMiddleware(inner, paths=("/tracked",))
+        before = requests_total.value("/tracked", "201")
+        count = request_duration.count("/tracked")
+        asyncio.run(middleware({"type": "http", "path": "/tracked"}, None, send))
+        asyncio.run(middleware({"type": "http", "path": "/other"}, None, send))
+        assert seen == [1.0, 0.0]
+        assert requests_in_flight.value("/tracked") == 0
+        assert requests_total.value("/tracked", "201") == before + 1
+        assert request_duration.count("/tracked") == count + 1
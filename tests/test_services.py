@@ -0,0 +1,1609 @@
+"""
+服务层测试
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import time
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import pytest
+
+from src.claude_code_adapter import metrics
+from src.claude_code_adapter.config import config_manager
+from src.claude_code_adapter.services import (
+    Backend,
+    BackendLimiters,
+    BackendPool,
+    CircuitBreaker,
+    CircuitOpenError,
+    ClientRegistry,
+    ConcurrencyLimiter,
+    HistoryCompactor,
+    LocalToolSelector,
+    MessageConverter,
+    OpenAIClient,
+    OverloadedError,
+    ResponseCache,
+    ResponseProcessor,
+    SingleFlight,
+    StreamProcessor,
+    StreamTimer,
+    UpstreamTimeoutError,
+    _Attempt,
+    request_priority,
+)
+from src.claude_code_adapter.tokenizer import get_token_counter
+from src.claude_code_adapter.tracing import current_request_id, tracer
+
+POOL_OPTIONS = (10, 5, 30.0, False)
+
+
+class TestClientRegistry:
+    """测试上游客户端注册表"""
+
+    def test_reuse_same_upstream(self) -> None:
+        """测试相同上游复用同一个客户端"""
+        registry = ClientRegistry()
+        first = registry.get("http://127.0.0.1:1234/v1", "key", POOL_OPTIONS)
+        second = registry.get("http://127.0.0.1:1234/v1", "key", POOL_OPTIONS)
+        assert first is second
+        assert len(registry) == 1
+
+    def test_separate_clients_per_key(self) -> None:
+        """测试不同地址或密钥使用不同客户端，连接池参数变化时替换旧客户端"""
+        registry = ClientRegistry()
+        base = registry.get("http://127.0.0.1:1234/v1", "key", POOL_OPTIONS)
+        assert registry.get("http://127.0.0.1:5678/v1", "key", POOL_OPTIONS) is not base
+        assert (
+            registry.get("http://127.0.0.1:1234/v1", "other", POOL_OPTIONS) is not base
+        )
+        assert (
+            registry.get("http://127.0.0.1:1234/v1", "key", (1, 1, 1.0, False))
+            is not base
+        )
+        assert len(registry) == 3
+        assert registry.retired == 1
+        asyncio.run(registry.aclose())
+        assert base.is_closed()
+
+    def test_reload_closes_replaced_clients(self) -> None:
+        """测试两次重载连接池参数后，被替换的旧客户端在后台关闭"""
+        registry = ClientRegistry(retire_delay=0.0)
+        url = "http://127.0.0.1:1234/v1"
+
+        async def run() -> List[Any]:
+            clients = [registry.get(url, "key", POOL_OPTIONS)]
+            clients.append(registry.get(url, "key", (20, 5, 30.0, False)))
+            clients.append(registry.get(url, "key", (30, 5, 30.0, False)))
+            await asyncio.sleep(0.01)
+            return clients
+
+        first, second, third = asyncio.run(run())
+        assert first.is_closed() and second.is_closed()
+        assert not third.is_closed()
+        assert len(registry) == 1 and registry.retired == 0
+        asyncio.run(registry.aclose())
+        assert third.is_closed()
+
+    def test_aclose_clears_clients(self) -> None:
+        """测试关闭后清空注册表"""
+        registry = ClientRegistry()
+        registry.get("http://127.0.0.1:1234/v1", "key", POOL_OPTIONS)
+        asyncio.run(registry.aclose())
+        assert len(registry) == 0
+
+
+def _chunk(content: str, finish_reason: Any = None) -> Dict[str, Any]:
+    return {
+        "id": "chatcmpl-1",
+        "model": "m",
+        "choices": [{"delta": {"content": content}, "finish_reason": finish_reason}],
+    }
+
+
+def _collect_events(
+    chunks: List[Dict[str, Any]], native_tools: bool = False
+) -> List[Dict[str, Any]]:
+    """运行流式处理并解析产出的 SSE 事件"""
+
+    async def source() -> AsyncIterator[Dict[str, Any]]:
+        for chunk in chunks:
+            yield chunk
+
+    async def run() -> List[bytes]:
+        processor = StreamProcessor()
+        return [e async for e in processor.process_stream(source(), "m", native_tools)]
+
+    events = []
+    for raw in asyncio.run(run()):
+        event_line, data_line = raw.decode().strip().split("\n")
+        data = json.loads(data_line[len("data: ") :])
+        assert event_line == f"event: {data['type']}"
+        events.append(data)
+    return events
+
+
+class TestStreamProcessor:
+    """测试流式响应转换为 Anthropic SSE 事件"""
+
+    def test_text_stream(self) -> None:
+        """测试纯文本流"""
+        events = _collect_events([_chunk("Hel"), _chunk("lo", "stop")])
+        assert [e["type"] for e in events] == [
+            "message_start",
+            "content_block_start",
+            "content_block_delta",
+            "content_block_delta",
+            "content_block_stop",
+            "message_delta",
+            "message_stop",
+        ]
+        assert events[-2]["delta"]["stop_reason"] == "end_turn"
+
+    def test_tool_use_stream(self) -> None:
+        """测试工具调用流"""
+        events = _collect_events(
+            [
+                _chunk("Reading.\n```json\n"),
+                _chunk('{"type": "tool_use", "id": "call_9", "name": "Read", '),
+                _chunk('"input": {"file_path": "/tmp/a"}}\n```'),
+                _chunk("", "stop"),
+            ]
+        )
+        starts = [e for e in events if e["type"] == "content_block_start"]
+        assert [b["content_block"]["type"] for b in starts] == ["text", "tool_use"]
+        assert starts[1]["content_block"]["name"] == "Read"
+        partial = "".join(
+            e["delta"]["partial_json"]
+            for e in events
+            if e["type"] == "content_block_delta"
+            and e["delta"]["type"] == "input_json_delta"
+        )
+        assert json.loads(partial) == {"file_path": "/tmp/a"}
+        assert events[-2]["delta"]["stop_reason"] == "tool_use"
+
+
+TOOLS = [
+    {"name": "Read", "description": "Reads a file from the local filesystem."},
+    {"name": "Grep", "description": "Search file contents with regex patterns."},
+    {"name": "Bash", "description": "Executes a bash command in a shell session."},
+    {"name": "WebFetch", "description": "Fetches content from a URL."},
+]
+
+
+class TestLocalToolSelector:
+    """测试本地工具选择"""
+
+    def test_rank_by_relevance(self) -> None:
+        """测试按最近消息的相关性排序"""
+        selector = LocalToolSelector()
+        msgs = [{"role": "user", "content": "search for the regex pattern"}]
+        assert selector.select(msgs, TOOLS, 2)[0] == "Grep"
+
+    def test_recent_tool_use_counts(self) -> None:
+        """测试最近使用过的工具名称计入查询"""
+        selector = LocalToolSelector()
+        msgs = [
+            {
+                "role": "assistant",
+                "content": [{"type": "tool_use", "name": "WebFetch", "input": {}}],
+            }
+        ]
+        assert selector.select(msgs, TOOLS, 1) == ["WebFetch"]
+
+    def test_default_tools_when_no_match(self) -> None:
+        """测试没有任何匹配时返回可用的默认工具"""
+        selector = LocalToolSelector()
+        msgs = [{"role": "user", "content": "你好"}]
+        assert selector.select(msgs, TOOLS, 3, ["Edit", "Bash", "Read"]) == [
+            "Bash",
+            "Read",
+        ]
+
+
+class TestNativeToolCalling:
+    """测试原生函数调用模式下的消息与响应转换"""
+
+    def test_convert_tool_blocks(self) -> None:
+        """测试 tool_use / tool_result 块转换为 tool_calls 与 tool 消息"""
+        body = {
+            "model": "m",
+            "tools": TOOLS,
+            "messages": [
+                {"role": "user", "content": "read a"},
+                {
+                    "role": "assistant",
+                    "content": [
+                        {"type": "text", "text": "Reading."},
+                        {
+                            "type": "tool_use",
+                            "id": "call_1",
+                            "name": "Read",
+                            "input": {"file_path": "a"},
+                        },
+                    ],
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "tool_result",
+                            "tool_use_id": "call_1",
+                            "content": [{"type": "text", "text": "hello"}],
+                        },
+                        {"type": "text", "text": "thanks"},
+                    ],
+                },
+            ],
+        }
+        out = MessageConverter().convert_anthropic_to_openai_messages(
+            body, native_tools=True
+        )
+        assert all("tool_use" not in str(m.get("content")) for m in out)
+        assert out[-4:] == [
+            {"role": "user", "content": "read a"},
+            {
+                "role": "assistant",
+                "content": "Reading.",
+                "tool_calls": [
+                    {
+                        "id": "call_1",
+                        "type": "function",
+                        "function": {
+                            "name": "Read",
+                            "arguments": '{"file_path": "a"}',
+                        },
+                    }
+                ],
+            },
+            {"role": "tool", "tool_call_id": "call_1", "content": "hello"},
+            {"role": "user", "content": "thanks"},
+        ]
+
+    def test_response_tool_calls(self) -> None:
+        """测试非流式响应中的 tool_calls 转换为 tool_use 块"""
+        resp = ResponseProcessor().process_response(
+            {
+                "id": "chatcmpl-1",
+                "choices": [
+                    {
+                        "message": {
+                            "content": None,
+                            "tool_calls": [
+                                {
+                                    "id": "call_2",
+                                    "type": "function",
+                                    "function": {
+                                        "name": "Grep",
+                                        "arguments": '{"pattern": "x"}',
+                                    },
+                                }
+                            ],
+                        }
+                    }
+                ],
+            },
+            "m",
+            native_tools=True,
+        )
+        assert resp["stop_reason"] == "tool_use"
+        assert resp["content"] == [
+            {
+                "type": "tool_use",
+                "id": "call_2",
+                "name": "Grep",
+                "input": {"pattern": "x"},
+            }
+        ]
+
+    def test_stream_tool_call_deltas(self) -> None:
+        """测试流式 tool_calls 增量转换为 tool_use 块与 input_json_delta"""
+
+        def tool_chunk(tc: Dict[str, Any]) -> Dict[str, Any]:
+            return {"choices": [{"delta": {"tool_calls": [tc]}}]}
+
+        events = _collect_events(
+            [
+                _chunk("```json not parsed"),
+                tool_chunk(
+                    {
+                        "index": 0,
+                        "id": "call_3",
+                        "function": {"name": "Read", "arguments": ""},
+                    }
+                ),
+                tool_chunk({"index": 0, "function": {"arguments": '{"file_'}}),
+                tool_chunk({"index": 0, "function": {"arguments": 'path": "a"}'}}),
+                _chunk("", "tool_calls"),
+            ],
+            native_tools=True,
+        )
+        starts = [
+            e["content_block"] for e in events if e["type"] == "content_block_start"
+        ]
+        assert [b["type"] for b in starts] == ["text", "tool_use"]
+        assert starts[1]["id"] == "call_3"
+        partial = "".join(
+            e["delta"].get("partial_json", "")
+            for e in events
+            if e["type"] == "content_block_delta"
+        )
+        assert json.loads(partial) == {"file_path": "a"}
+        assert events[-2]["delta"]["stop_reason"] == "tool_use"
+
+    def test_stream_text_between_tool_call_deltas(self) -> None:
+        """测试工具调用参数之间穿插的文本不会打断 tool_use 块"""
+
+        def tool_chunk(tc: Dict[str, Any]) -> Dict[str, Any]:
+            return {"choices": [{"delta": {"tool_calls": [tc]}}]}
+
+        events = _collect_events(
+            [
+                tool_chunk(
+                    {"index": 0, "id": "a", "function": {"name": "Read"}},
+                ),
+                tool_chunk({"index": 0, "function": {"arguments": '{"file_'}}),
+                _chunk("note"),
+                tool_chunk({"index": 1, "id": "b", "function": {"name": "Grep"}}),
+                tool_chunk({"index": 0, "function": {"arguments": 'path": "a"}'}}),
+                tool_chunk({"index": 1, "function": {"arguments": "{}"}}),
+                _chunk("", "tool_calls"),
+            ],
+            native_tools=True,
+        )
+        starts = {
+            e["index"]: e["content_block"]
+            for e in events
+            if e["type"] == "content_block_start"
+        }
+        assert [b["type"] for b in starts.values()] == ["tool_use", "tool_use", "text"]
+        args: Dict[int, str] = {}
+        for e in events:
+            if e["type"] == "content_block_delta" and "partial_json" in e["delta"]:
+                args[e["index"]] = args.get(e["index"], "") + e["delta"]["partial_json"]
+        assert json.loads(args[0]) == {"file_path": "a"}
+        assert json.loads(args[1]) == {}
+        text = [
+            e
+            for e in events
+            if e["type"] == "content_block_delta" and "text" in e["delta"]
+        ]
+        assert [(e["index"], e["delta"]["text"]) for e in text] == [(2, "note")]
+
+    def test_native_response_keeps_json_fence(self) -> None:
+        """测试原生工具模式下不去掉正文中的 ```json 代码块"""
+        text = 'Example:\n```json\n{"a": 1}\n```'
+        resp = ResponseProcessor().process_response(
+            {
+                "choices": [
+                    {
+                        "message": {
+                            "content": text,
+                            "tool_calls": [
+                                {
+                                    "id": "call_4",
+                                    "type": "function",
+                                    "function": {"name": "Read", "arguments": "{}"},
+                                }
+                            ],
+                        }
+                    }
+                ],
+            },
+            "m",
+            native_tools=True,
+        )
+        assert resp["content"][0] == {"type": "text", "text": text}
+
+
+class TestConversionCache:
+    """测试会话消息转换缓存"""
+
+    def test_reuse_unchanged_prefix(self) -> None:
+        """测试历史不变时只转换新增消息，结果与不使用缓存时一致"""
+        converter = MessageConverter()
+        converter.conversion_cache.configure(8)
+        calls: List[Dict[str, Any]] = []
+        convert_one = converter._convert_message
+
+        def counting(m: Dict[str, Any], *args: Any) -> List[Dict[str, Any]]:
+            calls.append(m)
+            return convert_one(m, *args)
+
+        converter._convert_message = counting  # type: ignore[method-assign]
+        history = [{"role": "user", "content": f"message {i}"} for i in range(5)]
+        first = converter.convert_messages(history, "m")
+        history = history + [{"role": "assistant", "content": "reply"}]
+        second = converter.convert_messages(history, "m")
+        assert len(calls) == 6
+        assert second[:-1] == first
+        assert second == MessageConverter().convert_messages(history, "m")
+
+        # 前缀中的消息变化后，从变化处开始重新转换
+        history[3] = {"role": "user", "content": "edited"}
+        third = converter.convert_messages(history, "m")
+        assert len(calls) == 9
+        assert third[3] == {"role": "user", "content": "edited"}
+
+    def test_message_budget_evicts_sessions(self) -> None:
+        """测试消息总条数超出上限时淘汰最久未使用的会话"""
+        converter = MessageConverter()
+        converter.conversion_cache.configure(8, max_messages=10)
+        for session in range(3):
+            history = [
+                {"role": "user", "content": f"session {session} message {i}"}
+                for i in range(4)
+            ]
+            converter.convert_messages(history, "m")
+        stats = converter.conversion_cache.stats()
+        assert stats["size"] == 2
+        assert stats["weight"] == 8
+
+    def test_skip_cache(self) -> None:
+        """测试 use_cache=False 时不写入会话缓存"""
+        converter = MessageConverter()
+        converter.conversion_cache.configure(8)
+        history = [{"role": "user", "content": "recent"}]
+        out = converter.convert_messages(history, "m", use_cache=False)
+        assert out == [{"role": "user", "content": "recent"}]
+        assert converter.conversion_cache.stats()["size"] == 0
+
+
+def _tool_turn(i: int, size: int) -> List[Dict[str, Any]]:
+    """一轮对话：用户提问、助手调用工具、回传工具结果"""
+    return [
+        {"role": "user", "content": f"question {i}"},
+        {
+            "role": "assistant",
+            "content": [
+                {"type": "tool_use", "id": f"c{i}", "name": "Read", "input": {}}
+            ],
+        },
+        {
+            "role": "user",
+            "content": [
+                {"type": "tool_result", "tool_use_id": f"c{i}", "content": "x" * size}
+            ],
+        },
+    ]
+
+
+class TestHistoryCompactor:
+    """测试对话历史压缩"""
+
+    def test_truncate_old_tool_results_first(self) -> None:
+        """测试优先截断最近轮次之前的工具结果，最近轮次保持不变"""
+        msgs = [m for i in range(4) for m in _tool_turn(i, 8000)]
+        compacted, removed = HistoryCompactor().compact(msgs, 1500, 2, 1000)
+        assert removed >= 1500
+        assert len(compacted) == len(msgs)
+        assert len(compacted[2]["content"][0]["content"]) < 1100
+        assert compacted[5] is msgs[5]
+        assert compacted[6:] == msgs[6:]
+        # 不修改原始消息
+        assert len(msgs[2]["content"][0]["content"]) == 8000
+
+    def test_drop_old_turns_keeps_first(self) -> None:
+        """测试截断仍不足时从第二轮开始整轮删除"""
+        msgs = [m for i in range(5) for m in _tool_turn(i, 100)]
+        compacted, _ = HistoryCompactor().compact(msgs, 150, 1, 1000)
+        assert compacted[0] == msgs[0]
+        assert compacted[-3:] == msgs[-3:]
+        assert len(compacted) < len(msgs)
+        assert HistoryCompactor.is_turn_start(compacted[3])
+
+    def test_converter_applies_budget(self) -> None:
+        """测试超出模型预算时压缩转换后的消息"""
+        settings = config_manager.settings.model_copy(
+            update={
+                "history_token_budgets": {"*": 3000},
+                "history_keep_recent_turns": 1,
+                "enable_tool_selection": False,
+            }
+        )
+        msgs = [m for i in range(4) for m in _tool_turn(i, 8000)]
+        converter = MessageConverter()
+        out = converter.convert_anthropic_to_openai_messages(
+            {"model": "m", "messages": msgs}, settings
+        )
+        assert sum(len(str(m["content"])) for m in out) < 4 * 3000
+        assert out[-1]["content"].endswith("x" * 8000)
+        assert converter.compactor.stats["compacted"] == 1
+        assert converter.compactor.stats["tokens_saved"] > 0
+
+    def test_budget_uses_configured_tokenizer(self) -> None:
+        """测试预算按 count_tokens 所用的同一分词器计算"""
+        settings = config_manager.settings.model_copy(
+            update={
+                "history_token_budgets": {"*": 3000},
+                "history_keep_recent_turns": 1,
+                "enable_tool_selection": False,
+                "tokenizer": "heuristic",
+                "tokenizer_chars_per_token": 40.0,
+            }
+        )
+        msgs = [m for i in range(4) for m in _tool_turn(i, 8000)]
+        converter = MessageConverter()
+        out = converter.convert_anthropic_to_openai_messages(
+            {"model": "m", "messages": msgs}, settings
+        )
+        assert converter.compactor.stats["compacted"] == 0
+        assert get_token_counter(settings).count_messages(out) < 3000
+
+
+class _CompletionResult:
+    """模拟的非流式模型响应"""
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self._data = data
+
+    def model_dump(self) -> Dict[str, Any]:
+        return self._data
+
+
+class FakeUpstream:
+    """模拟上游客户端，记录调用次数"""
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    async def create(self, **payload: Any) -> Any:
+        self.calls += 1
+        return _CompletionResult(
+            {
+                "id": "chatcmpl-1",
+                "model": payload["model"],
+                "choices": [
+                    {"message": {"content": "cached answer"}, "finish_reason": "stop"}
+                ],
+                "usage": {"prompt_tokens": 3, "completion_tokens": 2},
+            }
+        )
+
+
+class FakeRegistry:
+    """返回模拟上游的客户端注册表"""
+
+    def __init__(self, upstream: FakeUpstream) -> None:
+        completions = SimpleNamespace(create=upstream.create)
+        self.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    def pool_options(self, cfg: Any) -> Any:
+        return None
+
+    def get(self, url: str, key: str, options: Any) -> Any:
+        return self.client
+
+
+class TestResponseCache:
+    """测试确定性请求的响应缓存"""
+
+    def _client(
+        self, monkeypatch: Any, upstream: FakeUpstream, db: str = ""
+    ) -> OpenAIClient:
+        settings = config_manager.settings.model_copy(
+            update={"response_cache_enabled": True, "response_cache_db": db}
+        )
+        monkeypatch.setattr(config_manager, "settings", settings)
+        cache = ResponseCache()
+        return OpenAIClient(FakeRegistry(upstream), cache)  # type: ignore[arg-type]
+
+    def test_memory_hit_and_stream_replay(self, monkeypatch: Any) -> None:
+        """测试相同 payload 命中缓存，流式请求重放为 SSE"""
+        upstream = FakeUpstream()
+        client = self._client(monkeypatch, upstream)
+        payload = {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+
+        async def run() -> List[bytes]:
+            await client.create_completion("u", "k", {**payload, "temperature": 0})
+            second = await client.create_completion(
+                "u", "k", {**payload, "temperature": 0}
+            )
+            assert second.model_dump()["choices"][0]["message"]["content"] == (
+                "cached answer"
+            )
+            # 非确定性请求不使用缓存
+            await client.create_completion("u", "k", {**payload, "temperature": 1})
+            stream = await client.create_completion(
+                "u", "k", {**payload, "temperature": 0, "stream": True}
+            )
+            return [e async for e in StreamProcessor().process_stream(stream, "m")]
+
+        events = asyncio.run(run())
+        assert upstream.calls == 2
+        assert b"cached answer" in b"".join(events)
+        assert events[-1].startswith(b"event: message_stop")
+
+    def test_disk_tier(self, monkeypatch: Any, tmp_path: Any) -> None:
+        """测试磁盘缓存在内存缓存重建后仍可命中"""
+        upstream = FakeUpstream()
+        db = str(tmp_path / "responses.db")
+        payload = {"model": "m", "messages": [], "seed": 1}
+        client = self._client(monkeypatch, upstream, db)
+        asyncio.run(client.create_completion("u", "k", payload))
+        assert client.response_cache is not None
+        client.response_cache.close()
+
+        client = self._client(monkeypatch, upstream, db)
+        asyncio.run(client.create_completion("u", "k", payload))
+        assert upstream.calls == 1
+        assert client.response_cache is not None
+        assert client.response_cache.stats()["disk_hits"] == 1
+        client.response_cache.close()
+
+
+class TestSingleFlight:
+    """测试相同上游调用的合并"""
+
+    def test_coalesce_calls(self) -> None:
+        """测试并发的相同调用共享一次上游调用"""
+        flights = SingleFlight()
+        calls = 0
+
+        async def upstream() -> str:
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "result"
+
+        async def run() -> List[str]:
+            same = [flights.call("a", upstream) for _ in range(5)]
+            return await asyncio.gather(*same, flights.call("b", upstream))
+
+        assert asyncio.run(run()) == ["result"] * 6
+        assert calls == 2
+        assert flights.stats == {"upstream_calls": 2, "coalesced": 4}
+        assert len(flights) == 0
+
+    def test_fan_out_stream(self) -> None:
+        """测试一个上游流分发给多个订阅者，晚加入的订阅者会先重放已收到的分块"""
+        flights = SingleFlight()
+
+        async def source() -> AsyncIterator[int]:
+            for i in range(5):
+                await asyncio.sleep(0.005)
+                yield i
+
+        async def upstream() -> AsyncIterator[int]:
+            return source()
+
+        async def consume(delay: float) -> List[int]:
+            await asyncio.sleep(delay)
+            subscriber = await flights.stream("s", upstream, 8)
+            return [chunk async for chunk in subscriber]
+
+        async def run() -> List[List[int]]:
+            return await asyncio.gather(consume(0), consume(0.012))
+
+        assert asyncio.run(run()) == [[0, 1, 2, 3, 4]] * 2
+        assert flights.stats == {"upstream_calls": 1, "coalesced": 1}
+
+    def test_cancel_when_all_subscribers_leave(self) -> None:
+        """测试所有订阅者离开后取消上游流"""
+        flights = SingleFlight()
+
+        class Upstream:
+            def __init__(self) -> None:
+                self.closed = False
+
+            def __aiter__(self) -> "Upstream":
+                return self
+
+            async def __anext__(self) -> int:
+                await asyncio.sleep(0.005)
+                return 1
+
+            async def close(self) -> None:
+                self.closed = True
+
+        stream = Upstream()
+
+        async def upstream() -> Upstream:
+            return stream
+
+        async def run() -> None:
+            subscriber = await flights.stream("s", upstream, 8)
+            assert await subscriber.__anext__() == 1
+            await subscriber.close()
+            await asyncio.sleep(0.01)
+
+        asyncio.run(run())
+        assert stream.closed
+        assert len(flights) == 0
+
+    def test_cancel_when_last_subscriber_overflows(self) -> None:
+        """测试唯一的订阅者因消费过慢被断开后取消上游流"""
+        flights = SingleFlight()
+        reads = 0
+
+        class Upstream:
+            def __init__(self) -> None:
+                self.closed = False
+
+            def __aiter__(self) -> "Upstream":
+                return self
+
+            async def __anext__(self) -> int:
+                nonlocal reads
+                reads += 1
+                await asyncio.sleep(0)
+                return 1
+
+            async def close(self) -> None:
+                self.closed = True
+
+        stream = Upstream()
+
+        async def upstream() -> Upstream:
+            return stream
+
+        async def run() -> None:
+            await flights.stream("s", upstream, 2)
+            await asyncio.sleep(0.02)
+
+        asyncio.run(run())
+        assert stream.closed
+        assert reads < 10
+        assert len(flights) == 0
+
+    def test_end_delivered_to_full_queue(self) -> None:
+        """测试缓冲区恰好写满时仍能收到正常的结束标记"""
+        flights = SingleFlight()
+
+        async def source() -> AsyncIterator[int]:
+            for i in range(3):
+                yield i
+
+        async def upstream() -> AsyncIterator[int]:
+            return source()
+
+        async def run() -> List[int]:
+            subscriber = await flights.stream("s", upstream, 3)
+            await asyncio.sleep(0.01)
+            return [chunk async for chunk in subscriber]
+
+        assert asyncio.run(run()) == [0, 1, 2]
+
+    def test_replay_buffer_bounded(self) -> None:
+        """测试重放缓冲区写满后不再接受晚加入的订阅者"""
+        flights = SingleFlight()
+        flights.MAX_REPLAY = 2
+
+        async def source() -> AsyncIterator[int]:
+            for i in range(4):
+                await asyncio.sleep(0.005)
+                yield i
+
+        async def upstream() -> AsyncIterator[int]:
+            return source()
+
+        async def consume(seen: Optional[asyncio.Event] = None) -> List[int]:
+            chunks: List[int] = []
+            async for chunk in await flights.stream("s", upstream, 8):
+                chunks.append(chunk)
+                if seen is not None and len(chunks) == 2:
+                    seen.set()
+            return chunks
+
+        async def run() -> List[List[int]]:
+            seen = asyncio.Event()
+            first = asyncio.ensure_future(consume(seen))
+            await seen.wait()
+            return list(await asyncio.gather(first, consume()))
+
+        assert asyncio.run(run()) == [[0, 1, 2, 3]] * 2
+        assert flights.stats == {"upstream_calls": 2, "coalesced": 0}
+        assert len(flights) == 0
+
+    def test_stream_start_error_raised(self) -> None:
+        """测试上游流建立失败（如准入控制拒绝）时直接抛出，而不是返回订阅者"""
+        flights = SingleFlight()
+
+        async def upstream() -> Any:
+            await asyncio.sleep(0.01)
+            raise OverloadedError("target_max_concurrency is overloaded")
+
+        async def run() -> List[Any]:
+            return await asyncio.gather(
+                flights.stream("s", upstream, 8),
+                flights.stream("s", upstream, 8),
+                return_exceptions=True,
+            )
+
+        results = asyncio.run(run())
+        assert all(isinstance(r, OverloadedError) for r in results)
+        assert flights.stats == {"upstream_calls": 1, "coalesced": 1}
+        assert len(flights) == 0
+
+
+def _pool(strategy: str = "least_outstanding", **kwargs: Any) -> BackendPool:
+    backends = [Backend(f"http://node{i}", "key") for i in range(3)]
+    return BackendPool(backends, strategy, **kwargs)
+
+
+class TestBackendPool:
+    """测试后端节点池的负载均衡与健康剔除"""
+
+    def test_least_outstanding(self) -> None:
+        """测试按进行中请求数均匀分配"""
+        pool = _pool()
+        picked = [pool.acquire() for _ in range(6)]
+        assert [b.in_flight for b in pool.backends] == [2, 2, 2]
+        pool.release(picked[0], 0.1)
+        assert pool.acquire() is picked[0]
+
+    def test_weights(self) -> None:
+        """测试按权重分配"""
+        pool = BackendPool(
+            [Backend("http://big", "k", 3), Backend("http://small", "k", 1)]
+        )
+        for _ in range(8):
+            pool.acquire()
+        assert [b.in_flight for b in pool.backends] == [6, 2]
+
+    def test_ewma_prefers_fast_backend(self) -> None:
+        """测试 EWMA 策略优先选择延迟低的节点"""
+        pool = _pool("ewma")
+        for backend, latency in zip(pool.backends, (0.5, 0.05, 1.0)):
+            backend.in_flight += 1
+            pool.release(backend, latency)
+        assert pool.acquire().url == "http://node1"
+
+    def test_passive_ejection(self) -> None:
+        """测试连续失败后剔除节点，到期后恢复"""
+        pool = _pool(max_failures=2, ejection_time=30.0)
+        bad = pool.backends[0]
+        for _ in range(2):
+            bad.in_flight += 1
+            pool.release(bad, None, failed=True)
+        assert all(pool.acquire() is not bad for _ in range(10))
+        bad.ejected_until = 0.0
+        assert any(pool.acquire() is bad for _ in range(10))
+
+    def test_prefix_affinity_sticky(self) -> None:
+        """测试相同前缀路由到同一节点，不同前缀分布到多个节点"""
+        pool = _pool("prefix_affinity")
+        keys = [hashlib.sha1(str(i).encode()).hexdigest() for i in range(30)]
+        first = []
+        for key in keys:
+            backend = pool.acquire(key)
+            pool.release(backend, 0.1)
+            first.append(backend)
+        assert len({b.url for b in first}) == 3
+        for key, expected in zip(keys, first):
+            backend = pool.acquire(key)
+            pool.release(backend, 0.1)
+            assert backend is expected
+        assert pool.affinity_stats["hits"] == 30
+        assert pool.affinity_hit_rate() == 1.0
+
+    def test_prefix_affinity_bounded_load(self) -> None:
+        """测试节点超载时顺延到其他节点"""
+        pool = _pool("prefix_affinity", load_factor=1.25)
+        key = hashlib.sha1(b"hot").hexdigest()
+        picked = [pool.acquire(key) for _ in range(9)]
+        assert len({b.url for b in picked}) > 1
+        assert max(b.in_flight for b in pool.backends) <= math.ceil(1.25 * 9 / 3)
+        assert pool.affinity_stats["spilled"] > 0
+
+    def test_client_routes_to_backends(self, monkeypatch: Any) -> None:
+        """测试配置多个后端后请求分布到各节点"""
+        upstream = FakeUpstream()
+        registry = FakeRegistry(upstream)
+        urls: List[str] = []
+        get = registry.get
+
+        def record(url: str, key: str, options: Any) -> Any:
+            urls.append(url)
+            return get(url, key, options)
+
+        monkeypatch.setattr(registry, "get", record)
+        settings = config_manager.settings.model_copy(
+            update={
+                "target_backends": [{"url": "http://a"}, {"url": "http://b"}],
+                "response_cache_enabled": False,
+                "request_coalescing_enabled": False,
+            }
+        )
+        monkeypatch.setattr(config_manager, "settings", settings)
+        client = OpenAIClient(
+            registry, backends_setting="target_backends"  # type: ignore[arg-type]
+        )
+
+        async def run() -> None:
+            for _ in range(4):
+                await client.create_completion("http://ignored", "k", {"model": "m"})
+
+        asyncio.run(run())
+        assert sorted(urls) == ["http://a", "http://a", "http://b", "http://b"]
+        pool = client.backend_pool(settings, "k")
+        assert pool is not None
+        assert all(b["in_flight"] == 0 for b in pool.snapshot())
+
+
+class SlowUpstream(FakeUpstream):
+    """响应前等待的模拟上游"""
+
+    async def create(self, **payload: Any) -> Any:
+        await asyncio.sleep(0.05)
+        return await super().create(**payload)
+
+
+class TestAdmissionControl:
+    """测试并发限制与有界等待队列"""
+
+    def test_queue_and_shed(self) -> None:
+        """测试超限请求排队，队列已满时立即拒绝"""
+
+        async def run() -> None:
+            limiter = ConcurrencyLimiter("test", 1, max_queue=1, max_wait=1.0)
+            release = await limiter.acquire()
+            waiter = asyncio.create_task(limiter.acquire())
+            await asyncio.sleep(0)
+            assert limiter.queue_depth == 1
+            with pytest.raises(OverloadedError):
+                await limiter.acquire()
+            release()
+            release()  # 重复释放无副作用
+            (await waiter)()
+            stats = limiter.stats()
+            assert stats["admitted"] == 2
+            assert stats["rejected"] == 1
+            assert stats["max_queue_depth"] == 1
+            assert stats["in_flight"] == 0 and stats["queue_depth"] == 0
+
+        asyncio.run(run())
+
+    def test_wait_timeout(self) -> None:
+        """测试排队超时后拒绝"""
+
+        async def run() -> None:
+            limiter = ConcurrencyLimiter("test", 1, max_queue=5, max_wait=0.01)
+            await limiter.acquire()
+            with pytest.raises(OverloadedError):
+                await limiter.acquire()
+            assert limiter.stats()["timed_out"] == 1
+            assert limiter.queue_depth == 0
+
+        asyncio.run(run())
+
+    def test_client_route_limit(self, monkeypatch: Any) -> None:
+        """测试路由并发上限：超出的请求被拒绝，完成后释放名额"""
+        upstream = SlowUpstream()
+        settings = config_manager.settings.model_copy(
+            update={
+                "target_max_concurrency": 1,
+                "admission_queue_size": 0,
+                "response_cache_enabled": False,
+                "request_coalescing_enabled": False,
+            }
+        )
+        monkeypatch.setattr(config_manager, "settings", settings)
+        client = OpenAIClient(
+            FakeRegistry(upstream),  # type: ignore[arg-type]
+            concurrency_setting="target_max_concurrency",
+        )
+
+        async def run() -> List[Any]:
+            return await asyncio.gather(
+                *(
+                    client.create_completion("http://a", "k", {"model": "m"})
+                    for _ in range(2)
+                ),
+                return_exceptions=True,
+            )
+
+        results = asyncio.run(run())
+        assert sum(isinstance(r, OverloadedError) for r in results) == 1
+        assert upstream.calls == 1
+        assert client.limiter.in_flight == 0
+
+
+class TestFairScheduling:
+    """测试等待队列的优先级与公平调度"""
+
+    @staticmethod
+    async def _dispatch_order(flows: List[Tuple[str, float]]) -> List[str]:
+        limiter = ConcurrencyLimiter("test", 1, max_queue=100, max_wait=5.0)
+        release = await limiter.acquire()
+        order: List[str] = []
+
+        async def waiter(name: str, weight: float) -> None:
+            done = await limiter.acquire(name, weight)
+            order.append(name)
+            await asyncio.sleep(0)
+            done()
+
+        tasks = []
+        for name, weight in flows:
+            tasks.append(asyncio.create_task(waiter(name, weight)))
+            await asyncio.sleep(0)
+        release()
+        await asyncio.gather(*tasks)
+        return order
+
+    def test_fair_between_callers(self) -> None:
+        """测试请求量大的调用方不会饿死其他调用方"""
+        flows = [("heavy", 1.0)] * 4 + [("light", 1.0)] * 2
+        order = asyncio.run(self._dispatch_order(flows))
+        assert order[:4] == ["heavy", "light", "heavy", "light"]
+
+    def test_weighted_classes(self) -> None:
+        """测试权重高的类别优先获得名额"""
+        flows = [("bulk", 1.0)] * 5 + [("interactive", 4.0)] * 5
+        order = asyncio.run(self._dispatch_order(flows))
+        assert order[:6].count("interactive") == 4
+
+    def test_request_priority(self) -> None:
+        """测试按路由、流式与调用方匹配优先级规则"""
+        settings = config_manager.settings.model_copy(
+            update={
+                "priority_rules": [
+                    {"caller": "batch-*", "class": "bulk"},
+                    {"route": "tool_selection", "class": "tool_selection"},
+                    {"stream": True, "class": "interactive"},
+                ],
+                "priority_classes": {"bulk": 1.0, "interactive": 8.0},
+            }
+        )
+        assert request_priority(settings, "target", True, "batch-1") == ("bulk", 1.0)
+        assert request_priority(settings, "target", True, "alice") == (
+            "interactive",
+            8.0,
+        )
+        assert request_priority(settings, "tool_selection", False, "alice")[0] == (
+            "tool_selection"
+        )
+        assert request_priority(settings, "target", False, "alice")[0] == "default"
+
+    def test_class_stats(self, monkeypatch: Any) -> None:
+        """测试按类别记录排队时间与延迟"""
+        monkeypatch.setattr(
+            config_manager,
+            "settings",
+            config_manager.settings.model_copy(
+                update={
+                    "response_cache_enabled": False,
+                    "request_coalescing_enabled": False,
+                }
+            ),
+        )
+        client = OpenAIClient(FakeRegistry(FakeUpstream()))  # type: ignore[arg-type]
+        asyncio.run(client.create_completion("http://a", "k", {"model": "m"}))
+        stats = client.class_stats["bulk"]
+        assert stats["requests"] == 1
+        assert stats["latency_total"] >= 0
+
+    def test_shared_backend_queue_across_routes(self, monkeypatch: Any) -> None:
+        """测试目标模型与工具选择请求发往同一节点时在同一个公平队列中排队"""
+        backends = [{"url": "http://gpu", "max_concurrency": 1}]
+        monkeypatch.setattr(
+            config_manager,
+            "settings",
+            config_manager.settings.model_copy(
+                update={
+                    "response_cache_enabled": False,
+                    "request_coalescing_enabled": False,
+                    "target_backends": backends,
+                    "tool_selection_backends": backends,
+                }
+            ),
+        )
+        order: List[str] = []
+
+        class RecordingUpstream(FakeUpstream):
+            async def create(self, **payload: Any) -> Any:
+                order.append(payload["model"])
+                await asyncio.sleep(0)
+                return await super().create(**payload)
+
+        registry = RoutingRegistry({"http://gpu": RecordingUpstream()})
+        shared = BackendLimiters()
+        target = OpenAIClient(
+            registry,  # type: ignore[arg-type]
+            backends_setting="target_backends",
+            backend_limiters=shared,
+        )
+        selection = OpenAIClient(
+            registry,  # type: ignore[arg-type]
+            backends_setting="tool_selection_backends",
+            route="tool_selection",
+            backend_limiters=shared,
+        )
+
+        async def run() -> None:
+            limiter = shared.get("http://gpu", 1, 100, 5.0)
+            assert limiter is not None
+            release = await limiter.acquire()
+
+            async def queued(depth: int) -> None:
+                for _ in range(100):
+                    if limiter.queue_depth >= depth:
+                        return
+                    await asyncio.sleep(0)
+                raise AssertionError(f"queue depth {limiter.queue_depth} < {depth}")
+
+            tasks = [
+                asyncio.create_task(
+                    target.create_completion("http://a", "k", {"model": "bulk"})
+                )
+                for _ in range(5)
+            ]
+            await queued(5)
+            tasks.append(
+                asyncio.create_task(
+                    selection.create_completion("http://b", "k", {"model": "select"})
+                )
+            )
+            await queued(6)
+            release()
+            await asyncio.gather(*tasks)
+
+        asyncio.run(run())
+        assert target.pool is not None and selection.pool is not None
+        assert target.pool.backends[0].limiter is selection.pool.backends[0].limiter
+        # 工具选择类别权重更高，越过排在前面的批量请求
+        assert order.index("select") <= 1
+
+
+class StatusError(Exception):
+    """带状态码的上游错误"""
+
+    def __init__(self, status_code: int) -> None:
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+class ScriptedUpstream(FakeUpstream):
+    """按顺序执行预设行为的模拟上游：异常则抛出，数字则先等待相应秒数"""
+
+    def __init__(self, script: List[Any], chunks: Any = None) -> None:
+        super().__init__()
+        self.script = list(script)
+        self.chunks = chunks
+
+    async def create(self, **payload: Any) -> Any:
+        step = self.script.pop(0) if self.script else 0
+        if isinstance(step, Exception):
+            self.calls += 1
+            raise step
+        await asyncio.sleep(step)
+        if payload.get("stream"):
+            self.calls += 1
+            return self.chunks()
+        return await super().create(**payload)
+
+
+class RoutingRegistry:
+    """按地址返回不同模拟上游的客户端注册表"""
+
+    def __init__(self, upstreams: Dict[str, FakeUpstream]) -> None:
+        self.clients = {
+            url: FakeRegistry(upstream).client for url, upstream in upstreams.items()
+        }
+
+    def pool_options(self, cfg: Any) -> Any:
+        return None
+
+    def get(self, url: str, key: str, options: Any) -> Any:
+        return self.clients[url]
+
+
+class TestRetryAndHedging:
+    """测试上游重试、时限与对冲请求"""
+
+    @staticmethod
+    def _settings(monkeypatch: Any, **update: Any) -> None:
+        settings = config_manager.settings.model_copy(
+            update={
+                "response_cache_enabled": False,
+                "request_coalescing_enabled": False,
+                "upstream_retry_backoff": 0.0,
+                **update,
+            }
+        )
+        monkeypatch.setattr(config_manager, "settings", settings)
+
+    def test_retry_on_5xx(self, monkeypatch: Any) -> None:
+        """测试 5xx 重试后成功，4xx 不重试"""
+        self._settings(monkeypatch, upstream_max_retries=2)
+        upstream = ScriptedUpstream([StatusError(503), 0])
+        client = OpenAIClient(FakeRegistry(upstream))  # type: ignore[arg-type]
+        result = asyncio.run(client.create_completion("http://a", "k", {"model": "m"}))
+        assert result.model_dump()["model"] == "m"
+        assert upstream.calls == 2
+        assert client.attempt_stats["retries"] == 1
+        assert client.attempt_stats["error"] == 1
+
+        upstream = ScriptedUpstream([StatusError(400), 0])
+        client = OpenAIClient(FakeRegistry(upstream))  # type: ignore[arg-type]
+        with pytest.raises(StatusError):
+            asyncio.run(client.create_completion("http://a", "k", {"model": "m"}))
+        assert upstream.calls == 1
+
+    def test_stream_first_byte_timeout(self, monkeypatch: Any) -> None:
+        """测试流式首个分块超时后重试，重试前未向调用方返回任何数据"""
+        self._settings(
+            monkeypatch, upstream_max_retries=1, upstream_first_byte_timeout=0.05
+        )
+        delays = [1.0, 0.0]
+
+        async def chunks() -> AsyncIterator[str]:
+            await asyncio.sleep(delays.pop(0))
+            yield "first"
+            yield "second"
+
+        upstream = ScriptedUpstream([0, 0], chunks)
+        client = OpenAIClient(FakeRegistry(upstream))  # type: ignore[arg-type]
+
+        async def run() -> List[str]:
+            stream = await client.create_completion(
+                "http://a", "k", {"model": "m", "stream": True}
+            )
+            return [chunk async for chunk in stream]
+
+        assert asyncio.run(run()) == ["first", "second"]
+        assert client.attempt_stats["timeout"] == 1
+        assert client.attempt_stats["ok"] == 1
+
+        self._settings(
+            monkeypatch, upstream_max_retries=0, upstream_first_byte_timeout=0.05
+        )
+        delays.append(1.0)
+        with pytest.raises(UpstreamTimeoutError):
+            asyncio.run(run())
+
+    def test_stream_total_deadline(self, monkeypatch: Any) -> None:
+        """测试流的总时限只设置一个定时器，分块停滞超过总时限时超时"""
+        self._settings(monkeypatch, upstream_max_retries=0, upstream_total_timeout=0.1)
+        stall = [0.0]
+
+        async def chunks() -> AsyncIterator[int]:
+            for i in range(50):
+                yield i
+            await asyncio.sleep(stall[0])
+            yield 50
+
+        upstream = ScriptedUpstream([0, 0], chunks)
+        client = OpenAIClient(FakeRegistry(upstream))  # type: ignore[arg-type]
+        wait_for = asyncio.wait_for
+        waits = 0
+
+        async def counting_wait_for(aw: Any, timeout: Any) -> Any:
+            nonlocal waits
+            waits += 1
+            return await wait_for(aw, timeout)
+
+        monkeypatch.setattr(asyncio, "wait_for", counting_wait_for)
+
+        async def run() -> List[int]:
+            stream = await client.create_completion(
+                "http://a", "k", {"model": "m", "stream": True}
+            )
+            return [chunk async for chunk in stream]
+
+        assert asyncio.run(run()) == list(range(51))
+        # 只有建立连接与预取首个分块使用 wait_for，后续分块不再逐个包装
+        assert waits == 2
+
+        stall[0] = 1.0
+        with pytest.raises(UpstreamTimeoutError):
+            asyncio.run(run())
+        assert client.attempt_stats["ok"] == 2
+
+    def test_limiter_rejection_not_recorded(self, monkeypatch: Any) -> None:
+        """测试被节点并发限制拒绝的尝试不计入节点的成功或失败"""
+        self._settings(
+            monkeypatch,
+            target_backends=[{"url": "http://gpu", "max_concurrency": 1}],
+            admission_queue_size=0,
+        )
+        client = OpenAIClient(
+            RoutingRegistry({"http://gpu": FakeUpstream()}),  # type: ignore[arg-type]
+            backends_setting="target_backends",
+        )
+        settings = config_manager.settings
+        pool = client.backend_pool(settings, "k")
+        assert pool is not None
+        backend = pool.backends[0]
+        backend.consecutive_failures = 1
+
+        async def run() -> None:
+            limiter = client.backend_limiters.get(
+                "http://gpu",
+                1,
+                settings.admission_queue_size,
+                settings.admission_queue_timeout,
+            )
+            assert limiter is not None
+            release = await limiter.acquire()
+            with pytest.raises(OverloadedError):
+                await client.create_completion("http://a", "k", {"model": "m"})
+            release()
+
+        asyncio.run(run())
+        assert backend.consecutive_failures == 1
+        assert backend.in_flight == 0
+
+    def test_hedged_request(self, monkeypatch: Any) -> None:
+        """测试超过 p95 延迟后向另一个节点对冲，先返回者胜出"""
+        self._settings(
+            monkeypatch,
+            target_backends=[{"url": "http://slow"}, {"url": "http://fast"}],
+            load_balancing_strategy="least_outstanding",
+            upstream_hedging_enabled=True,
+            upstream_hedge_min_delay=0.01,
+        )
+        slow = ScriptedUpstream([1.0])
+        fast = ScriptedUpstream([0])
+        client = OpenAIClient(
+            RoutingRegistry(
+                {"http://slow": slow, "http://fast": fast}
+            ),  # type: ignore[arg-type]
+            backends_setting="target_backends",
+        )
+        client._latencies.extend([0.01] * OpenAIClient.HEDGE_MIN_SAMPLES)
+        pool = client.backend_pool(config_manager.settings, "k")
+        assert pool is not None
+        # 让首次请求落到慢节点
+        pool.backends[1].in_flight = 1
+        asyncio.run(client.create_completion("http://a", "k", {"model": "m"}))
+        pool.backends[1].in_flight -= 1
+        assert fast.calls == 1
+        assert client.attempt_stats["hedges"] == 1
+        assert client.attempt_stats["hedge_wins"] == 1
+        assert client.attempt_stats["cancelled"] == 1
+        assert [b["in_flight"] for b in pool.snapshot()] == [0, 0]
+
+    def test_hedge_skipped_when_circuits_open(self, monkeypatch: Any) -> None:
+        """测试对冲时其余节点均已熔断，继续等待主请求而不是取消它"""
+        self._settings(
+            monkeypatch,
+            upstream_hedging_enabled=True,
+            upstream_hedge_min_delay=0.01,
+        )
+        client = OpenAIClient(FakeRegistry(FakeUpstream()))  # type: ignore[arg-type]
+        client._latencies.extend([0.01] * OpenAIClient.HEDGE_MIN_SAMPLES)
+        primary = _Attempt(None, Backend("http://a", "k"))
+        selections = 0
+
+        def select() -> _Attempt:
+            nonlocal selections
+            selections += 1
+            if selections > 1:
+                raise CircuitOpenError("all backends open")
+            return primary
+
+        async def run(attempt: _Attempt) -> _Attempt:
+            await asyncio.sleep(0.05)
+            return attempt
+
+        pool = _pool()
+        result = asyncio.run(
+            client._hedged_attempt(config_manager.settings, pool, select, run)
+        )
+        assert result is primary
+        assert selections == 2
+        assert client.attempt_stats["hedges"] == 0
+        assert client.attempt_stats["cancelled"] == 0
+
+
+class TestCircuitBreaker:
+    """测试熔断器与降级"""
+
+    @staticmethod
+    def _settings(**update: Any) -> Any:
+        return config_manager.settings.model_copy(
+            update={
+                "circuit_breaker_enabled": True,
+                "circuit_window": 4,
+                "circuit_min_requests": 2,
+                "circuit_error_rate": 0.5,
+                "circuit_open_time": 30.0,
+                "response_cache_enabled": False,
+                "request_coalescing_enabled": False,
+                "upstream_max_retries": 0,
+                **update,
+            }
+        )
+
+    def test_state_transitions(self) -> None:
+        """测试错误率超过阈值时打开，半开探测成功后关闭、失败后重新打开"""
+        breaker = CircuitBreaker("http://a")
+        breaker.configure(self._settings())
+        breaker.record(False, 0.1)
+        breaker.record(True, None)
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.available()
+
+        breaker.open_time = 0.0
+        assert breaker.available()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        breaker.begin()
+        assert not breaker.available()  # 探测名额已占用
+        breaker.record(True, None)
+        assert breaker.state == CircuitBreaker.OPEN
+
+        assert breaker.available()
+        breaker.begin()
+        breaker.record(False, 0.1)
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.trips == 2
+
+    def test_slow_calls_trip(self) -> None:
+        """测试慢请求比例超过阈值时打开"""
+        breaker = CircuitBreaker("http://a")
+        breaker.configure(self._settings(circuit_slow_threshold=1.0))
+        breaker.record(False, 2.0)
+        breaker.record(False, 3.0)
+        assert breaker.state == CircuitBreaker.OPEN
+
+    def test_open_circuit_fails_fast_or_falls_back(self, monkeypatch: Any) -> None:
+        """测试熔断后不再请求故障后端：未配置降级时立即失败，配置后改用降级目标"""
+        monkeypatch.setattr(config_manager, "settings", self._settings())
+        down = ScriptedUpstream([StatusError(503)] * 2)
+        backup = ScriptedUpstream([])
+        registry = RoutingRegistry({"http://a": down, "http://backup": backup})
+        client = OpenAIClient(
+            registry,  # type: ignore[arg-type]
+            fallback_setting="target_fallback",
+        )
+
+        async def call() -> Any:
+            return await client.create_completion("http://a", "k", {"model": "m"})
+
+        for _ in range(2):
+            with pytest.raises(StatusError):
+                asyncio.run(call())
+        with pytest.raises(CircuitOpenError):
+            asyncio.run(call())
+        assert down.calls == 2
+        assert client.breakers["http://a"].snapshot()["state"] == "open"
+
+        monkeypatch.setattr(
+            config_manager,
+            "settings",
+            self._settings(
+                target_fallback={"base_url": "http://backup", "model": "small"}
+            ),
+        )
+        result = asyncio.run(call())
+        assert result.model_dump()["model"] == "small"
+        assert backup.calls == 1
+        assert down.calls == 2
+
+    def test_pool_skips_open_backend(self, monkeypatch: Any) -> None:
+        """测试节点池跳过熔断的节点"""
+        monkeypatch.setattr(
+            config_manager,
+            "settings",
+            self._settings(target_backends=[{"url": "http://a"}, {"url": "http://b"}]),
+        )
+        a, b = ScriptedUpstream([]), ScriptedUpstream([])
+        client = OpenAIClient(
+            RoutingRegistry({"http://a": a, "http://b": b}),  # type: ignore[arg-type]
+            backends_setting="target_backends",
+        )
+        breaker = client.breaker(config_manager.settings, "http://a")
+        assert breaker is not None
+        breaker.record(True, None)
+        breaker.record(True, None)
+
+        async def run() -> None:
+            for _ in range(4):
+                await client.create_completion("http://x", "k", {"model": "m"})
+
+        asyncio.run(run())
+        assert (a.calls, b.calls) == (0, 4)
+
+
+class BackendStream:
+    """模拟带后端地址的上游流：按间隔返回分块，最后一个分块带 usage"""
+
+    def __init__(self, backend: str, n: int, gap: float = 0.0) -> None:
+        self.backend = backend
+        self.n = n
+        self.gap = gap
+
+    async def __aiter__(self) -> AsyncIterator[Dict[str, Any]]:
+        for i in range(self.n):
+            await asyncio.sleep(self.gap)
+            chunk: Dict[str, Any] = {"choices": [{"delta": {"content": "x"}}]}
+            if i == self.n - 1:
+                chunk["usage"] = {"completion_tokens": 40}
+            yield chunk
+
+
+class TestStreamTimer:
+    """测试流式响应计时"""
+
+    def test_completed_stream(self) -> None:
+        """测试记录 TTFT、分块间隔、总时长与按 usage 计算的输出速率"""
+        labels = ("http://timer-a", "m")
+        before = metrics.stream_chunk_gap.count(*labels)
+
+        async def run() -> StreamTimer:
+            stream = BackendStream("http://timer-a", 4, 0.01)
+            timer = StreamTimer(stream, "m", time.perf_counter())
+            async for _ in timer.chunks():
+                pass
+            timer.finish(False)
+            return timer
+
+        timer = asyncio.run(run())
+        assert timer.chunk_count == 4
+        assert timer.output_tokens == 40
+        assert metrics.stream_ttft.count(*labels) >= 1
+        assert metrics.stream_chunk_gap.count(*labels) == before + 3
+        assert metrics.stream_duration.count(*labels) >= 1
+        assert metrics.stream_tokens_per_second.count(*labels) >= 1
+        assert metrics.stream_disconnects.value(*labels) == 0
+
+    def test_disconnect(self) -> None:
+        """测试客户端断开时计入断开次数且不记录输出速率"""
+        labels = ("http://timer-b", "m")
+
+        async def run() -> None:
+            timer = StreamTimer(BackendStream("http://timer-b", 3), "m", 0.0)
+            async for _ in timer.chunks():
+                break
+            timer.finish(True)
+
+        asyncio.run(run())
+        assert metrics.stream_disconnects.value(*labels) == 1
+        assert metrics.stream_tokens_per_second.count(*labels) == 0
+
+    def test_model_label_bounded(self, monkeypatch: Any) -> None:
+        """测试超出模型标签上限的模型名记为 other"""
+        monkeypatch.setattr(metrics, "model_labels", metrics.LabelSet(1))
+        assert StreamTimer(None, "known", 0.0).model == "known"
+        assert StreamTimer(None, "client-supplied", 0.0).model == "other"
+
+
+class HeaderRecorder(FakeUpstream):
+    """记录每次调用的额外请求头"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.headers: List[Any] = []
+
+    async def create(self, **payload: Any) -> Any:
+        self.headers.append(payload.pop("extra_headers", None))
+        return await super().create(**payload)
+
+
+class TestUpstreamTracing:
+    """测试上游请求的追踪与请求 ID 转发"""
+
+    def test_request_id_and_spans(self, monkeypatch: Any) -> None:
+        """测试请求 ID 随请求头转发给上游，上游请求与每次尝试记录为 span"""
+        settings = config_manager.settings.model_copy(
+            update={"tracing_enabled": True, "request_coalescing_enabled": False}
+        )
+        monkeypatch.setattr(config_manager, "settings", settings)
+        tracer.configure(settings)
+        upstream = HeaderRecorder()
+        client = OpenAIClient(FakeRegistry(upstream))  # type: ignore[arg-type]
+        payload = {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+
+        async def run() -> None:
+            current_request_id.set("upstream-1")
+            root = tracer.start_trace("req")
+            await client.create_completion("http://a", "k", payload)
+            tracer.finish_trace(root)
+
+        try:
+            asyncio.run(run())
+        finally:
+            tracer.configure(settings.model_copy(update={"tracing_enabled": False}))
+        assert upstream.headers == [{"x-request-id": "upstream-1"}]
+        trace = tracer.memory.get("upstream-1")
+        assert trace is not None
+        spans = {s["name"]: s for s in trace["spans"]}
+        assert spans["upstream"]["attributes"]["payload_bytes"] > 0
+        assert spans["upstream_attempt"]["parent_id"] == spans["upstream"]["span_id"]
+        assert spans["upstream_attempt"]["attributes"]["backend"] == "http://a"
@@ -0,0 +1,93 @@
+"""
+本地 token 计数测试
+"""
+
+import base64
+from pathlib import Path
+
+import pytest
+
+from src.claude_code_adapter.tokenizer import (
+    BPETokenizer,
+    HeuristicTokenizer,
+    TokenCounter,
+    Tokenizer,
+)
+from src.claude_code_adapter.utils import estimate_message_tokens, estimate_tokens
+
+
+def _write_vocab(path: Path, tokens: list) -> None:
+    """写入 tiktoken 格式的词表：全部单字节加上给定的合并结果"""
+    vocab = [bytes([i]) for i in range(256)] + tokens
+    path.write_bytes(
+        b"\n".join(base64.b64encode(t) + b" %d" % rank for rank, t in enumerate(vocab))
+    )
+
+
+class TestHeuristicTokenizer:
+    """测试启发式分词器"""
+
+    def test_ascii_and_cjk(self) -> None:
+        """测试英文按字符比例、中文按字符计数"""
+        tokenizer = HeuristicTokenizer(chars_per_token=4.0)
+        assert tokenizer.count("") == 0
+        assert tokenizer.count("abcdefgh") == 2
+        assert tokenizer.count("你好世界") == 4
+
+    def test_matches_estimator(self) -> None:
+        """测试启发式分词器与 utils 估算函数一致"""
+        text = "hello 世界, 0123456789"
+        assert HeuristicTokenizer().count(text) == estimate_tokens(text)
+
+    def test_base_is_abstract(self) -> None:
+        """测试分词器基类不能直接实例化"""
+        with pytest.raises(TypeError):
+            Tokenizer()  # type: ignore[abstract]
+
+    def test_calibration(self) -> None:
+        """测试按目标模型校准比例"""
+        assert HeuristicTokenizer(chars_per_token=2.0).count("abcdefgh") == 4
+
+
+class TestBPETokenizer:
+    """测试字节级 BPE 分词器"""
+
+    def test_merge_by_rank(self, tmp_path: Path) -> None:
+        """测试按合并优先级合并字节对"""
+        vocab = tmp_path / "vocab.tiktoken"
+        _write_vocab(vocab, [b"he", b"ll", b"hell", b"hello", b" w"])
+        tokenizer = BPETokenizer.from_file(str(vocab))
+        assert tokenizer.count("hello") == 1
+        # " world" → " w" + o + r + l + d
+        assert tokenizer.count("hello world") == 6
+        # 片段结果被缓存，重复计数结果一致
+        assert tokenizer.count("hello hello") == tokenizer.count("hello hello")
+
+
+class TestTokenCounter:
+    """测试消息计数与缓存"""
+
+    def test_message_cache(self) -> None:
+        """测试相同内容的消息命中缓存"""
+        counter = TokenCounter(HeuristicTokenizer())
+        message = {"role": "user", "content": "x" * 400}
+        first = counter.count_message(message)
+        assert first == 100 + 4
+        assert counter.count_message({"role": "user", "content": "x" * 400}) == first
+        assert counter.stats()["hits"] == 1
+        assert counter.count_messages([message, {"role": "user", "content": "y"}]) == (
+            first + 5
+        )
+
+    def test_cache_key_is_digest(self) -> None:
+        """测试缓存键为固定长度摘要，计数与估算函数一致"""
+        counter = TokenCounter(HeuristicTokenizer())
+        message = {
+            "role": "assistant",
+            "content": "x" * 10000,
+            "tool_calls": [{"function": {"name": "read", "arguments": "{}"}}],
+        }
+        key = counter._cache_key(message)
+        assert isinstance(key, bytes) and len(key) == 16
+        assert key != counter._cache_key({**message, "content": "x" * 9999})
+        assert counter.count_message(message) == estimate_message_tokens(message)
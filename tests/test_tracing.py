@@ -0,0 +1,168 @@
+"""
+请求级追踪测试
+"""
+
+import asyncio
+import json
+import threading
+from pathlib import Path
+from typing import Any, Dict, List
+
+import pytest
+
+from src.claude_code_adapter.config import config_manager
+from src.claude_code_adapter.tracing import (
+    NOOP_SPAN,
+    JsonlExporter,
+    MemoryExporter,
+    TraceExporter,
+    Tracer,
+    current_request_id,
+)
+
+
+def _tracer(**overrides: Any) -> Tracer:
+    tracer = Tracer()
+    tracer.configure(
+        config_manager.settings.model_copy(
+            update={"tracing_enabled": True, **overrides}
+        )
+    )
+    return tracer
+
+
+class ListExporter(TraceExporter):
+    """记录导出结果的自定义导出器"""
+
+    def __init__(self) -> None:
+        self.traces: List[Dict[str, Any]] = []
+
+    def export(self, trace: Dict[str, Any]) -> None:
+        self.traces.append(trace)
+
+
+class TestTracer:
+    """测试追踪器"""
+
+    def test_disabled_is_noop(self) -> None:
+        """测试未启用追踪时返回空 span 且不导出"""
+        tracer = Tracer()
+        root = tracer.start_trace("req")
+        assert root is NOOP_SPAN
+        with tracer.span("child") as span:
+            assert not span.recording
+        tracer.finish_trace(root)
+        assert tracer.memory.recent() == []
+
+    def test_nested_spans(self) -> None:
+        """测试嵌套 span 的父子关系、属性、错误与请求 ID"""
+        tracer = _tracer()
+        exporter = ListExporter()
+        tracer.add_exporter(exporter)
+
+        async def run() -> None:
+            current_request_id.set("req-1")
+            root = tracer.start_trace("req", message_count=3)
+            with tracer.span("outer", tool_count=2) as outer:
+
+                async def child() -> None:
+                    with tracer.span("inner"):
+                        await asyncio.sleep(0)
+
+                # 子任务继承当前 span
+                await asyncio.create_task(child())
+                outer.set("selected", 1)
+            with pytest.raises(RuntimeError):
+                with tracer.span("failing"):
+                    raise RuntimeError("boom")
+            tracer.finish_trace(root)
+
+        asyncio.run(run())
+        trace = tracer.memory.get("req-1")
+        assert trace is not None and exporter.traces == [trace]
+        spans = {s["name"]: s for s in trace["spans"]}
+        assert spans["req"]["attributes"] == {"message_count": 3}
+        assert spans["outer"]["parent_id"] == spans["req"]["span_id"]
+        assert spans["inner"]["parent_id"] == spans["outer"]["span_id"]
+        assert spans["outer"]["attributes"] == {"tool_count": 2, "selected": 1}
+        assert spans["failing"]["error"] == "RuntimeError: boom"
+
+    def test_slow_threshold_and_jsonl(self, tmp_path: Path) -> None:
+        """测试只导出耗时达到阈值的追踪，并追加写入 JSONL 文件"""
+        path = tmp_path / "traces.jsonl"
+        tracer = _tracer(tracing_slow_threshold=0.05, tracing_file=str(path))
+
+        async def request(delay: float) -> None:
+            root = tracer.start_trace("req")
+            await asyncio.sleep(delay)
+            tracer.finish_trace(root)
+
+        asyncio.run(request(0))
+        asyncio.run(request(0.06))
+        tracer.close()
+        lines = path.read_text(encoding="utf-8").splitlines()
+        assert len(lines) == 1
+        assert json.loads(lines[0])["duration_ms"] >= 50
+        assert len(tracer.memory.recent()) == 1
+
+
+class TestMemoryExporter:
+    """测试内存环形缓冲区"""
+
+    def test_ring_buffer(self) -> None:
+        """测试容量限制、倒序查询与按耗时过滤"""
+        exporter = MemoryExporter(2)
+        for i, duration in enumerate((5.0, 50.0, 10.0)):
+            exporter.export({"request_id": str(i), "duration_ms": duration})
+        assert [t["request_id"] for t in exporter.recent()] == ["2", "1"]
+        assert [t["request_id"] for t in exporter.recent(min_duration_ms=20)] == ["1"]
+        assert exporter.get("0") is None
+
+    def test_base_is_abstract(self) -> None:
+        """测试导出器基类不能直接实例化"""
+        with pytest.raises(TypeError):
+            TraceExporter()  # type: ignore[abstract]
+
+
+class TestJsonlExporter:
+    """测试 JSONL 文件导出器"""
+
+    def test_background_writer(self, tmp_path: Path, monkeypatch: Any) -> None:
+        """测试写入在后台线程中完成，关闭时写完已排队的追踪"""
+        path = tmp_path / "traces.jsonl"
+        exporter = JsonlExporter(str(path))
+        writers = set()
+        dumps = json.dumps
+
+        def recording_dumps(*args: Any, **kwargs: Any) -> str:
+            writers.add(threading.current_thread().name)
+            return dumps(*args, **kwargs)
+
+        monkeypatch.setattr(json, "dumps", recording_dumps)
+        for i in range(50):
+            exporter.export({"request_id": str(i), "duration_ms": 1.0})
+        exporter.close()
+        lines = path.read_text(encoding="utf-8").splitlines()
+        assert [json.loads(line)["request_id"] for line in lines] == [
+            str(i) for i in range(50)
+        ]
+        assert writers == {"trace-writer"}
+
+    def test_drop_when_queue_full(self, tmp_path: Path, monkeypatch: Any) -> None:
+        """测试磁盘写入阻塞、队列已满时丢弃追踪而不阻塞调用方"""
+        monkeypatch.setattr(JsonlExporter, "QUEUE_SIZE", 1)
+        exporter = JsonlExporter(str(tmp_path / "traces.jsonl"))
+        unblock = threading.Event()
+        write = exporter._file.write
+
+        def blocking_write(data: str) -> int:
+            unblock.wait(5)
+            return write(data)
+
+        monkeypatch.setattr(exporter._file, "write", blocking_write)
+        for i in range(200):
+            exporter.export({"request_id": str(i), "duration_ms": 1.0})
+        # 最多一条在写入中、一条在队列中
+        assert exporter.dropped >= 198
+        unblock.set()
+        exporter.close()
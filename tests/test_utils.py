@@ -2,10 +2,24 @@
 工具函数测试
 """
 
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List
+from unittest.mock import patch
+
+from src.claude_code_adapter import utils
 from src.claude_code_adapter.utils import (
+    IncrementalToolCallParser,
+    LRUCache,
+    StructuredConfigIndex,
+    convert_tool_choice_to_openai,
     convert_tools_to_prompt,
     flatten_content,
     parse_tool_calls_from_response,
+    prefix_affinity_key,
+    supports_native_tools,
+    tool_prompt_cache_stats,
 )
 
 
@@ -58,6 +72,59 @@ class TestConvertToolsToPrompt:
         assert "test_tool" in result
         assert "A test tool" in result
 
+    def test_convert_tools_cached(self) -> None:
+        """测试相同工具列表与模板命中缓存"""
+        tools = [{"name": "cached_tool", "description": "Cached"}]
+        template = "Cached tools: {tools_json}"
+        first = convert_tools_to_prompt(tools, template)
+        hits = tool_prompt_cache_stats()["hits"]
+        second = convert_tools_to_prompt([dict(t) for t in tools], template)
+        assert second == first
+        assert tool_prompt_cache_stats()["hits"] == hits + 1
+
+    def test_convert_tools_template_in_key(self) -> None:
+        """测试模板不同时不复用缓存结果"""
+        tools = [{"name": "cached_tool", "description": "Cached"}]
+        assert convert_tools_to_prompt(tools, "A: {tools_json}").startswith("A: ")
+        assert convert_tools_to_prompt(tools, "B: {tools_json}").startswith("B: ")
+
+
+class TestLRUCache:
+    """测试有界 LRU 缓存"""
+
+    def test_evicts_least_recently_used(self) -> None:
+        """测试超出容量时淘汰最久未使用的条目"""
+        cache: LRUCache[str, int] = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        assert cache.get("a") == 1
+        cache.put("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        assert cache.stats() == {"size": 2, "maxsize": 2, "hits": 3, "misses": 1}
+
+    def test_expired_entries_miss(self) -> None:
+        """测试过期条目视为未命中"""
+        cache: LRUCache[str, int] = LRUCache(2, ttl=-1)
+        cache.put("a", 1)
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+    def test_weight_budget(self) -> None:
+        """测试条目权重之和超出上限时淘汰最久未使用的条目"""
+        cache: LRUCache[str, str] = LRUCache(10, maxweight=5, weigher=len)
+        cache.put("a", "xx")
+        cache.put("b", "yyy")
+        cache.put("a", "x")
+        assert cache.weight == 4
+        cache.put("c", "zz")
+        assert cache.get("b") is None
+        assert cache.weight == 3
+        cache.put("d", "too long")
+        assert len(cache) == 0
+        assert cache.weight == 0
+
 
 class TestParseToolCalls:
     """测试工具调用解析"""
@@ -114,3 +181,219 @@ class TestParseToolCalls:
         assert tools[0]["function"]["name"] == "tool1"
         assert tools[1]["function"]["name"] == "tool2"
         assert content == "Having multiple tool calls:"
+
+    def test_array_without_ids_gets_distinct_ids(self) -> None:
+        """测试 JSON 数组中缺少 id 的多个工具调用得到不同的 id"""
+        content = json.dumps(
+            [
+                {"type": "tool_use", "name": "Read", "input": {"path": "a"}},
+                {"type": "tool_use", "name": "Read", "input": {"path": "b"}},
+            ]
+        )
+        tools, _ = parse_tool_calls_from_response(content)
+        assert len(tools) == 2
+        assert tools[0]["id"] != tools[1]["id"]
+
+    def test_parse_bare_tool_call_with_braces_in_strings(self) -> None:
+        """测试裸 JSON 工具调用，字符串中的括号不影响匹配"""
+        content = (
+            'Fix: {"type": "tool_use", "id": "call_7", "name": "Edit", '
+            '"input": {"new_string": "if (a) { b(); }"}} done'
+        )
+        tools, clean = parse_tool_calls_from_response(content)
+        assert len(tools) == 1
+        assert json.loads(tools[0]["function"]["arguments"]) == {
+            "new_string": "if (a) { b(); }"
+        }
+        assert clean == "Fix:  done"
+
+    def test_parse_single_quoted_tool_call(self) -> None:
+        """测试单引号工具调用的兜底修复"""
+        content = "{'type': 'tool_use', 'id': 'call_8', 'name': 'Read', 'input': {}}"
+        tools, clean = parse_tool_calls_from_response(content)
+        assert [t["function"]["name"] for t in tools] == ["Read"]
+        assert clean == ""
+
+    def test_parse_tool_call_array(self) -> None:
+        """测试工具调用数组"""
+        content = (
+            '[{"type": "tool_use", "id": "a", "name": "Read", "input": {}},'
+            ' {"type": "tool_use", "id": "b", "name": "Grep", "input": {}}]'
+        )
+        tools, clean = parse_tool_calls_from_response(content)
+        assert [t["id"] for t in tools] == ["a", "b"]
+        assert clean == ""
+
+    def test_code_sample_is_not_tool_call(self) -> None:
+        """测试代码示例中的括号不会被误识别"""
+        content = "function f() { return {a: 1}; } [1, 2]"
+        tools, clean = parse_tool_calls_from_response(content)
+        assert tools == []
+        assert clean == content
+
+    def test_deep_nesting_keeps_earlier_tool_calls(self) -> None:
+        """测试嵌套过深的片段不会丢弃前面已解析的工具调用"""
+        call = '{"type": "tool_use", "id": "a", "name": "Read", "input": {}}'
+        tools, _ = parse_tool_calls_from_response(call + " " + "[" * 5000)
+        assert [t["id"] for t in tools] == ["a"]
+
+    def test_unterminated_nesting_bounded(self) -> None:
+        """测试截断的嵌套对象只做有限次解析尝试"""
+        content = '{"a": ' * 6000 + '{"type": "tool_use", "id": "b", "name": "Read"'
+        with patch.object(
+            utils._DECODER, "raw_decode", wraps=utils._DECODER.raw_decode
+        ) as raw_decode:
+            tools, _ = parse_tool_calls_from_response(content)
+        assert tools == []
+        assert raw_decode.call_count <= utils.MAX_JSON_DECODE_FAILURES
+
+
+class TestStructuredConfigIndex:
+    """测试结构化内容配置索引"""
+
+    def _write_map(self, path: Path, model_map: dict) -> None:
+        path.write_text(json.dumps(model_map), encoding="utf-8")
+        st = path.stat()
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+    def test_longest_prefix_match(self, tmp_path: Path) -> None:
+        """测试精确匹配优先，其次最长前缀匹配"""
+        path = tmp_path / "map.json"
+        self._write_map(path, {"qwen": {"id": 1}, "qwen2-vl": {"id": 2}})
+        index = StructuredConfigIndex(path, check_interval=0)
+        assert index.lookup("qwen") == {"id": 1}
+        assert index.lookup("Qwen2-VL-Max") == {"id": 2}
+        assert index.lookup("qwen3-4b") == {"id": 1}
+        assert index.lookup("llama") == {}
+
+    def test_reload_on_file_change(self, tmp_path: Path) -> None:
+        """测试映射文件变更后重新加载"""
+        path = tmp_path / "map.json"
+        self._write_map(path, {"gpt-4o": {"id": 1}})
+        index = StructuredConfigIndex(path, check_interval=0)
+        assert index.lookup("gpt-4o") == {"id": 1}
+        self._write_map(path, {"gpt-4o": {"id": 2}})
+        assert index.lookup("gpt-4o") == {"id": 2}
+
+    def test_memo_bounded(self, tmp_path: Path) -> None:
+        """测试匹配结果缓存有界，任意模型名称不会使其无限增长"""
+        path = tmp_path / "map.json"
+        self._write_map(path, {"qwen": {"id": 1}})
+        index = StructuredConfigIndex(path, check_interval=0)
+        for i in range(index.MEMO_SIZE * 2):
+            index.lookup(f"random-model-{i}")
+        assert len(index._memo) == index.MEMO_SIZE
+        assert index.lookup("qwen-max") == {"id": 1}
+
+
+def _feed_in_chunks(text: str, size: int) -> List[Dict[str, Any]]:
+    """按固定大小分段输入增量解析器"""
+    parser = IncrementalToolCallParser()
+    events: List[Dict[str, Any]] = []
+    for i in range(0, len(text), size):
+        events.extend(parser.feed(text[i : i + size]))
+    events.extend(parser.close())
+    return events
+
+
+class TestIncrementalToolCallParser:
+    """测试流式工具调用解析"""
+
+    TOOL_TEXT = (
+        "Let me read it.\n```json\n"
+        '{"type": "tool_use", "id": "call_1", "name": "Read",'
+        ' "input": {"file_path": "/a \\" }```", "n": [1, 2]}}\n'
+        "```\nDone."
+    )
+
+    def test_tool_call_any_chunking(self) -> None:
+        """测试任意分段下都能正确解析工具调用与文本"""
+        for size in (1, 3, 8, len(self.TOOL_TEXT)):
+            events = _feed_in_chunks(self.TOOL_TEXT, size)
+            text = "".join(e["text"] for e in events if e["type"] == "text")
+            partial = "".join(
+                e["partial_json"] for e in events if e["type"] == "input_json_delta"
+            )
+            starts = [e for e in events if e["type"] == "tool_use_start"]
+            assert text == "Let me read it.\n\nDone."
+            assert json.loads(partial) == {"file_path": '/a " }```', "n": [1, 2]}
+            assert starts == [
+                {"type": "tool_use_start", "id": "call_1", "name": "Read"}
+            ]
+
+    def test_tool_start_before_block_closes(self) -> None:
+        """测试解析到 input 起始位置即开始工具调用，无需等待代码块结束"""
+        parser = IncrementalToolCallParser()
+        events = parser.feed(
+            '```json\n{"type": "tool_use", "name": "Write", "input": {"content": "ab'
+        )
+        assert [e["type"] for e in events] == ["tool_use_start", "input_json_delta"]
+
+    def test_non_tool_block_kept_as_text(self) -> None:
+        """测试非工具调用的 JSON 代码块原样保留为文本"""
+        text = 'See:\n```json\n{"a": 1}\n```'
+        events = _feed_in_chunks(text, 4)
+        assert all(e["type"] == "text" for e in events)
+        assert "".join(e["text"] for e in events) == text
+
+    def test_fallback_single_quotes(self) -> None:
+        """测试无法增量解析的代码块在闭合后整体解析"""
+        text = "```json\n{'type': 'tool_use', 'name': 'Grep', 'input': {}}\n```"
+        events = _feed_in_chunks(text, 5)
+        assert [e["type"] for e in events] == [
+            "tool_use_start",
+            "input_json_delta",
+            "tool_use_stop",
+        ]
+        assert events[0]["name"] == "Grep"
+
+
+class TestNativeToolHelpers:
+    """测试原生函数调用相关的转换函数"""
+
+    def test_supports_native_tools(self) -> None:
+        """测试按模型名称前缀匹配"""
+        assert supports_native_tools("GPT-4o-mini", ["gpt-4o"])
+        assert supports_native_tools("any", ["*"])
+        assert not supports_native_tools("qwen3", ["gpt-4o", ""])
+
+    def test_convert_tool_choice(self) -> None:
+        """测试 tool_choice 映射"""
+        assert convert_tool_choice_to_openai({"type": "auto"}) == "auto"
+        assert convert_tool_choice_to_openai({"type": "any"}) == "required"
+        assert convert_tool_choice_to_openai({"type": "tool", "name": "Read"}) == {
+            "type": "function",
+            "function": {"name": "Read"},
+        }
+        assert convert_tool_choice_to_openai(None) is None
+
+
+class TestPrefixAffinityKey:
+    """测试前缀亲和键"""
+
+    def test_stable_across_turns(self) -> None:
+        """测试同一会话后续轮次的键不变，不同首条消息的键不同"""
+        first = [
+            {"role": "system", "content": "sys"},
+            {"role": "user", "content": "hello"},
+        ]
+        later = first + [
+            {"role": "assistant", "content": "hi"},
+            {"role": "user", "content": "next"},
+        ]
+        other = [first[0], {"role": "user", "content": "bye"}]
+        assert prefix_affinity_key(first, 1) == prefix_affinity_key(later, 1)
+        assert prefix_affinity_key(first, 1) != prefix_affinity_key(other, 1)
+        assert prefix_affinity_key(first, 2) != prefix_affinity_key(later, 2)
+
+    def test_exclude_trailing_tool_prompt(self) -> None:
+        """测试排除每轮变化的工具选择提示词"""
+        first = [
+            {"role": "system", "content": "sys"},
+            {"role": "user", "content": "hello"},
+        ]
+        prompt_a = {"role": "user", "content": "tools: Read"}
+        prompt_b = {"role": "user", "content": "tools: Write"}
+        key_a = prefix_affinity_key(first + [prompt_a], 2, prompt_a)
+        key_b = prefix_affinity_key(first + [prompt_b], 2, prompt_b)
+        assert key_a == key_b == prefix_affinity_key(first, 2)